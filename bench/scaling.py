@@ -0,0 +1,158 @@
+'''
+Scaling benchmark for the node server poll path.
+
+Runs discovery and N short poll cycles against synthetic accounts of
+increasing size, with a stub Polyglot, and reports poll cycle CPU time,
+memory and driver update rate per channel count.
+
+    python -m bench.scaling --channels 10,100,500 --cycles 120
+    python -m bench.scaling --channels 10,100,500 --json > scaling.json
+    python -m bench.scaling --channels 100 --poll-interval 10 --interval-average 8
+'''
+
+import argparse
+import json
+import math
+import sys
+import time
+import tracemalloc
+
+from bench import stub_udi
+udi_interface = stub_udi.install()
+
+import pyemvue
+import pyemvue.replay
+import query
+import vue as nodeserver
+from bench.synthetic import SyntheticAccount, SyntheticSession
+
+
+def build(channels, circuits, plugs, chargers, chart_seconds=0):
+    '''Synthetic account with about the requested number of channels.'''
+    per_monitor = circuits + 1 + plugs + chargers
+    monitors = max(1, int(math.ceil(channels / per_monitor)))
+    return SyntheticAccount(monitors=monitors, circuits=circuits,
+            plugs=plugs * monitors, chargers=chargers * monitors, chart_seconds=chart_seconds)
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    index = min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def run(account, cycles, warmup=5, poll_interval=1, interval_limit=0, shard_size=0):
+    counters = udi_interface.counters
+    counters.reset()
+
+    session = SyntheticSession(account)
+    vue = pyemvue.replay.offline(pyemvue.PyEmVue(), session)
+    polyglot = udi_interface.Interface()
+
+    nodeserver.polyglot = polyglot
+    nodeserver.vue = vue
+    nodeserver.querys = query.Query(polyglot, vue)
+    nodeserver.querys.interval_limit = interval_limit
+    nodeserver.querys.shard_size = shard_size
+    # polls run back to back rather than in real time, don't wait for
+    # the next 1S sample to be published
+    nodeserver.querys.align = lambda scale, timeout: 0
+    nodeserver.topology = {}
+    nodeserver.ready = False
+
+    start = time.process_time()
+    nodeserver.discover()
+    discover_cpu = time.process_time() - start
+    nodes = counters.add_node
+
+    for i in range(warmup):
+        for s in range(poll_interval):
+            account.step()
+        nodeserver.querys.query(pyemvue.enums.Scale.SECOND.value, extra=True)
+
+    counters.reset()
+    session.requests = {}
+    tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+    cpu = []
+    wall = []
+    for i in range(cycles):
+        for s in range(poll_interval):
+            account.step()
+        start = time.process_time()
+        started = time.perf_counter()
+        nodeserver.querys.query(pyemvue.enums.Scale.SECOND.value, extra=True)
+        cpu.append(time.process_time() - start)
+        wall.append(time.perf_counter() - started)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        'channels': account.channel_count(),
+        'nodes': nodes,
+        'cycles': cycles,
+        'discover_ms': round(1000 * discover_cpu, 2),
+        'cpu_ms_mean': round(1000 * sum(cpu) / len(cpu), 3),
+        'cpu_ms_p95': round(1000 * percentile(cpu, 95), 3),
+        'wall_ms_mean': round(1000 * sum(wall) / len(wall), 3),
+        'memory_growth_kb': round((current - base) / 1024, 1),
+        'memory_peak_kb': round((peak - base) / 1024, 1),
+        'set_driver_per_cycle': round(counters.set_driver / cycles, 1),
+        'driver_sent_per_cycle': round(counters.driver_sent / cycles, 1),
+        'requests': dict(session.requests),
+        'requests_per_cycle': round(sum(session.requests.values()) / cycles, 1),
+    }
+
+
+def chart(results, key, width=50):
+    top = max(r[key] for r in results) or 1
+    lines = ['{} by channel count'.format(key)]
+    for r in results:
+        bar = '#' * max(1, int(width * r[key] / top))
+        lines.append('{:>6} | {} {}'.format(r['channels'], bar, r[key]))
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Node server poll path scaling benchmark')
+    parser.add_argument('--channels', default='10,50,100,250,500', help='comma separated channel counts')
+    parser.add_argument('--cycles', type=int, default=60, help='poll cycles per channel count')
+    parser.add_argument('--circuits', type=int, default=16, help='circuits per monitor')
+    parser.add_argument('--plugs', type=int, default=2, help='smart plugs nested under each monitor')
+    parser.add_argument('--chargers', type=int, default=0, help='EV chargers nested under each monitor')
+    parser.add_argument('--poll-interval', type=int, default=1, help='seconds of samples between short polls')
+    parser.add_argument('--interval-average', type=int, default=0,
+            help='fetch the interval average with this many concurrent chart requests (default off)')
+    parser.add_argument('--shard-size', type=int, default=0, help='devices per usage request (default all)')
+    parser.add_argument('--json', action='store_true', help='print results as JSON')
+    args = parser.parse_args()
+
+    results = []
+    for channels in [int(c) for c in args.channels.split(',')]:
+        # keep just the samples an interval average needs
+        chart_seconds = args.poll_interval + 1 if args.interval_average else 0
+        account = build(channels, args.circuits, args.plugs, args.chargers, chart_seconds)
+        results.append(run(account, args.cycles, poll_interval=args.poll_interval, interval_limit=args.interval_average,
+                shard_size=args.shard_size))
+
+    if args.json:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+        return
+
+    print('{:>8} {:>6} {:>10} {:>10} {:>10} {:>12} {:>12} {:>10} {:>10}'.format(
+        'channels', 'nodes', 'cpu ms', 'p95 ms', 'wall ms', 'mem grow KB', 'setDriver/c', 'sent/c', 'requests/c'))
+    for r in results:
+        print('{:>8} {:>6} {:>10} {:>10} {:>10} {:>12} {:>12} {:>10} {:>10}'.format(
+            r['channels'], r['nodes'], r['cpu_ms_mean'], r['cpu_ms_p95'], r['wall_ms_mean'],
+            r['memory_growth_kb'], r['set_driver_per_cycle'], r['driver_sent_per_cycle'], r['requests_per_cycle']))
+    print()
+    print(chart(results, 'cpu_ms_mean'))
+    print()
+    print(chart(results, 'driver_sent_per_cycle'))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+'''
+A stand-in for udi_interface so the node server code can run outside of
+Polyglot.  install() must be called before importing query, vue or the
+nodes.  The stub Polyglot counts addNode/setDriver calls, and how many
+setDriver calls would actually have been sent to the ISY.
+'''
+
+import logging
+import sys
+import types
+
+LOGGER = logging.getLogger('udi_interface')
+
+
+class Counters(object):
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.add_node = 0
+        self.set_driver = 0
+        self.driver_sent = 0
+
+
+counters = Counters()
+
+
+class Node(object):
+    drivers = []
+
+    def __init__(self, polyglot, primary, address, name):
+        self.poly = polyglot
+        self.primary = primary
+        self.address = address
+        self.name = name
+        self.values = {d['driver']: d['value'] for d in self.drivers}
+
+    def setDriver(self, driver, value, report=True, force=False, uom=None):
+        counters.set_driver += 1
+        if force or self.values.get(driver) != value:
+            counters.driver_sent += 1
+        self.values[driver] = value
+
+    def getDriver(self, driver):
+        return self.values.get(driver)
+
+
+class Custom(dict):
+    def __init__(self, polyglot, name):
+        super(Custom, self).__init__()
+
+    def load(self, params):
+        self.update(params)
+
+
+class Interface(object):
+    CUSTOMPARAMS = 'customparams'
+    POLL = 'poll'
+    DISCOVER = 'discover'
+    START = 'start'
+
+    def __init__(self, args=None):
+        self.nodes = {}
+        self.Notices = {}
+
+    def getNode(self, address):
+        return self.nodes.get(address)
+
+    def getNodes(self):
+        return self.nodes
+
+    def addNode(self, node, conn_status=None):
+        counters.add_node += 1
+        self.nodes[node.address] = node
+        return node
+
+    def delNode(self, address):
+        self.nodes.pop(address, None)
+
+    def renameNode(self, address, name):
+        if address in self.nodes:
+            self.nodes[address].name = name
+
+    def getValidName(self, name):
+        return name
+
+    def subscribe(self, *args):
+        pass
+
+
+def install():
+    '''Register the stub as the udi_interface module.'''
+    module = types.ModuleType('udi_interface')
+    module.LOGGER = LOGGER
+    module.Node = Node
+    module.Custom = Custom
+    module.Interface = Interface
+    module.counters = counters
+    sys.modules['udi_interface'] = module
+    return module
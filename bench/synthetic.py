@@ -0,0 +1,221 @@
+'''
+Synthetic Emporia accounts for benchmarking.
+
+SyntheticAccount builds a consistent set of customers/devices,
+locationProperties, getDeviceListUsages and devices/status payloads for
+any number of Vue monitors, circuits per monitor, and smart plugs / EV
+chargers nested under the monitors' circuits.  Usage follows a seeded
+random walk so repeated runs see the same data, and each monitor's Main
+channel is the sum of its circuits.  Each step is a new 1 second sample
+instant, the last chart_seconds samples are kept for getChartUsage.
+
+SyntheticSession serves those payloads in place of requests.Session, use
+pyemvue.replay.offline(vue, SyntheticSession(account)) to point a PyEmVue
+at it.
+'''
+
+import collections
+import datetime
+import json
+import random
+import threading
+from urllib.parse import urlparse, parse_qs
+
+SCALE_SECONDS = {
+    '1S': 1, '1MIN': 60, '15MIN': 900, '1H': 3600,
+    '1D': 86400, '1W': 604800, '1MON': 2592000, '1Y': 31536000,
+}
+
+FIRST_GID = 100000
+
+
+class SyntheticAccount(object):
+    def __init__(self, monitors=1, circuits=16, plugs=0, chargers=0, seed=1, chart_seconds=0):
+        self.random = random.Random(seed)
+        self.monitors = []
+        self.nested = []
+        self.outlets = {}
+        self.chargers = {}
+        self.power = {}
+        self.lock = threading.Lock()
+        self.clock = datetime.datetime.now(datetime.timezone.utc).replace(microsecond=0)
+        self.samples = collections.deque(maxlen=chart_seconds)
+
+        gid = FIRST_GID
+        for m in range(monitors):
+            self.monitors.append(gid)
+            for c in range(1, circuits + 1):
+                self.power[(gid, str(c))] = self.random.uniform(0.0, 2.0)
+            gid += 1
+
+        # nest plugs and chargers round robin under the monitors' circuits
+        for n in range(plugs + chargers):
+            parent = self.monitors[n % monitors]
+            channel = str(n // monitors % max(circuits, 1) + 1)
+            self.nested.append((gid, parent, channel))
+            if n < plugs:
+                self.outlets[gid] = True
+            else:
+                self.chargers[gid] = [True, 16, 40]
+            self.power[(gid, '1,2,3')] = self.random.uniform(0.0, 1.0)
+            gid += 1
+        self.circuits = circuits
+
+    def channel_count(self):
+        return len(self.monitors) * (self.circuits + 1) + len(self.nested)
+
+    def step(self):
+        '''Advance the random walk of every channel by one sample.'''
+        with self.lock:
+            self.clock += datetime.timedelta(seconds=1)
+            for key, kw in self.power.items():
+                self.power[key] = max(0.0, kw + self.random.uniform(-0.05, 0.05))
+            if self.samples.maxlen:
+                self.samples.append((self.clock, dict(self.power)))
+
+    def devices(self):
+        devices = []
+        for gid in self.monitors:
+            channels = [{'deviceGid': gid, 'name': 'Main', 'channelNum': '1,2,3', 'channelMultiplier': 1.0, 'channelTypeGid': 1}]
+            for c in range(1, self.circuits + 1):
+                channels.append({'deviceGid': gid, 'name': 'Circuit {}'.format(c), 'channelNum': str(c),
+                    'channelMultiplier': 1.0, 'channelTypeGid': 2})
+            nested = []
+            for child, parent, channel in self.nested:
+                if parent == gid:
+                    nested.append(self._nested_device(child, parent, channel))
+            devices.append({'deviceGid': gid, 'manufacturerDeviceId': 'SYN{}'.format(gid), 'model': 'VUE002',
+                'firmware': 'synthetic', 'channels': channels, 'devices': nested,
+                'locationProperties': {'deviceName': 'Monitor {}'.format(gid)}})
+        return {'customerGid': 1, 'devices': devices}
+
+    def _nested_device(self, gid, parent, channel):
+        dev = {'deviceGid': gid, 'manufacturerDeviceId': 'SYN{}'.format(gid), 'firmware': 'synthetic',
+            'parentDeviceGid': parent, 'parentChannelNum': channel,
+            'channels': [{'deviceGid': gid, 'name': None, 'channelNum': '1,2,3', 'channelMultiplier': 1.0, 'channelTypeGid': 1}],
+            'locationProperties': {'deviceName': 'Plug {}'.format(gid)}}
+        if gid in self.outlets:
+            dev['model'] = 'SSO001'
+            dev['outlet'] = {'deviceGid': gid, 'outletOn': self.outlets[gid], 'loadGid': 0}
+        else:
+            dev['model'] = 'VVDN01'
+            on, rate, max_rate = self.chargers[gid]
+            dev['evCharger'] = {'deviceGid': gid, 'chargerOn': on, 'chargingRate': rate, 'maxChargingRate': max_rate}
+        return dev
+
+    def properties(self, gid):
+        return {'deviceGid': gid, 'deviceName': 'Device {}'.format(gid), 'timeZone': 'America/Chicago',
+            'usageCentPerKwHour': 12.5, 'peakDemandDollarPerKw': 0.0, 'billingCycleStartDay': 1,
+            'solar': False, 'locationInformation': {}}
+
+    def usage(self, gids, scale, instant=None):
+        seconds = SCALE_SECONDS.get(scale, 1)
+        if instant is None:
+            instant = self.clock
+
+        def kwh(kw):
+            return kw * seconds / 3600
+
+        devices = []
+        with self.lock:
+            for gid in gids:
+                if gid in self.monitors:
+                    usages = []
+                    total = 0.0
+                    for c in range(1, self.circuits + 1):
+                        kw = self.power[(gid, str(c))]
+                        total += kw
+                        nested = [self._nested_usage(child, kwh) for child, parent, channel in self.nested
+                            if parent == gid and channel == str(c)]
+                        usages.append({'deviceGid': gid, 'channelNum': str(c), 'name': 'Circuit {}'.format(c),
+                            'usage': kwh(kw), 'percentage': 0.0, 'nestedDevices': nested})
+                    usages.insert(0, {'deviceGid': gid, 'channelNum': '1,2,3', 'name': 'Main',
+                        'usage': kwh(total), 'percentage': 100.0, 'nestedDevices': []})
+                    devices.append({'deviceGid': gid, 'channelUsages': usages})
+        return {'deviceListUsages': {'instant': instant.strftime('%Y-%m-%dT%H:%M:%SZ'), 'scale': scale,
+            'energyUnit': 'KilowattHours', 'devices': devices}}
+
+    def chart(self, gid, channel, start, end):
+        '''1S chart usage of one channel from the kept samples.'''
+        with self.lock:
+            # samples are one second apart and end at the clock
+            last = len(self.samples) - 1
+            low = max(0, last - int((self.clock - start).total_seconds()))
+            high = last - int((self.clock - end).total_seconds())
+            samples = [self.samples[i] for i in range(low, high + 1)]
+        if channel == '1,2,3' and gid in self.monitors:
+            usage = [sum(power[(gid, str(c))] for c in range(1, self.circuits + 1)) / 3600 for t, power in samples]
+        else:
+            usage = [power[(gid, channel)] / 3600 if (gid, channel) in power else None for t, power in samples]
+        first = samples[0][0] if samples else start
+        return {'firstUsageInstant': first.strftime('%Y-%m-%dT%H:%M:%SZ'), 'usageList': usage}
+
+    def _nested_usage(self, gid, kwh):
+        return {'deviceGid': gid, 'channelUsages': [{'deviceGid': gid, 'channelNum': '1,2,3', 'name': 'Main',
+            'usage': kwh(self.power[(gid, '1,2,3')]), 'percentage': 0.0, 'nestedDevices': []}]}
+
+    def status(self):
+        outlets = [{'deviceGid': gid, 'outletOn': on, 'loadGid': 0} for gid, on in self.outlets.items()]
+        chargers = [{'deviceGid': gid, 'chargerOn': c[0], 'chargingRate': c[1], 'maxChargingRate': c[2]}
+            for gid, c in self.chargers.items()]
+        connected = [{'deviceGid': gid, 'connected': True, 'offlineSince': None} for gid in self.monitors]
+        connected += [{'deviceGid': gid, 'connected': True, 'offlineSince': None} for gid, p, c in self.nested]
+        return {'outlets': outlets, 'evChargers': chargers, 'devicesConnected': connected}
+
+
+class SyntheticResponse(object):
+    def __init__(self, status, body):
+        self.status_code = status
+        self.headers = {}
+        self.text = json.dumps(body) if body is not None else ''
+
+    def json(self):
+        return json.loads(self.text)
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise Exception('{} Error (synthetic)'.format(self.status_code))
+
+
+class SyntheticSession(object):
+    '''Answers PyEmVue requests from a SyntheticAccount, counting requests per endpoint.'''
+    def __init__(self, account):
+        self.account = account
+        self.headers = {}
+        self.requests = {}
+        self.lock = threading.Lock()
+
+    def _count(self, endpoint):
+        with self.lock:
+            self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+
+    def get(self, url, **kwargs):
+        parsed = urlparse(url)
+        query = parse_qs(parsed.query)
+        if parsed.path == '/AppAPI' and query.get('apiMethod') == ['getDeviceListUsages']:
+            self._count('usage')
+            gids = [int(g) for g in query['deviceGids'][0].replace(' ', '+').split('+')]
+            return SyntheticResponse(200, self.account.usage(gids, query['scale'][0]))
+        if parsed.path == '/AppAPI' and query.get('apiMethod') == ['getChartUsage']:
+            self._count('chart')
+            return SyntheticResponse(200, self.account.chart(int(query['deviceGid'][0]), query['channel'][0],
+                    _parse_time(query['start'][0]), _parse_time(query['end'][0])))
+        if parsed.path == '/customers/devices':
+            self._count('devices')
+            return SyntheticResponse(200, self.account.devices())
+        if parsed.path == '/customers/devices/status':
+            self._count('status')
+            return SyntheticResponse(200, self.account.status())
+        if parsed.path.endswith('/locationProperties'):
+            self._count('properties')
+            return SyntheticResponse(200, self.account.properties(int(parsed.path.split('/')[2])))
+        return SyntheticResponse(404, None)
+
+    def put(self, url, json=None, **kwargs):
+        self._count('put')
+        return SyntheticResponse(200, json)
+
+
+def _parse_time(text):
+    '''Times in the urls are UTC isoformat with a Z.'''
+    return datetime.datetime.fromisoformat(text.rstrip('Z')).replace(tzinfo=datetime.timezone.utc)
@@ -0,0 +1,83 @@
+'''
+The CommandDispatcher sends outlet and charger updates to the Emporia
+Cloud on its own thread so that node command handlers return right away.
+
+Nodes set their drivers optimistically and submit the change.  Pending
+changes are coalesced per device, so a burst of SET_RATE commands only
+sends the latest rate.  Once the PUT completes the node refreshes its
+drivers from the device object, which either confirms the new state or
+rolls back to the last state the cloud reported.
+
+While hold() is True (Emporia is down for maintenance) pending changes
+are kept and sent once it's over.
+'''
+
+import udi_interface
+import threading
+import collections
+import time
+
+LOGGER = udi_interface.LOGGER
+
+# seconds between hold() checks while commands are held
+HOLD_RECHECK = 5
+
+class CommandDispatcher(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.pending = collections.OrderedDict()
+        self.inflight = set()
+        self.thread = None
+        self.hold = None
+
+    # queue a change for a node.  changes are merged with anything
+    # already pending for the same device.
+    def submit(self, node, **changes):
+        gid = node.address
+        with self.lock:
+            if gid in self.pending:
+                self.pending[gid][1].update(changes)
+            else:
+                self.pending[gid] = (node, dict(changes))
+
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+        self.wake.set()
+
+    # True while a device has a command waiting or being sent. Status
+    # polls shouldn't overwrite the optimistic state during that time.
+    def busy(self, gid):
+        with self.lock:
+            return gid in self.pending or gid in self.inflight
+
+    def run(self):
+        while True:
+            self.wake.wait()
+            if self.hold is not None and self.hold():
+                time.sleep(HOLD_RECHECK)
+                continue
+            with self.lock:
+                if not self.pending:
+                    self.wake.clear()
+                    continue
+                gid, (node, changes) = self.pending.popitem(last=False)
+                self.inflight.add(gid)
+
+            try:
+                LOGGER.debug('Sending {} to {}'.format(changes, gid))
+                node.send_update(changes)
+            except Exception as e:
+                LOGGER.error('Command for {} failed: {}'.format(gid, e))
+
+            with self.lock:
+                self.inflight.discard(gid)
+                newer = gid in self.pending
+
+            # if another command is queued it will refresh the node
+            if not newer:
+                try:
+                    node.refresh_state()
+                except Exception as e:
+                    LOGGER.error('Failed to refresh {}: {}'.format(gid, e))
@@ -0,0 +1,271 @@
+'''
+Batched export of every poll's channel values to a time-series database
+that accepts InfluxDB line protocol over HTTP (InfluxDB, VictoriaMetrics,
+...), so nothing else needs to poll the Emporia Cloud for the same data.
+
+The export is configured with the Export custom parameter as a JSON
+object:
+
+  {
+    "url": "http://influx:8086/write?db=emporia",   # line protocol endpoint
+    "token": "",                 # optional, sent as Authorization: Token ...
+    "measurement": "emporia",    # optional
+    "batch": 5000,               # lines per write
+    "interval": 10,              # seconds, flush at least this often
+    "spool": "/path/to/dir",     # optional, batches that can't be sent
+    "spool_mb": 100              # cap on the spool directory
+  }
+
+The poll thread only puts each poll's values on a queue bounded by the
+number of points waiting (QUEUE_POINTS) and never waits.  A worker
+thread formats them as line protocol, writes a batch when it's full or
+the interval has passed, and retries failed writes with exponential
+backoff.  A batch that still fails goes to a spool file (or is dropped
+without a spool) and spooled batches are sent once the sink is back.
+When the queue is full new values are dropped and counted, so an
+outage can't grow memory without bound.
+'''
+
+import udi_interface
+import json
+import logging
+import os
+import queue
+import threading
+import time
+import requests
+import polllog
+from snapshot import FIELDS
+
+LOGGER = udi_interface.LOGGER
+
+QUEUE_POINTS = 100000
+RETRIES = 3
+BACKOFF_MAX = 30
+REPORT_INTERVAL = 600
+
+
+def parse_export(text):
+    '''Parse the Export custom parameter, raises ValueError if invalid.'''
+    if text is None or text.strip() == '':
+        return {}
+    config = json.loads(text)
+    if not isinstance(config, dict):
+        raise ValueError('Export must be a JSON object')
+    if not str(config.get('url', '')).startswith(('http://', 'https://')):
+        raise ValueError('Export needs an http(s) url')
+    try:
+        if int(config.get('batch', 5000)) < 1 or float(config.get('interval', 10)) <= 0:
+            raise ValueError('batch and interval must be positive')
+        float(config.get('spool_mb', 100))
+    except TypeError as e:
+        raise ValueError('Invalid Export setting: {}'.format(e))
+    return config
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace(',', '\\,').replace('=', '\\=').replace(' ', '\\ ')
+
+
+class Exporter(object):
+    def __init__(self, config, queue_points=QUEUE_POINTS):
+        self.config = config
+        self.url = config['url']
+        self.measurement = _escape(config.get('measurement', 'emporia'))
+        self.batch_size = int(config.get('batch', 5000))
+        self.interval = float(config.get('interval', 10))
+        self.spool = config.get('spool')
+        self.spool_bytes = int(float(config.get('spool_mb', 100)) * 1024 * 1024)
+        self.timeout = min(10, self.interval)
+
+        self.session = requests.Session()
+        if config.get('token'):
+            self.session.headers['Authorization'] = 'Token {}'.format(config['token'])
+
+        self.queue = queue.Queue()
+        self.queue_points = queue_points
+        self.pending = 0
+        self.pending_lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.thread = None
+        self.tags = {}
+        self.stats = {
+            'queued': 0,
+            'dropped': 0,          # values dropped because the queue was full
+            'sent_points': 0,
+            'sent_batches': 0,
+            'retries': 0,
+            'failed_batches': 0,   # batches that couldn't be sent or spooled
+            'spooled_batches': 0,
+            'unspooled_batches': 0,
+            'spool_dropped': 0,    # spool files removed to stay under the cap
+        }
+        self.last_error = None
+        self.log = polllog.PollLogger(LOGGER)
+        self.last_report = time.monotonic()
+
+    def start(self):
+        if self.spool:
+            os.makedirs(self.spool, exist_ok=True)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self, timeout=5):
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join(timeout)
+
+    # called from the poll thread, changes maps a node address to
+    # (gid, channel number, name, value).  Never blocks.
+    def publish(self, scale, changes):
+        if scale not in FIELDS or not changes:
+            return
+        with self.pending_lock:
+            if self.pending + len(changes) > self.queue_points:
+                self.stats['dropped'] += len(changes)
+                return
+            self.pending += len(changes)
+            self.stats['queued'] += len(changes)
+        self.queue.put_nowait((scale, changes, time.time_ns()))
+
+    # points waiting on the queue
+    def depth(self):
+        return self.pending
+
+    def take(self, block=True, timeout=None):
+        scale, changes, stamp = self.queue.get(block, timeout)
+        with self.pending_lock:
+            self.pending -= len(changes)
+        return self.format(scale, changes, stamp)
+
+    # stamp is the publish time in nanoseconds, whole seconds would let
+    # two updates in the same second overwrite each other in the database
+    def format(self, scale, changes, stamp):
+        field = FIELDS[scale]
+        lines = []
+        for address, (gid, channel_num, name, value) in changes.items():
+            if value is None:
+                continue
+            if scale == '1S':
+                value = value * 3600
+            tags = self.tags.get((address, name))
+            if tags is None:
+                tags = '{},gid={},channel={},name={}'.format(self.measurement, gid,
+                        _escape(channel_num), _escape(name if name else address))
+                self.tags[(address, name)] = tags
+            lines.append('{} {}={} {}'.format(tags, field, round(value, 6), stamp))
+        return lines
+
+    def run(self):
+        lines = []
+        deadline = time.monotonic() + self.interval
+        while True:
+            timeout = max(0, deadline - time.monotonic())
+            try:
+                lines.extend(self.take(timeout=min(timeout, 1)))
+            except queue.Empty:
+                pass
+
+            stopping = self.stopping.is_set()
+            if len(lines) >= self.batch_size or time.monotonic() >= deadline or stopping:
+                if stopping:
+                    # take what's left on the queue with us
+                    while True:
+                        try:
+                            lines.extend(self.take(block=False))
+                        except queue.Empty:
+                            break
+                while lines:
+                    batch = lines[:self.batch_size]
+                    del lines[:self.batch_size]
+                    self.flush(batch, retry=not stopping)
+                deadline = time.monotonic() + self.interval
+                self.report()
+                if stopping:
+                    return
+
+    def flush(self, lines, retry=True):
+        body = '\n'.join(lines).encode('utf-8')
+        if self.write(body, retry):
+            self.stats['sent_points'] += len(lines)
+            self.stats['sent_batches'] += 1
+            self.unspool()
+        elif not self.spool_batch(body):
+            self.stats['failed_batches'] += 1
+
+    # POST a batch, retrying with exponential backoff.  Gives up early
+    # when stopping.
+    def write(self, body, retry=True):
+        delay = 1
+        for attempt in range(RETRIES + 1 if retry else 1):
+            if attempt:
+                self.stats['retries'] += 1
+                if self.stopping.wait(delay):
+                    return False
+                delay = min(delay * 2, BACKOFF_MAX)
+            try:
+                response = self.session.post(self.url, data=body, timeout=self.timeout)
+                if response.status_code < 300:
+                    return True
+                self.last_error = 'HTTP {}'.format(response.status_code)
+                # a bad request won't get better by retrying
+                if 400 <= response.status_code < 500 and response.status_code != 429:
+                    break
+            except requests.RequestException as e:
+                self.last_error = str(e)
+        self.log.limited(logging.WARNING, 'export', 'Export to %s failed: %s', self.url, self.last_error)
+        return False
+
+    def spool_files(self):
+        try:
+            return sorted(f for f in os.listdir(self.spool) if f.endswith('.lp'))
+        except OSError:
+            return []
+
+    def spool_batch(self, body):
+        if not self.spool:
+            return False
+        try:
+            files = self.spool_files()
+            used = sum(os.path.getsize(os.path.join(self.spool, f)) for f in files)
+            # keep the newest data, remove the oldest batches over the cap
+            while files and used + len(body) > self.spool_bytes:
+                oldest = os.path.join(self.spool, files.pop(0))
+                used -= os.path.getsize(oldest)
+                os.remove(oldest)
+                self.stats['spool_dropped'] += 1
+            if len(body) > self.spool_bytes:
+                return False
+            name = os.path.join(self.spool, '{:020d}.lp'.format(time.time_ns()))
+            with open(name + '.tmp', 'wb') as f:
+                f.write(body)
+            os.replace(name + '.tmp', name)
+            self.stats['spooled_batches'] += 1
+            return True
+        except OSError as e:
+            LOGGER.error('Failed to spool export batch: {}'.format(e))
+            return False
+
+    # send a few spooled batches, oldest first, after a successful write
+    def unspool(self, limit=10):
+        if not self.spool:
+            return
+        for f in self.spool_files()[:limit]:
+            path = os.path.join(self.spool, f)
+            try:
+                with open(path, 'rb') as spooled:
+                    body = spooled.read()
+            except OSError:
+                continue
+            if not self.write(body, retry=False):
+                return
+            os.remove(path)
+            self.stats['unspooled_batches'] += 1
+
+    def report(self):
+        if time.monotonic() - self.last_report < REPORT_INTERVAL:
+            return
+        self.last_report = time.monotonic()
+        LOGGER.info('Export: {} points sent in {} batches, {} dropped, {} retries, {} spooled, {} failed, {} points queued'.format(
+            self.stats['sent_points'], self.stats['sent_batches'], self.stats['dropped'], self.stats['retries'],
+            self.stats['spooled_batches'], self.stats['failed_batches'], self.depth()))
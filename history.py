@@ -0,0 +1,235 @@
+'''
+The history module keeps a bounded, in-memory history of the most
+recent samples for each channel so that windowed statistics (average,
+peak, minimum) can be computed locally without any extra queries to the
+Emporia Cloud.
+'''
+
+import array
+import calendar
+import collections
+
+
+class RingBuffer(object):
+    '''
+    Fixed size ring buffer of float samples backed by preallocated
+    arrays.
+
+    append() is O(1).  Sums over the last n samples are O(1) using a
+    ring of cumulative totals that is periodically rebased so it can't
+    lose precision.  The window min/max are O(1) amortized using
+    monotonic queues of sample sequence numbers.
+
+    Each sample also keeps the time it was taken so means can be over a
+    time span (mean_since) as well as over a number of samples.
+    '''
+    def __init__(self, size):
+        if size < 1:
+            raise ValueError('Ring buffer size must be at least 1')
+        self.size = size
+        self.samples = array.array('d', bytes(8 * size))
+        self.times = array.array('d', bytes(8 * size))
+        # totals[i % (size + 1)] holds the sum of the first i samples
+        self.totals = array.array('d', bytes(8 * (size + 1)))
+        self.count = 0
+        self._maxq = collections.deque(maxlen=size)
+        self._minq = collections.deque(maxlen=size)
+
+    def __len__(self):
+        return min(self.count, self.size)
+
+    def append(self, value, when=0.0):
+        seq = self.count
+        self.samples[seq % self.size] = value
+        self.times[seq % self.size] = when
+
+        span = self.size + 1
+        self.totals[(seq + 1) % span] = self.totals[seq % span] + value
+        self.count = seq + 1
+
+        # drop anything that just fell out of the window
+        oldest = self.count - self.size
+        while self._maxq and self._maxq[0] < oldest:
+            self._maxq.popleft()
+        while self._minq and self._minq[0] < oldest:
+            self._minq.popleft()
+
+        while self._maxq and self.samples[self._maxq[-1] % self.size] <= value:
+            self._maxq.pop()
+        self._maxq.append(seq)
+        while self._minq and self.samples[self._minq[-1] % self.size] >= value:
+            self._minq.pop()
+        self._minq.append(seq)
+
+        if self.count % self.size == 0:
+            self._rebase()
+
+    def _rebase(self):
+        # Subtract the oldest total still in use so the cumulative sums
+        # stay on the same order of magnitude as the window sum.
+        span = self.size + 1
+        base = self.totals[(self.count - self.size) % span]
+        if base == 0.0:
+            return
+        for i in range(span):
+            self.totals[i] -= base
+
+    def last(self):
+        if self.count == 0:
+            return None
+        return self.samples[(self.count - 1) % self.size]
+
+    def sum(self, n=None):
+        '''Sum of the last n samples (default is the whole window).'''
+        n = len(self) if n is None else min(n, len(self))
+        if n == 0:
+            return 0.0
+        span = self.size + 1
+        return self.totals[self.count % span] - self.totals[(self.count - n) % span]
+
+    def mean(self, n=None):
+        n = len(self) if n is None else min(n, len(self))
+        if n == 0:
+            return None
+        return self.sum(n) / n
+
+    def since(self, when):
+        '''Number of samples taken at or after when, O(log n).'''
+        lo = self.count - len(self)
+        hi = self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.times[mid % self.size] < when:
+                lo = mid + 1
+            else:
+                hi = mid
+        return self.count - lo
+
+    def mean_since(self, when):
+        '''Mean of the samples taken at or after when.'''
+        return self.mean(self.since(when))
+
+    def max(self):
+        if self.count == 0:
+            return None
+        return self.samples[self._maxq[0] % self.size]
+
+    def min(self):
+        if self.count == 0:
+            return None
+        return self.samples[self._minq[0] % self.size]
+
+
+class ChannelHistory(object):
+    '''
+    A ring buffer per node address.  The buffers are allocated the first
+    time an address is seen so memory is O(channels x window).
+    '''
+    def __init__(self, window=3600):
+        self.window = window
+        self.buffers = {}
+
+    def record(self, address, value, when=0.0):
+        buf = self.buffers.get(address)
+        if buf is None:
+            buf = RingBuffer(self.window)
+            self.buffers[address] = buf
+        buf.append(value, when)
+        return buf
+
+    def get(self, address):
+        return self.buffers.get(address)
+
+    def remove(self, address):
+        self.buffers.pop(address, None)
+
+
+def billing_cycle(now, start_day):
+    '''(year, month) of the billing cycle that local time now falls in.'''
+    # clamp the start day for short months
+    day = min(start_day if start_day else 1, calendar.monthrange(now.year, now.month)[1])
+    if now.day >= day:
+        return (now.year, now.month)
+    if now.month == 1:
+        return (now.year - 1, 12)
+    return (now.year, now.month - 1)
+
+
+class NetMeter(object):
+    '''
+    Splits one Main channel's net power into energy imported from and
+    exported to the grid, by the sign of each sample.  Energy is
+    integrated over the time between samples and totalled for the
+    current local hour, day and month.  Gaps longer than max_gap seconds
+    are not counted.
+    '''
+    def __init__(self, max_gap=300):
+        self.max_gap = max_gap
+        self.last = None
+        self.periods = [None, None, None]
+        self.imported = [0.0, 0.0, 0.0]
+        self.exported = [0.0, 0.0, 0.0]
+
+    def add(self, kw, now):
+        '''
+        Add a power sample taken at the local time now.  Returns import
+        and export kWh for the hour, day and month to date.
+        '''
+        periods = [(now.date(), now.hour), now.date(), (now.year, now.month)]
+        for i, period in enumerate(periods):
+            if period != self.periods[i]:
+                self.periods[i] = period
+                self.imported[i] = 0.0
+                self.exported[i] = 0.0
+
+        if self.last is not None:
+            elapsed = (now - self.last).total_seconds()
+            if 0 < elapsed <= self.max_gap:
+                kwh = kw * elapsed / 3600
+                totals = self.imported if kwh >= 0 else self.exported
+                for i in range(3):
+                    totals[i] += abs(kwh)
+        self.last = now
+
+        return (self.imported[0], self.exported[0], self.imported[1],
+                self.exported[1], self.imported[2], self.exported[2])
+
+
+class DemandMeter(object):
+    '''
+    Tracks utility style demand for one channel.  Demand is the average
+    power over fixed, clock aligned intervals (15 minutes by default).
+    The peak is the highest completed interval in the current billing
+    cycle, which starts on cycle_start_day of each month.
+    '''
+    def __init__(self, interval=900, cycle_start_day=1):
+        self.interval = interval
+        self.cycle_start_day = cycle_start_day if cycle_start_day else 1
+        self.block = None
+        self.block_sum = 0.0
+        self.block_count = 0
+        self.cycle = None
+        self.peak = 0.0
+
+    def add(self, kw, now):
+        '''Add a power sample taken at the local time now, returns (demand, peak).'''
+        cycle = billing_cycle(now, self.cycle_start_day)
+        midnight = now.replace(hour=0, minute=0, second=0, microsecond=0)
+        seconds = (now - midnight).total_seconds()
+        block = (now.date(), int(seconds // self.interval))
+
+        if block != self.block:
+            # the finished interval belongs to the cycle it started in
+            if self.block_count:
+                self.peak = max(self.peak, self.block_sum / self.block_count)
+            self.block = block
+            self.block_sum = 0.0
+            self.block_count = 0
+
+        if cycle != self.cycle:
+            self.cycle = cycle
+            self.peak = 0.0
+
+        self.block_sum += kw
+        self.block_count += 1
+        return (self.block_sum / self.block_count, self.peak)
@@ -0,0 +1,100 @@
+'''
+Suspends cloud polling during Emporia maintenance windows.
+
+While the Emporia Cloud is down for maintenance every poll fails and
+logging in again after each failure only adds load.  Once a poll fails
+the Maintenance class checks Emporia's maintenance notice (a small
+static file, the answer is cached by PyEmVue) and while one is posted
+tells the poll loop to skip all cloud requests and logins.  The notice
+is checked again every RECHECK seconds, that's the only request made
+during the outage.
+
+When the notice is gone polling resumes in steps so every node server
+doesn't hit the cloud at the same moment: after a random delay of up to
+WARMUP_JITTER seconds only the short poll runs, the long poll joins once
+a short poll has succeeded.
+
+Node queries and outlet/charger commands check suspended() so they wait
+for the same window, and connect() only checks the notice, not logging
+in, while it's posted.
+'''
+
+import udi_interface
+import random
+import time
+
+LOGGER = udi_interface.LOGGER
+
+RECHECK = 60
+WARMUP_JITTER = 30
+
+POLLING = 'polling'
+SUSPENDED = 'suspended'
+WARMUP = 'warmup'
+
+
+class Maintenance(object):
+    def __init__(self, vue, recheck=RECHECK, jitter=WARMUP_JITTER):
+        self.vue = vue
+        self.recheck = recheck
+        self.jitter = jitter
+        self.state = POLLING
+        self.message = None
+        self.next_check = 0
+        self.resume_at = 0
+        self.skipped = 0
+
+    # True if this poll (shortPoll or longPoll) may use the cloud
+    def allow(self, poll_flag):
+        if self.state == POLLING:
+            return True
+
+        now = time.monotonic()
+        if self.state == SUSPENDED:
+            self.skipped += 1
+            if now < self.next_check:
+                return False
+            self.next_check = now + self.recheck
+            # can't tell, stay suspended until the notice can be read
+            if self.check(True):
+                return False
+            self.state = WARMUP
+            self.resume_at = now + random.uniform(0, self.jitter)
+            LOGGER.info('Emporia maintenance is over, resuming polls in {:.0f} seconds'.format(self.resume_at - now))
+            return False
+
+        if now < self.resume_at or poll_flag != 'shortPoll':
+            self.skipped += 1
+            return False
+        return True
+
+    # True while other cloud requests (node queries, commands) should wait
+    def suspended(self):
+        if self.state == SUSPENDED:
+            return True
+        return self.state == WARMUP and time.monotonic() < self.resume_at
+
+    def success(self, poll_flag):
+        if self.state == WARMUP and poll_flag == 'shortPoll':
+            self.state = POLLING
+            LOGGER.info('Polling resumed, {} polls were skipped for maintenance'.format(self.skipped))
+            self.skipped = 0
+
+    # a poll failed, returns True if logging in again might help
+    def failure(self):
+        if not self.check(False):
+            return True
+        if self.state != SUSPENDED:
+            LOGGER.warning('Emporia Cloud is down for maintenance, polling suspended: {}'.format(self.message))
+            self.state = SUSPENDED
+            self.next_check = time.monotonic() + self.recheck
+        return False
+
+    # True if maintenance is announced, default if the notice can't be read
+    def check(self, default):
+        try:
+            self.message = self.vue.down_for_maintenance(max_age=self.recheck)
+        except Exception as e:
+            LOGGER.debug('Maintenance check failed: {}'.format(e))
+            return default
+        return self.message is not None
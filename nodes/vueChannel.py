@@ -25,6 +25,25 @@ class VueChannel(udi_interface.Node):
         kwh = round(raw * 3600, 4)
         self.setDriver('CPW', kwh, True, True)
 
+    def update_peak(self, raw):
+        self.setDriver('GV22', round(raw * 3600, 4), True, False)
+
+    def update_window(self, avg, peak, low):
+        self.setDriver('GV6', round(avg, 4), True, False)
+        self.setDriver('GV7', round(peak, 4), True, False)
+        self.setDriver('GV8', round(low, 4), True, False)
+
+    def update_demand(self, avg1, avg5, demand, peak):
+        self.setDriver('GV9', round(avg1, 4), True, False)
+        self.setDriver('GV10', round(avg5, 4), True, False)
+        self.setDriver('GV11', round(demand, 4), True, False)
+        self.setDriver('GV12', round(peak, 4), True, False)
+
+    def update_cost(self, rate, day, cycle):
+        self.setDriver('GV13', round(rate, 4), True, False)
+        self.setDriver('GV14', round(day, 2), True, False)
+        self.setDriver('GV15', round(cycle, 2), True, False)
+
     def update_hour(self, raw):
         kwh = round(raw, 4)
         self.setDriver('GV1', kwh, True, True)
@@ -55,6 +74,17 @@ class VueChannel(udi_interface.Node):
             {'driver': 'GV1', 'value': 0, 'uom': 33, 'name': 'Hourly KWh'},  # power
             {'driver': 'GV2', 'value': 0, 'uom': 33, 'name': 'Daily KWh'},  # power
             {'driver': 'GV3', 'value': 0, 'uom': 33, 'name': 'Monthly KWh'},  # power
+            {'driver': 'GV6', 'value': 0, 'uom': 30, 'name': 'Average KW'},   # window average
+            {'driver': 'GV7', 'value': 0, 'uom': 30, 'name': 'Peak KW'},      # window peak
+            {'driver': 'GV8', 'value': 0, 'uom': 30, 'name': 'Minimum KW'},   # window minimum
+            {'driver': 'GV9', 'value': 0, 'uom': 30, 'name': '1 Minute KW'},  # 1 minute average
+            {'driver': 'GV10', 'value': 0, 'uom': 30, 'name': '5 Minute KW'}, # 5 minute average
+            {'driver': 'GV11', 'value': 0, 'uom': 30, 'name': 'Demand KW'},   # 15 minute demand
+            {'driver': 'GV12', 'value': 0, 'uom': 30, 'name': 'Peak Demand KW'}, # billing cycle peak
+            {'driver': 'GV13', 'value': 0, 'uom': 103, 'name': 'Cost per Hour'},  # cost rate
+            {'driver': 'GV14', 'value': 0, 'uom': 103, 'name': 'Daily Cost'},     # day to date cost
+            {'driver': 'GV15', 'value': 0, 'uom': 103, 'name': 'Cycle Cost'},     # cycle to date cost
+            {'driver': 'GV22', 'value': 0, 'uom': 30, 'name': 'Interval Peak KW'}, # short poll interval peak
             ]
 
     
@@ -7,6 +7,7 @@ Copyright (C) 2021 Robert Paauwe
 import udi_interface
 import sys
 import time
+import copy
 from datetime import datetime
 from pyemvue.pyemvue import Scale
 
@@ -30,6 +31,34 @@ class VueDevice(udi_interface.Node):
         kwh = round(raw * 60, 4)
         self.setDriver('CPW', kwh, True, True)
 
+    def update_peak(self, raw):
+        self.setDriver('GV22', round(raw * 3600, 4), True, False)
+
+    def update_window(self, avg, peak, low):
+        self.setDriver('GV6', round(avg, 4), True, False)
+        self.setDriver('GV7', round(peak, 4), True, False)
+        self.setDriver('GV8', round(low, 4), True, False)
+
+    def update_demand(self, avg1, avg5, demand, peak):
+        self.setDriver('GV9', round(avg1, 4), True, False)
+        self.setDriver('GV10', round(avg5, 4), True, False)
+        self.setDriver('GV11', round(demand, 4), True, False)
+        self.setDriver('GV12', round(peak, 4), True, False)
+
+    def update_cost(self, rate, day, cycle):
+        self.setDriver('GV13', round(rate, 4), True, False)
+        self.setDriver('GV14', round(day, 2), True, False)
+        self.setDriver('GV15', round(cycle, 2), True, False)
+
+    # grid import/export energy from the sign of the Main channel
+    def update_net(self, hour_in, hour_out, day_in, day_out, month_in, month_out):
+        self.setDriver('GV16', round(hour_in, 4), True, False)
+        self.setDriver('GV17', round(hour_out, 4), True, False)
+        self.setDriver('GV18', round(day_in, 4), True, False)
+        self.setDriver('GV19', round(day_out, 4), True, False)
+        self.setDriver('GV20', round(month_in, 4), True, False)
+        self.setDriver('GV21', round(month_out, 4), True, False)
+
     def update_hour(self, raw):
         kwh = round(raw, 4)
         self.setDriver('GV1', kwh, True, True)
@@ -71,18 +100,34 @@ class VueDevice(udi_interface.Node):
             {'driver': 'GV1', 'value': 0, 'uom': 33},  # power
             {'driver': 'GV2', 'value': 0, 'uom': 33},  # power
             {'driver': 'GV3', 'value': 0, 'uom': 33},  # power
+            {'driver': 'GV6', 'value': 0, 'uom': 30},  # window average
+            {'driver': 'GV7', 'value': 0, 'uom': 30},  # window peak
+            {'driver': 'GV8', 'value': 0, 'uom': 30},  # window minimum
+            {'driver': 'GV9', 'value': 0, 'uom': 30},  # 1 minute average
+            {'driver': 'GV10', 'value': 0, 'uom': 30}, # 5 minute average
+            {'driver': 'GV11', 'value': 0, 'uom': 30}, # 15 minute demand
+            {'driver': 'GV12', 'value': 0, 'uom': 30}, # billing cycle peak demand
+            {'driver': 'GV13', 'value': 0, 'uom': 103}, # cost rate $/hour
+            {'driver': 'GV14', 'value': 0, 'uom': 103}, # day to date cost
+            {'driver': 'GV15', 'value': 0, 'uom': 103}, # cycle to date cost
+            {'driver': 'GV16', 'value': 0, 'uom': 33}, # hour grid import
+            {'driver': 'GV17', 'value': 0, 'uom': 33}, # hour grid export
+            {'driver': 'GV18', 'value': 0, 'uom': 33}, # day grid import
+            {'driver': 'GV19', 'value': 0, 'uom': 33}, # day grid export
+            {'driver': 'GV20', 'value': 0, 'uom': 33}, # month grid import
+            {'driver': 'GV21', 'value': 0, 'uom': 33}, # month grid export
+            {'driver': 'GV22', 'value': 0, 'uom': 30}, # short poll interval peak
             ]
 
     
 class VueCharger(udi_interface.Node):
     id = 'charger'
-    def __init__(self, polyglot, primary, address, name, vue, charger, querys):
+    def __init__(self, polyglot, primary, address, name, charger, querys):
         super(VueCharger, self).__init__(polyglot, primary, address, name)
         self.poly = polyglot
         self.name = name
         self.address = address
         self.primary = primary
-        self.vueAPI = vue  # so we can set the charger on/off
         self.charger = charger
         self.querys = querys
 
@@ -94,6 +139,25 @@ class VueCharger(udi_interface.Node):
         kwh = round(raw * 60, 4)
         self.setDriver('CPW', kwh, True, False)
 
+    def update_peak(self, raw):
+        self.setDriver('GV22', round(raw * 3600, 4), True, False)
+
+    def update_window(self, avg, peak, low):
+        self.setDriver('GV6', round(avg, 4), True, False)
+        self.setDriver('GV7', round(peak, 4), True, False)
+        self.setDriver('GV8', round(low, 4), True, False)
+
+    def update_demand(self, avg1, avg5, demand, peak):
+        self.setDriver('GV9', round(avg1, 4), True, False)
+        self.setDriver('GV10', round(avg5, 4), True, False)
+        self.setDriver('GV11', round(demand, 4), True, False)
+        self.setDriver('GV12', round(peak, 4), True, False)
+
+    def update_cost(self, rate, day, cycle):
+        self.setDriver('GV13', round(rate, 4), True, False)
+        self.setDriver('GV14', round(day, 2), True, False)
+        self.setDriver('GV15', round(cycle, 2), True, False)
+
     def update_hour(self, raw):
         kwh = round(raw, 4)
         self.setDriver('GV1', kwh, True, False)
@@ -133,22 +197,32 @@ class VueCharger(udi_interface.Node):
         self.querys.query_device(self.address, Scale.DAY.value)
         self.querys.query_device(self.address, Scale.HOUR.value)
         self.querys.query_device(self.address, Scale.SECOND.value)
-        self.querys.query_device_status()
+        self.querys.query_device_status(force=True)
+
+    # called from the command dispatcher thread. Work on a copy so
+    # a failed PUT leaves self.charger at the last known state.
+    def send_update(self, changes):
+        charger = copy.copy(self.charger)
+        self.charger = self.querys.vue.update_charger(charger, on=changes.get('on'), charge_rate=changes.get('charge_rate'))
+
+    def refresh_state(self):
+        self.update_state(self.charger.charger_on)
+        self.update_rate(self.charger.charging_rate)
+        self.update_max_rate(self.charger.max_charging_rate)
 
     def set_on(self, cmd):
-        self.vueAPI.update_charger(self.charger, on=True)
         self.setDriver('ST', 1, True, False)
+        self.querys.commands.submit(self, on=True)
 
     def set_off(self, cmd):
-        self.vueAPI.update_charger(self.charger, on=False)
         self.setDriver('ST', 0, True, False)
+        self.querys.commands.submit(self, on=False)
 
     def set_rate(self, cmd):
-        LOGGER.info('TESTING: set rate to :: {}'.format(cmd))
         LOGGER.info(' -- rate = {}'.format(cmd['query']['SET_RATE.uom1']))
         rate = int(cmd['query']['SET_RATE.uom1'])
-        self.vueAPI.update_charger(self.charger, charge_rate=rate)
         self.setDriver('GV4', rate, True, False)
+        self.querys.commands.submit(self, charge_rate=rate)
 
     commands = {
             'QUERY': query,
@@ -165,18 +239,28 @@ class VueCharger(udi_interface.Node):
             {'driver': 'GV3', 'value': 0, 'uom': 33},  # power
             {'driver': 'GV4', 'value': 0, 'uom': 1},   # amps
             {'driver': 'GV5', 'value': 0, 'uom': 1},   # amps
+            {'driver': 'GV6', 'value': 0, 'uom': 30},  # window average
+            {'driver': 'GV7', 'value': 0, 'uom': 30},  # window peak
+            {'driver': 'GV8', 'value': 0, 'uom': 30},  # window minimum
+            {'driver': 'GV9', 'value': 0, 'uom': 30},  # 1 minute average
+            {'driver': 'GV10', 'value': 0, 'uom': 30}, # 5 minute average
+            {'driver': 'GV11', 'value': 0, 'uom': 30}, # 15 minute demand
+            {'driver': 'GV12', 'value': 0, 'uom': 30}, # billing cycle peak demand
+            {'driver': 'GV13', 'value': 0, 'uom': 103}, # cost rate $/hour
+            {'driver': 'GV14', 'value': 0, 'uom': 103}, # day to date cost
+            {'driver': 'GV15', 'value': 0, 'uom': 103}, # cycle to date cost
+            {'driver': 'GV22', 'value': 0, 'uom': 30}, # short poll interval peak
             ]
 
 class VueOutlet(udi_interface.Node):
     id = 'outlet'
     hint = 0x01030501
-    def __init__(self, polyglot, primary, address, name, vue, outlet, querys):
+    def __init__(self, polyglot, primary, address, name, outlet, querys):
         super(VueOutlet, self).__init__(polyglot, primary, address, name)
         self.poly = polyglot
         self.name = name
         self.address = address
         self.primary = primary
-        self.vueAPI = vue  # so we can set the charger on/off
         self.outlet = outlet
         self.querys = querys
 
@@ -188,6 +272,25 @@ class VueOutlet(udi_interface.Node):
         kwh = round(raw * 60, 4)
         self.setDriver('CPW', kwh, True, False)
 
+    def update_peak(self, raw):
+        self.setDriver('GV22', round(raw * 3600, 4), True, False)
+
+    def update_window(self, avg, peak, low):
+        self.setDriver('GV6', round(avg, 4), True, False)
+        self.setDriver('GV7', round(peak, 4), True, False)
+        self.setDriver('GV8', round(low, 4), True, False)
+
+    def update_demand(self, avg1, avg5, demand, peak):
+        self.setDriver('GV9', round(avg1, 4), True, False)
+        self.setDriver('GV10', round(avg5, 4), True, False)
+        self.setDriver('GV11', round(demand, 4), True, False)
+        self.setDriver('GV12', round(peak, 4), True, False)
+
+    def update_cost(self, rate, day, cycle):
+        self.setDriver('GV13', round(rate, 4), True, False)
+        self.setDriver('GV14', round(day, 2), True, False)
+        self.setDriver('GV15', round(cycle, 2), True, False)
+
     def update_hour(self, raw):
         kwh = round(raw, 4)
         self.setDriver('GV1', kwh, True, False)
@@ -218,15 +321,24 @@ class VueOutlet(udi_interface.Node):
         self.querys.query_device(self.address, Scale.DAY.value)
         self.querys.query_device(self.address, Scale.HOUR.value)
         self.querys.query_device(self.address, Scale.SECOND.value)
-        self.querys.query_device_status()
+        self.querys.query_device_status(force=True)
+
+    # called from the command dispatcher thread. Work on a copy so
+    # a failed PUT leaves self.outlet at the last known state.
+    def send_update(self, changes):
+        outlet = copy.copy(self.outlet)
+        self.outlet = self.querys.vue.update_outlet(outlet, on=changes.get('on'))
+
+    def refresh_state(self):
+        self.update_state(self.outlet.outlet_on)
 
     def set_on(self, cmd):
-        self.vueAPI.update_outlet(self.outlet, on=True)
         self.setDriver('ST', 1, True, False)
+        self.querys.commands.submit(self, on=True)
 
     def set_off(self, cmd):
-        self.vueAPI.update_outlet(self.outlet, on=False)
         self.setDriver('ST', 0, True, False)
+        self.querys.commands.submit(self, on=False)
 
     commands = {
             'QUERY': query,
@@ -240,4 +352,15 @@ class VueOutlet(udi_interface.Node):
             {'driver': 'GV1', 'value': 0, 'uom': 33, 'name': 'Hourly KWh'},  # power
             {'driver': 'GV2', 'value': 0, 'uom': 33, 'name': 'Daily KWh'},   # power
             {'driver': 'GV3', 'value': 0, 'uom': 33, 'name': 'Monthly KWh'}, # power
+            {'driver': 'GV6', 'value': 0, 'uom': 30, 'name': 'Average KW'},  # window average
+            {'driver': 'GV7', 'value': 0, 'uom': 30, 'name': 'Peak KW'},     # window peak
+            {'driver': 'GV8', 'value': 0, 'uom': 30, 'name': 'Minimum KW'},  # window minimum
+            {'driver': 'GV9', 'value': 0, 'uom': 30, 'name': '1 Minute KW'}, # 1 minute average
+            {'driver': 'GV10', 'value': 0, 'uom': 30, 'name': '5 Minute KW'}, # 5 minute average
+            {'driver': 'GV11', 'value': 0, 'uom': 30, 'name': 'Demand KW'},  # 15 minute demand
+            {'driver': 'GV12', 'value': 0, 'uom': 30, 'name': 'Peak Demand KW'}, # billing cycle peak
+            {'driver': 'GV13', 'value': 0, 'uom': 103, 'name': 'Cost per Hour'},  # cost rate
+            {'driver': 'GV14', 'value': 0, 'uom': 103, 'name': 'Daily Cost'},     # day to date cost
+            {'driver': 'GV15', 'value': 0, 'uom': 103, 'name': 'Cycle Cost'},     # cycle to date cost
+            {'driver': 'GV22', 'value': 0, 'uom': 30, 'name': 'Interval Peak KW'}, # short poll interval peak
             ]
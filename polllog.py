@@ -0,0 +1,88 @@
+'''
+Logging for the poll path.  At a 1 second short poll the per-channel
+messages would swamp the Polyglot log viewer and formatting them costs
+more than the driver updates themselves, so:
+
+  - messages use the logger's lazy %-style formatting, debug messages
+    are only formatted when debug logging is enabled
+  - repeated messages with the same key are rate limited and report
+    how many were suppressed
+  - each poll cycle is summarized in one line (debug), with a periodic
+    roll up of all cycles at info level
+'''
+
+import logging
+import time
+
+
+class PollLogger(object):
+    def __init__(self, logger, interval=60):
+        self.logger = logger
+        self.interval = interval
+        self.last = {}
+        self.suppressed = {}
+        self.counts = {}
+        self.cycle_start = None
+        self.totals = {}
+
+    def debug(self, msg, *args):
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug(msg, *args)
+
+    # log at most once per interval for each key
+    def limited(self, level, key, msg, *args):
+        if not self.logger.isEnabledFor(level):
+            return
+        now = time.monotonic()
+        last = self.last.get(key)
+        if last is not None and now - last < self.interval:
+            self.suppressed[key] = self.suppressed.get(key, 0) + 1
+            return
+        self.last[key] = now
+        skipped = self.suppressed.pop(key, 0)
+        if skipped:
+            msg = msg + ' (%d similar messages suppressed)'
+            args = args + (skipped,)
+        self.logger.log(level, msg, *args)
+
+    def error(self, key, msg, *args):
+        self.count('errors')
+        self.limited(logging.ERROR, key, msg, *args)
+
+    def count(self, name, n=1):
+        self.counts[name] = self.counts.get(name, 0) + n
+
+    def start_cycle(self):
+        self.cycle_start = time.monotonic()
+        self.counts = {}
+
+    def end_cycle(self, scale):
+        elapsed = time.monotonic() - self.cycle_start if self.cycle_start else 0.0
+        self.debug('Poll %s: %d devices, %d channels, %d errors in %.3fs', scale,
+                self.counts.get('devices', 0), self.counts.get('channels', 0),
+                self.counts.get('errors', 0), elapsed)
+
+        total = self.totals.setdefault(scale, {'cycles': 0, 'channels': 0, 'errors': 0, 'stale': 0, 'duplicate': 0, 'time': 0.0})
+        total['cycles'] += 1
+        total['channels'] += self.counts.get('channels', 0)
+        total['errors'] += self.counts.get('errors', 0)
+        total['stale'] += self.counts.get('stale', 0)
+        total['duplicate'] += self.counts.get('duplicate', 0)
+        total['time'] += elapsed
+        if self.logger.isEnabledFor(logging.INFO) and self._due('summary:' + scale):
+            self.logger.info('Poll %s: %d cycles, %d channel updates, %d errors, %d stale, %d repeated, %.1f ms average',
+                    scale, total['cycles'], total['channels'], total['errors'], total['stale'],
+                    total['duplicate'], 1000 * total['time'] / total['cycles'])
+            del self.totals[scale]
+
+    def _due(self, key):
+        now = time.monotonic()
+        last = self.last.get(key)
+        if last is None:
+            # start the interval, report once it's full
+            self.last[key] = now
+            return False
+        if now - last < self.interval:
+            return False
+        self.last[key] = now
+        return True
@@ -1,2 +1,2 @@
 
-from pyemvue.pyemvue import PyEmVue
\ No newline at end of file
+from pyemvue.pyemvue import PyEmVue, DeadlineExceeded
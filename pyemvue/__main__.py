@@ -1,85 +1,302 @@
-import sys
+import argparse
 import datetime
-import dateutil
+import json
+import sys
+import threading
+import time
+from urllib.parse import urlparse, parse_qs
+
+import dateutil.parser
 
 # Our files
-from pyemvue.device import VueDevice, VueUsageDevice
+from pyemvue.device import VueDeviceChannel
 from pyemvue.enums import Scale, Unit
-from pyemvue.pyemvue import PyEmVue
+from pyemvue.pyemvue import PyEmVue, DeadlineExceeded
+from pyemvue.cache import SCALE_SECONDS
+import pyemvue.replay
 
 def print_recursive(usage_dict, info, scaleBy=1, unit='kWh', depth=0):
     for gid, device in usage_dict.items():
         for channelnum, channel in device.channels.items():
             name = channel.name
-            if name == 'Main':
+            if name == 'Main' and gid in info:
                 name = info[gid].device_name
             usage = channel.usage or 0
             print('-'*depth, f'{gid} {channelnum} {name} {usage*scaleBy} {unit}')
             if channel.nested_devices:
                 print_recursive(channel.nested_devices, info, scaleBy=scaleBy, unit=unit, depth=depth+1)
 
-def main():
-    errorMsg = 'Please pass a file containing the "email" and "password" as json.'
-    if len(sys.argv) == 1:
-        print(errorMsg)
-        sys.exit(1)
+def usage_as_json(usage_dict):
+    result = {}
+    for gid, device in usage_dict.items():
+        channels = {}
+        for channelnum, channel in device.channels.items():
+            channels[channelnum] = {
+                'name': channel.name,
+                'usage': channel.usage,
+                'percentage': channel.percentage,
+                'nested': usage_as_json(channel.nested_devices),
+            }
+        result[gid] = {'timestamp': device.timestamp.isoformat() if device.timestamp else None, 'channels': channels}
+    return result
 
-    filepath = sys.argv[1]
-    vue = PyEmVue()
-    vue.login(token_storage_file=filepath)
-    print('Logged in. Authtoken follows:')
-    print(vue.auth.tokens["id_token"])
-    print()
-    devices = vue.get_devices()
-    deviceGids: list[int] = []
-    deviceInfo: dict[int, VueDevice] = {}
+def merge_devices(devices):
+    """Returns the gids and a gid -> VueDevice dictionary, merging the channels of repeated gids."""
+    gids = []
+    info = {}
     for device in devices:
-        if not device.device_gid in deviceGids:
-            deviceGids.append(device.device_gid)
-            deviceInfo[device.device_gid] = device
-            print(device.device_gid, device.manufacturer_id, device.model, device.firmware)
-            for chan in device.channels:
-                print('\t', chan.device_gid, chan.name, chan.channel_num, chan.channel_multiplier)
+        if not device.device_gid in info:
+            gids.append(device.device_gid)
+            info[device.device_gid] = device
         else:
-            deviceInfo[device.device_gid].channels += device.channels
-
-    monthly, start = vue.get_chart_usage(devices[0].channels[0],scale=Scale.MONTH.value)
-    print(monthly[0], 'kwh used since', start.isoformat())
-    now = datetime.datetime.now(datetime.timezone.utc)
-    midnight=(datetime.datetime
-             .now(dateutil.tz.gettz(devices[0].time_zone))
-             .replace(hour=0, minute=0, second=0, microsecond=0)
-             .astimezone(dateutil.tz.tzutc()))
-    yesterday = midnight - datetime.timedelta(days=1)
-    yesterday = yesterday.replace(tzinfo=None)
-    print('Total usage for today in kwh: ')
-
-    use = vue.get_device_list_usage(deviceGids, now, Scale.DAY.value)
-    print_recursive(use, deviceInfo)
-    print('Total usage for yesterday in kwh: ')
-    for gid, device in deviceInfo.items():
-        for chan in device.channels:
-            usage = vue.get_chart_usage(chan, yesterday, yesterday+datetime.timedelta(hours=23, minutes=59), Scale.DAY.value)
-            if usage and usage[0]:
-                print(f'{chan.device_gid} ({chan.channel_num}): {usage[0][0]} kwh')
-    print('Average usage over the last minute in watts: ')
-    use = vue.get_device_list_usage(deviceGids, None, Scale.MINUTE.value)
-    print_recursive(use, deviceInfo, scaleBy=60000, unit='W')
-
-    usage_over_time, start_time = vue.get_chart_usage(devices[0].channels[0], datetime.datetime.now(datetime.timezone.utc)-datetime.timedelta(days=7), datetime.datetime.now(datetime.timezone.utc), scale=Scale.DAY.value, unit=Unit.KWH.value)
-
-    print('Usage for the last seven days starting', start_time.isoformat())
-    for usage in usage_over_time:
-        print(usage, 'kwh')
-
-    (outlets, chargers) = vue.get_devices_status(devices)
+            known = set(c.channel_num for c in info[device.device_gid].channels)
+            info[device.device_gid].channels += [c for c in device.channels if c.channel_num not in known]
+    return gids, info
+
+def parse_time(text):
+    if not text:
+        return None
+    return dateutil.parser.parse(text)
+
+class TimingSession(object):
+    """Wraps the PyEmVue session and records the latency of every request by endpoint."""
+    def __init__(self, session):
+        self.session = session
+        self.headers = session.headers
+        self.lock = threading.Lock()
+        self.latency = {}
+        self.errors = {}
+
+    def get(self, url, **kwargs):
+        return self._timed(self.session.get, url, kwargs)
+
+    def put(self, url, **kwargs):
+        return self._timed(self.session.put, url, kwargs)
+
+    def _timed(self, send, url, kwargs):
+        endpoint = endpoint_name(url)
+        start = time.perf_counter()
+        try:
+            response = send(url, **kwargs)
+        except Exception:
+            with self.lock:
+                self.errors[endpoint] = self.errors.get(endpoint, 0) + 1
+            raise
+        elapsed = time.perf_counter() - start
+        with self.lock:
+            self.latency.setdefault(endpoint, []).append(elapsed)
+            if response.status_code >= 400:
+                self.errors[endpoint] = self.errors.get(endpoint, 0) + 1
+        return response
+
+def endpoint_name(url):
+    parsed = urlparse(url)
+    method = parse_qs(parsed.query).get('apiMethod')
+    if method:
+        return method[0]
+    if parsed.path.endswith('/locationProperties'):
+        return 'locationProperties'
+    return parsed.path
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))
+    return ordered[index]
+
+def cmd_devices(vue, args):
+    gids, info = merge_devices(vue.get_devices())
+    for gid in gids:
+        vue.populate_device_properties(info[gid])
+    if args.json:
+        out = []
+        for gid in gids:
+            dev = info[gid]
+            out.append({'gid': gid, 'name': dev.device_name, 'manufacturer_id': dev.manufacturer_id, 'model': dev.model,
+                'firmware': dev.firmware, 'parent_gid': dev.parent_device_gid, 'time_zone': dev.time_zone,
+                'channels': [{'channel': c.channel_num, 'name': c.name, 'multiplier': c.channel_multiplier} for c in dev.channels]})
+        json.dump(out, sys.stdout, indent=2)
+        print()
+        return
+    for gid in gids:
+        dev = info[gid]
+        print(gid, dev.manufacturer_id, dev.model, dev.firmware, dev.device_name)
+        for chan in dev.channels:
+            print('\t', chan.device_gid, chan.name, chan.channel_num, chan.channel_multiplier)
+
+def cmd_usage(vue, args):
+    gids, info = merge_devices(vue.get_devices())
+    if args.gids:
+        gids = [int(g) for g in args.gids.split(',')]
+    use = vue.get_device_list_usage(gids, parse_time(args.instant), scale=args.scale, unit=args.unit)
+    if args.json:
+        json.dump(usage_as_json(use), sys.stdout, indent=2)
+        print()
+    else:
+        print_recursive(use, info, unit=args.unit)
+
+def cmd_history(vue, args):
+    gid, channel_num = args.channel.split(':', 1)
+    channel = VueDeviceChannel(gid=int(gid), channelNum=channel_num)
+    end = parse_time(args.end) or datetime.datetime.now(datetime.timezone.utc)
+    start = parse_time(args.start) or end - datetime.timedelta(days=1)
+    usage, first = vue.get_chart_usage(channel, start, end, scale=args.scale, unit=args.unit)
+    if args.json:
+        json.dump({'channel': args.channel, 'scale': args.scale, 'unit': args.unit,
+            'start': first.isoformat() if first else None, 'usage': usage}, sys.stdout, indent=2)
+        print()
+        return
+    # csv, one row per bucket in the requested scale
+    step = datetime.timedelta(seconds=SCALE_SECONDS.get(args.scale, 1))
+    print('time,usage')
+    for i, value in enumerate(usage):
+        print('{},{}'.format((first + step * i).isoformat(), '' if value is None else value))
+
+def cmd_status(vue, args):
+    gids, info = merge_devices(vue.get_devices())
+    (outlets, chargers) = vue.get_devices_status(list(info.values()))
+    if args.json:
+        json.dump({'outlets': [o.as_dictionary() for o in outlets],
+            'chargers': [c.as_dictionary() for c in chargers]}, sys.stdout, indent=2)
+        print()
+        return
     print('List of Outlets:')
     for outlet in outlets:
         print(f"\t{outlet.device_gid} On? {outlet.outlet_on}")
-
     print('List of Chargers:')
     for charger in chargers:
         print(f"\t{charger.device_gid} On? {charger.charger_on} Charge rate: {charger.charging_rate}/{charger.max_charging_rate} Status: {charger.status}")
 
+def cmd_bench(vue, args):
+    timing = TimingSession(vue.session)
+    vue.session = timing
+    gids, info = merge_devices(vue.get_devices())
+    scales = args.scales.split(',')
+    vue.hedge_percentile = args.hedge or None
+    channels = [channel for gid in gids for channel in info[gid].channels]
+
+    failures = 0
+    stale = 0
+    last = None
+    start = time.perf_counter()
+    for cycle in range(args.cycles):
+        cycle_start = time.perf_counter()
+        try:
+            for scale in scales:
+                timeout = args.timeout if scale == Scale.SECOND.value else None
+                vue.get_device_list_usage(gids, None, scale=scale, unit=Unit.KWH.value, timeout=timeout)
+            if args.interval_average:
+                # 1S chart usage of every channel since the last cycle
+                now = datetime.datetime.now(datetime.timezone.utc)
+                if last:
+                    vue.get_chart_usage_list(channels, last, now, limit=args.interval_average, timeout=args.timeout)
+                last = now
+            if args.status:
+                vue.get_devices_status(list(info.values()))
+        except DeadlineExceeded:
+            stale += 1
+        except Exception as e:
+            failures += 1
+            print('cycle {} failed: {}'.format(cycle, e), file=sys.stderr)
+        if args.interval:
+            time.sleep(max(0, args.interval - (time.perf_counter() - cycle_start)))
+    elapsed = time.perf_counter() - start
+
+    total = sum(len(v) for v in timing.latency.values())
+    report = {
+        'cycles': args.cycles,
+        'failed_cycles': failures,
+        'stale_cycles': stale,
+        'hedging': vue.hedge_stats,
+        'chart': vue.chart_stats,
+        'elapsed_s': round(elapsed, 3),
+        'requests': total,
+        'throughput_rps': round(total / elapsed, 2) if elapsed else 0,
+        'endpoints': {},
+    }
+    for endpoint, values in sorted(timing.latency.items()):
+        report['endpoints'][endpoint] = {
+            'count': len(values),
+            'errors': timing.errors.get(endpoint, 0),
+            'p50_ms': round(1000 * percentile(values, 50), 2),
+            'p90_ms': round(1000 * percentile(values, 90), 2),
+            'p99_ms': round(1000 * percentile(values, 99), 2),
+            'max_ms': round(1000 * max(values), 2),
+        }
+
+    if args.json:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+        return
+    print('{} cycles in {}s, {} requests, {} requests/s, {} failed cycles, {} past the deadline'.format(
+        report['cycles'], report['elapsed_s'], report['requests'], report['throughput_rps'], failures, stale))
+    if args.timeout:
+        print('hedged {hedged} of {requests} requests, the hedge answered first {hedge_won} times'.format(**vue.hedge_stats))
+    if args.interval_average:
+        print('{requests} chart requests, {failed} failed, {late} past the deadline'.format(**vue.chart_stats))
+    print('{:<24} {:>7} {:>7} {:>9} {:>9} {:>9} {:>9}'.format('endpoint', 'count', 'errors', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms'))
+    for endpoint, r in report['endpoints'].items():
+        print('{:<24} {:>7} {:>7} {:>9} {:>9} {:>9} {:>9}'.format(
+            endpoint, r['count'], r['errors'], r['p50_ms'], r['p90_ms'], r['p99_ms'], r['max_ms']))
+
+def main():
+    scales = [s.value for s in Scale]
+    units = [u.value for u in Unit]
+
+    parser = argparse.ArgumentParser(prog='python -m pyemvue', description='Inspect and benchmark the Emporia Cloud API')
+    parser.add_argument('--login', metavar='FILE', help='json file with "email" and "password" (or stored tokens)')
+    parser.add_argument('--replay', metavar='FILE', help='serve requests from a recording instead of the Emporia Cloud')
+    parser.add_argument('--speed', type=float, default=0, help='replay speed, 1.0 is real time, 0 (default) is no delay')
+    parser.add_argument('--record', metavar='FILE', help='record the Emporia Cloud traffic to a file')
+    parser.add_argument('--json', action='store_true', help='output JSON')
+    parser.add_argument('--show-token', action='store_true', help='print the id token after logging in')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    sub.add_parser('devices', help='list devices and channels')
+    sub.add_parser('status', help='list outlet and charger status')
+
+    p = sub.add_parser('usage', help='usage of all devices at a scale')
+    p.add_argument('--scale', default=Scale.DAY.value, choices=scales)
+    p.add_argument('--unit', default=Unit.KWH.value, choices=units)
+    p.add_argument('--instant', help='time to get usage for (default now)')
+    p.add_argument('--gids', help='comma separated device gids (default all)')
+
+    p = sub.add_parser('history', help='export chart usage of one channel (csv or --json)')
+    p.add_argument('channel', help='GID:CHANNEL, for example 12345:1,2,3')
+    p.add_argument('--start', help='start time (default one day before end)')
+    p.add_argument('--end', help='end time (default now)')
+    p.add_argument('--scale', default=Scale.HOUR.value, choices=scales)
+    p.add_argument('--unit', default=Unit.KWH.value, choices=units)
+
+    p = sub.add_parser('bench', help='run poll cycles and report per-endpoint latency')
+    p.add_argument('--cycles', type=int, default=60)
+    p.add_argument('--interval', type=float, default=0, help='seconds between cycle starts (default back to back)')
+    p.add_argument('--scales', default=Scale.SECOND.value, help='comma separated scales queried each cycle')
+    p.add_argument('--no-status', dest='status', action='store_false', help="don't query device status each cycle")
+    p.add_argument('--timeout', type=float, help='deadline in seconds for each 1S usage request')
+    p.add_argument('--hedge', type=int, default=0, help='with --timeout, resend requests slower than this latency percentile')
+    p.add_argument('--interval-average', type=int, default=0, metavar='N',
+            help='also get the 1S chart usage of every channel since the last cycle, N requests at a time')
+
+    args = parser.parse_args()
+
+    vue = PyEmVue()
+    if args.replay:
+        pyemvue.replay.replay(vue, args.replay, speed=args.speed)
+    elif args.login:
+        vue.login(token_storage_file=args.login)
+        if args.show_token:
+            print('Logged in. Authtoken follows:', file=sys.stderr)
+            print(vue.cognito.id_token, file=sys.stderr)
+        if args.record:
+            pyemvue.replay.record(vue, args.record)
+    else:
+        parser.error('either --login or --replay is required')
+
+    commands = {'devices': cmd_devices, 'status': cmd_status, 'usage': cmd_usage, 'history': cmd_history, 'bench': cmd_bench}
+    try:
+        commands[args.command](vue, args)
+    finally:
+        pyemvue.replay.stop_recording(vue)
+
 if __name__ == '__main__':
     main()
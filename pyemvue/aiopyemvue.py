@@ -0,0 +1,158 @@
+import asyncio
+import datetime
+import functools
+import json
+import time
+
+import aiohttp
+from jose import jwt
+
+# Our files
+from pyemvue.enums import Scale, Unit
+from pyemvue.pyemvue import PyEmVue, API_ROOT, API_CUSTOMER_DEVICES, API_DEVICES_USAGE, API_CHART_USAGE, API_DEVICE_PROPERTIES, API_OUTLET, API_CHARGER, API_GET_STATUS
+from pyemvue.pyemvue import _format_time, _parse_devices, _parse_device_list_usage, _parse_chart_usage, _parse_devices_status
+
+class AsyncPyEmVue(object):
+    """asyncio counterpart of PyEmVue. Authentication is handled by a (possibly shared) PyEmVue
+       instance, all API requests go through a single pooled aiohttp session.
+
+        async with AsyncPyEmVue() as vue:
+            await vue.login(username=..., password=...)
+            usage = await vue.get_device_list_usage(gids, None, timeout=2)
+
+       The node server doesn't use it, so aiohttp isn't in requirements.txt. Install it
+       (aiohttp >= 3.8, < 4) to use this client.
+    """
+    def __init__(self, vue=None, connect_timeout=6.03, read_timeout=10.03, limit=100):
+        self.vue = vue if vue else PyEmVue(connect_timeout=connect_timeout, read_timeout=read_timeout)
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.limit = limit
+        self.session = None
+        self._token_lock = None
+        # access token -> its expiry time, so a valid token needs no lock or executor
+        self._token = None
+        self._expires = 0
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def close(self):
+        if self.session:
+            await self.session.close()
+            self.session = None
+
+    async def login(self, **kwargs):
+        """Same arguments as PyEmVue.login, the blocking Cognito authentication runs in an executor."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, functools.partial(self.vue.login, **kwargs))
+
+    async def get_devices(self, timeout=None):
+        """Get all devices under the current customer account."""
+        j = await self._get_json(API_ROOT + API_CUSTOMER_DEVICES, timeout)
+        return _parse_devices(j) if j else []
+
+    async def populate_device_properties(self, device, timeout=None):
+        """Get details about a specific device"""
+        j = await self._get_json(API_ROOT + API_DEVICE_PROPERTIES.format(deviceGid=device.device_gid), timeout)
+        if j:
+            device.populate_location_properties_from_json(j)
+        return device
+
+    async def get_device_list_usage(self, deviceGids, instant, scale=Scale.SECOND.value, unit=Unit.KWH.value, timeout=None):
+        """Returns a nested dictionary of VueUsageDevice and VueDeviceChannelUsage with the total usage of the devices over the specified scale."""
+        if not instant: instant = datetime.datetime.now(datetime.timezone.utc)
+        gids = deviceGids
+        if isinstance(deviceGids, list):
+            gids = '+'.join(map(str, deviceGids))
+
+        url = API_ROOT + API_DEVICES_USAGE.format(deviceGids=gids, instant=_format_time(instant), scale=scale, unit=unit)
+        j = await self._get_json(url, timeout)
+        return _parse_device_list_usage(j) if j else {}
+
+    async def get_chart_usage(self, channel, start=None, end=None, scale=Scale.SECOND.value, unit=Unit.KWH.value, timeout=None):
+        """Gets the usage over a given time period and the start of the measurement period."""
+        if channel.channel_num in ['MainsFromGrid', 'MainsToGrid']:
+            return [], start
+        if not start: start = datetime.datetime.now(datetime.timezone.utc)
+        if not end: end = datetime.datetime.now(datetime.timezone.utc)
+        url = API_ROOT + API_CHART_USAGE.format(deviceGid=channel.device_gid, channel=channel.channel_num, start=_format_time(start), end=_format_time(end), scale=scale, unit=unit)
+        j = await self._get_json(url, timeout)
+        return _parse_chart_usage(j, start) if j else ([], start)
+
+    async def get_devices_status(self, device_list=None, timeout=None):
+        """Gets the list of outlets and chargers. If device list is provided, updates the connected status on each device."""
+        j = await self._get_json(API_ROOT + API_GET_STATUS, timeout)
+        return _parse_devices_status(j, device_list) if j else ([], [])
+
+    async def update_outlet(self, outlet, on=None, timeout=None):
+        """Turn an outlet on or off, see PyEmVue.update_outlet."""
+        if on is not None:
+            outlet.outlet_on = on
+        j = await self._put_json(API_ROOT + API_OUTLET, outlet.as_dictionary(), timeout)
+        outlet.from_json_dictionary(j)
+        return outlet
+
+    async def update_charger(self, charger, on=None, charge_rate=None, timeout=None):
+        """Enable/disable an evse/charger or change its rate, see PyEmVue.update_charger."""
+        if on is not None:
+            charger.charger_on = on
+        if charge_rate:
+            charger.charging_rate = charge_rate
+        j = await self._put_json(API_ROOT + API_CHARGER, charger.as_dictionary(), timeout)
+        charger.from_json_dictionary(j)
+        return charger
+
+    def _session(self):
+        if self.session is None or self.session.closed:
+            timeout = aiohttp.ClientTimeout(sock_connect=self.connect_timeout, sock_read=self.read_timeout)
+            connector = aiohttp.TCPConnector(limit=self.limit)
+            self.session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+        return self.session
+
+    async def _headers(self):
+        if not self.vue.cognito: raise Exception('Must call "login" before calling any API methods.')
+        if time.time() < self._token_expiry():
+            return {'authtoken': self.vue.cognito.id_token}
+        if self._token_lock is None:
+            self._token_lock = asyncio.Lock()
+        # only one task refreshes an expired token, the rest wait for it
+        async with self._token_lock:
+            if time.time() >= self._token_expiry():
+                loop = asyncio.get_running_loop()
+                await loop.run_in_executor(None, self.vue._check_token)
+        return {'authtoken': self.vue.cognito.id_token}
+
+    def _token_expiry(self):
+        token = self.vue.cognito.access_token
+        if token != self._token:
+            try:
+                self._expires = jwt.get_unverified_claims(token)['exp']
+            except Exception:
+                # can't tell, let _check_token decide every time
+                self._expires = 0
+            self._token = token
+        return self._expires
+
+    # request kwargs for a per-call timeout.  Without one the session's
+    # timeouts apply, an explicit timeout=None would replace them with none.
+    def _timeout(self, timeout):
+        if timeout is None:
+            return {}
+        return {'timeout': aiohttp.ClientTimeout(total=timeout, sock_connect=self.connect_timeout, sock_read=self.read_timeout)}
+
+    async def _get_json(self, url, timeout=None):
+        headers = await self._headers()
+        async with self._session().get(url, headers=headers, **self._timeout(timeout)) as response:
+            response.raise_for_status()
+            text = await response.text()
+        return json.loads(text) if text else None
+
+    async def _put_json(self, url, body, timeout=None):
+        headers = await self._headers()
+        async with self._session().put(url, headers=headers, json=body, **self._timeout(timeout)) as response:
+            response.raise_for_status()
+            return await response.json(content_type=None)
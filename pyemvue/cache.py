@@ -0,0 +1,111 @@
+import collections
+import datetime
+import threading
+import time
+
+from pyemvue.enums import Scale
+
+# How long usage for the current (still changing) bucket of each scale is
+# reused. 1S usage is never cached.
+SCALE_TTL = {
+    Scale.SECOND.value: 0,
+    Scale.MINUTE.value: 10,
+    Scale.MINUTES_15.value: 30,
+    Scale.HOUR.value: 30,
+    Scale.DAY.value: 120,
+    Scale.WEEK.value: 300,
+    Scale.MONTH.value: 300,
+    Scale.YEAR.value: 900,
+}
+
+# Approximate bucket sizes, only used to key the cache and to tell if a
+# requested instant is in an already completed bucket.
+SCALE_SECONDS = {
+    Scale.SECOND.value: 1,
+    Scale.MINUTE.value: 60,
+    Scale.MINUTES_15.value: 900,
+    Scale.HOUR.value: 3600,
+    Scale.DAY.value: 86400,
+    Scale.WEEK.value: 604800,
+    Scale.MONTH.value: 2592000,
+    Scale.YEAR.value: 31536000,
+}
+
+# usage for completed buckets doesn't change (much)
+COMPLETED_TTL = 3600
+
+class UsageCache(object):
+    """LRU cache of getDeviceListUsages results, stored per device so a request for
+       any subset of the gids in earlier requests can be answered from the cache."""
+    def __init__(self, max_buckets=64):
+        self.max_buckets = max_buckets
+        self.buckets = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _bucket(self, scale, unit, instant):
+        size = SCALE_SECONDS.get(scale, 1)
+        epoch = instant.timestamp() if instant.tzinfo else instant.replace(tzinfo=datetime.timezone.utc).timestamp()
+        index = int(epoch // size)
+        completed = (index + 1) * size <= time.time()
+        return (scale, unit, index), completed
+
+    def get(self, gids, scale, unit, instant):
+        """Returns a getDeviceListUsages style json dictionary, or None on a miss."""
+        if not SCALE_TTL.get(scale):
+            return None
+        key, completed = self._bucket(scale, unit, instant)
+        now = time.monotonic()
+        with self.lock:
+            bucket = self.buckets.get(key)
+            if bucket is not None:
+                devices = []
+                wanted = set(gids)
+                for gid in gids:
+                    entry = bucket.get(gid)
+                    if entry is None or entry[2] < now or (entry[0] is None and entry[3] not in wanted):
+                        devices = None
+                        break
+                    # nested devices are returned inside their (requested) parent
+                    if entry[0] is not None:
+                        devices.append(entry[0])
+                if devices is not None:
+                    self.buckets.move_to_end(key)
+                    self.hits += 1
+                    return {'deviceListUsages': {'instant': bucket[gids[0]][1], 'devices': devices}}
+            self.misses += 1
+        return None
+
+    def put(self, scale, unit, instant, j):
+        ttl = SCALE_TTL.get(scale)
+        if not ttl or 'deviceListUsages' not in j or 'devices' not in j['deviceListUsages']:
+            return
+        key, completed = self._bucket(scale, unit, instant)
+        expires = time.monotonic() + (COMPLETED_TTL if completed else ttl)
+        usages = j['deviceListUsages']
+        with self.lock:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                bucket = {}
+                self.buckets[key] = bucket
+            self.buckets.move_to_end(key)
+            for device in usages['devices']:
+                if device and 'deviceGid' in device:
+                    bucket[device['deviceGid']] = (device, usages.get('instant'), expires)
+                    for gid in _nested_gids(device):
+                        if gid not in bucket or bucket[gid][0] is None:
+                            bucket[gid] = (None, usages.get('instant'), expires, device['deviceGid'])
+            while len(self.buckets) > self.max_buckets:
+                self.buckets.popitem(last=False)
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+def _nested_gids(device):
+    for channel in device.get('channelUsages') or []:
+        for nested in (channel or {}).get('nestedDevices') or []:
+            if nested and 'deviceGid' in nested:
+                yield nested['deviceGid']
+                yield from _nested_gids(nested)
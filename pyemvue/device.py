@@ -135,6 +135,28 @@ class VueUsageDevice(VueDevice):
                     self.channels[populated_channel.channel_num] = populated_channel
         return self
 
+    def update_from_json_dictionary(self, js, timestamp):
+        """Overwrite the usage of the existing channels in place, only new channels are allocated."""
+        self.timestamp = timestamp
+        if not js: return self
+        updated = 0
+        if 'channelUsages' in js and js['channelUsages']:
+            for channel in js['channelUsages']:
+                if not channel: continue
+                existing = self.channels.get(channel.get('channelNum'))
+                if existing is None:
+                    existing = VueDeviceChannelUsage(timestamp=timestamp).from_json_dictionary(channel)
+                    self.channels[existing.channel_num] = existing
+                else:
+                    existing.update_from_json_dictionary(channel, timestamp)
+                updated += 1
+        if updated != len(self.channels):
+            # some channels weren't in this response, drop them
+            present = set(c.get('channelNum') for c in (js.get('channelUsages') or []) if c)
+            for num in [n for n in self.channels if n not in present]:
+                del self.channels[num]
+        return self
+
 class VueDeviceChannelUsage(VueDeviceChannel):
     def __init__(self, gid=0, usage=0, channelNum='1,2,3', name='', timestamp=None):
         super().__init__(gid=gid, name=name, channelNum=channelNum)
@@ -163,6 +185,29 @@ class VueDeviceChannelUsage(VueDeviceChannel):
                     self.nested_devices[populated.device_gid] = populated
         return self
 
+    def update_from_json_dictionary(self, js, timestamp):
+        """Overwrite usage, percentage and timestamp in place, including nested devices."""
+        self.timestamp = timestamp
+        if 'name' in js: self.name = js['name']
+        if 'usage' in js: self.usage = js['usage']
+        if 'percentage' in js: self.percentage = js['percentage']
+        nested = js.get('nestedDevices') or []
+        updated = 0
+        for device in nested:
+            if not device: continue
+            existing = self.nested_devices.get(device.get('deviceGid'))
+            if existing is None:
+                existing = VueUsageDevice(timestamp=timestamp).from_json_dictionary(device)
+                self.nested_devices[existing.device_gid] = existing
+            else:
+                existing.update_from_json_dictionary(device, timestamp)
+            updated += 1
+        if updated != len(self.nested_devices):
+            present = set(d.get('deviceGid') for d in nested if d)
+            for gid in [g for g in self.nested_devices if g not in present]:
+                del self.nested_devices[gid]
+        return self
+
 class OutletDevice(object):
     def __init__(self, gid=0, on=False, parentGid=0, parentChannel=0):
         self.device_gid = gid
@@ -1,6 +1,10 @@
 import requests
 import datetime
 import json
+import time
+import collections
+import concurrent.futures
+import threading
 from dateutil.parser import parse
 from urllib.parse import quote
 
@@ -12,6 +16,7 @@ from warrant import Cognito
 # Our files
 from pyemvue.enums import Scale, Unit
 from pyemvue.customer import Customer
+from pyemvue.cache import UsageCache
 from pyemvue.device import ChargerDevice, VueDevice, OutletDevice, VueDeviceChannel, VueDeviceChannelUsage, VueUsageDevice
 
 API_ROOT = 'https://api.emporiaenergy.com'
@@ -31,47 +36,82 @@ API_MAINTENANCE = 'https://s3.amazonaws.com/com.emporiaenergy.manual.ota/mainten
 CLIENT_ID = '4qte47jbstod8apnfic0bunmrq'
 USER_POOL = 'us-east-2_ghlOXVLi1'
 
+# need this many latency samples before hedging
+HEDGE_MIN_SAMPLES = 20
+
+# usage trees kept for get_device_list_usage(reuse=True), least recently used
+# gid sets (old shards, tiers, node queries) are dropped past this
+USAGE_TREES = 128
+
+class DeadlineExceeded(Exception):
+    """Raised when a request made with a timeout didn't answer in time."""
+
 class PyEmVue(object):
-    def __init__(self, connect_timeout = 6.03, read_timeout = 10.03):
+    def __init__(self, connect_timeout = 6.03, read_timeout = 10.03, cache_buckets = 64):
         self.username = None
         self.token_storage_file = None
         self.customer = None
         self.connect_timeout = connect_timeout
         self.read_timeout = read_timeout
         self.cognito = None
+        self.session = requests.Session()
+        self.session.headers['Accept-Encoding'] = 'gzip'
+        # url -> (etag, last modified, parsed json) for conditional requests
+        self._validators = {}
+        # endpoint -> [not modified count, request count]
+        self.cache_stats = {}
+        # (gids, scale, unit) -> usage tree updated in place by get_device_list_usage(reuse=True)
+        self._usage_trees = collections.OrderedDict()
+        # (gids, scale, unit) -> instant the tree was last parsed from
+        self._usage_instants = {}
+        # shards request usage from several threads
+        self._trees_lock = threading.Lock()
+        # coarse scale usage, see pyemvue.cache for the TTLs
+        self.usage_cache = UsageCache(cache_buckets)
+        # with a timeout, send a second usage request once the first has taken longer than
+        # this percentile of recent latencies. None disables hedging.
+        self.hedge_percentile = None
+        self.latency = collections.deque(maxlen=200)
+        self.hedge_stats = {'requests': 0, 'hedged': 0, 'hedge_won': 0, 'deadline_exceeded': 0}
+        # hedge_stats and latency are updated from the executor threads
+        self._stats_lock = threading.Lock()
+        self._executor = None
+        # get_chart_usage_list requests, late is past the timeout
+        self.chart_stats = {'requests': 0, 'failed': 0, 'late': 0}
+        self._chart_executor = None
+        self._chart_limit = None
+        # (checked at, message) from down_for_maintenance
+        self._maintenance = None
 
-    def down_for_maintenance(self):
-        """Checks to see if the API is down for maintenance, returns the reported message if present."""
-        response = requests.get(API_MAINTENANCE)
-        if response.status_code == 404: return None
-        if response.text:
+    def down_for_maintenance(self, max_age=60):
+        """Checks to see if the API is down for maintenance, returns the reported message if present.
+           The answer is cached for max_age seconds, the check goes through the session but needs no login."""
+        now = time.monotonic()
+        if self._maintenance is not None and now - self._maintenance[0] < max_age:
+            return self._maintenance[1]
+        response = self.session.get(API_MAINTENANCE, timeout=(self.connect_timeout, self.read_timeout))
+        message = None
+        # anything but the maintenance document (404, S3 access denied) means no maintenance
+        if response.status_code < 300 and response.text:
             j = response.json()
             if 'msg' in j:
-                return j['msg']
+                message = j['msg']
+        self._maintenance = (now, message)
+        return message
 
     def get_devices(self):
         """Get all devices under the current customer account."""
         url = API_ROOT + API_CUSTOMER_DEVICES.format(customerGid = self.customer.customer_gid)
-        response = self._get_request(url)
-        response.raise_for_status()
-        devices = []
-        if response.text:
-            j = response.json()
-            if 'devices' in j:
-                for dev in j['devices']:
-                    devices.append(VueDevice().from_json_dictionary(dev))
-                    if 'devices' in dev:
-                        for subdev in dev['devices']:
-                            devices.append(VueDevice().from_json_dictionary(subdev))
-        return devices
+        j = self._get_conditional(url, 'devices')
+        if j:
+            return _parse_devices(j)
+        return []
 
     def populate_device_properties(self, device):
         """Get details about a specific device"""
         url = API_ROOT + API_DEVICE_PROPERTIES.format(deviceGid=device.device_gid)
-        response = self._get_request(url)
-        response.raise_for_status()
-        if response.text:
-            j = response.json()
+        j = self._get_conditional(url, 'properties')
+        if j:
             device.populate_location_properties_from_json(j)
         return device
 
@@ -86,28 +126,53 @@ class PyEmVue(object):
             return Customer().from_json_dictionary(j)
         return None
 
-    def get_device_list_usage(self, deviceGids, instant, scale=Scale.SECOND.value, unit=Unit.KWH.value):
-        """Returns a nested dictionary of VueUsageDevice and VueDeviceChannelUsage with the total usage of the devices over the specified scale. Note that you may need to scale this to get a rate (1MIN in kw = 60*result)"""
+    def get_device_list_usage(self, deviceGids, instant, scale=Scale.SECOND.value, unit=Unit.KWH.value, reuse=False, timeout=None):
+        """Returns a nested dictionary of VueUsageDevice and VueDeviceChannelUsage with the total usage of the devices over the specified scale. Note that you may need to scale this to get a rate (1MIN in kw = 60*result)
+           With reuse=True the same objects are returned on every call for the same gids, scale and unit and are updated in place,
+           so the result is only valid until the next call.
+           With a timeout (seconds) the request may be hedged, see hedge_percentile, and DeadlineExceeded is raised if
+           no response arrives in time."""
         if not instant: instant = datetime.datetime.now(datetime.timezone.utc)
         gids = deviceGids
         if isinstance(deviceGids, list):
             gids = '+'.join(map(str, deviceGids))
         
-        url = API_ROOT + API_DEVICES_USAGE.format(deviceGids=gids, instant=_format_time(instant), scale=scale, unit=unit)
-        response = self._get_request(url)
-        response.raise_for_status()
-        devices = {}
-        if response.text:
+        gid_list = deviceGids if isinstance(deviceGids, list) else [int(g) for g in str(deviceGids).split('+')]
+        j = self.usage_cache.get(gid_list, scale, unit, instant)
+        if j is None:
+            url = API_ROOT + API_DEVICES_USAGE.format(deviceGids=gids, instant=_format_time(instant), scale=scale, unit=unit)
+            if timeout:
+                response = self._get_hedged(url, timeout)
+            else:
+                response = self._get_request(url)
+            response.raise_for_status()
+            if not response.text:
+                return {}
             j = response.json()
-            if 'deviceListUsages' in j and 'devices' in j['deviceListUsages']:
-                timestamp = parse(j['deviceListUsages']['instant'])
-                for device in j['deviceListUsages']['devices']:
-                    populated = VueUsageDevice(timestamp=timestamp).from_json_dictionary(device)
-                    devices[populated.device_gid] = populated
-        return devices
+            self.usage_cache.put(scale, unit, instant, j)
+
+        if reuse:
+            key = (gids, scale, unit)
+            sample = j.get('deviceListUsages', {}).get('instant')
+            with self._trees_lock:
+                tree = self._usage_trees.get(key)
+                if tree is None:
+                    tree = {}
+                    self._usage_trees[key] = tree
+                    while len(self._usage_trees) > USAGE_TREES:
+                        old, _ = self._usage_trees.popitem(last=False)
+                        self._usage_instants.pop(old, None)
+                else:
+                    self._usage_trees.move_to_end(key)
+                # a 1S sample doesn't change once published, don't parse the same instant twice
+                if scale == Scale.SECOND.value and tree and sample is not None and self._usage_instants.get(key) == sample:
+                    return tree
+                self._usage_instants[key] = sample
+            return _parse_device_list_usage(j, tree)
+        return _parse_device_list_usage(j)
 
 
-    def get_chart_usage(self, channel, start=None, end=None, scale=Scale.SECOND.value, unit=Unit.KWH.value):
+    def get_chart_usage(self, channel, start=None, end=None, scale=Scale.SECOND.value, unit=Unit.KWH.value, timeout=None):
         """Gets the usage over a given time period and the start of the measurement period. Note that you may need to scale this to get a rate (1MIN in kw = 60*result)"""
         if channel.channel_num in ['MainsFromGrid', 'MainsToGrid']:
             # These is not populated for the special Mains data as of right now
@@ -115,15 +180,50 @@ class PyEmVue(object):
         if not start: start = datetime.datetime.now(datetime.timezone.utc)
         if not end: end = datetime.datetime.now(datetime.timezone.utc)
         url = API_ROOT + API_CHART_USAGE.format(deviceGid=channel.device_gid, channel=channel.channel_num, start=_format_time(start), end=_format_time(end), scale=scale, unit=unit)
-        response = self._get_request(url)
+        response = self._get_request(url, timeout=timeout)
         response.raise_for_status()
-        usage = []
-        instant = start
         if response.text:
-            j = response.json()
-            if 'firstUsageInstant' in j: instant = parse(j['firstUsageInstant'])
-            if 'usageList' in j: usage = j['usageList']
-        return usage, instant
+            return _parse_chart_usage(response.json(), start)
+        return [], start
+
+    def get_chart_usage_list(self, channels, start=None, end=None, scale=Scale.SECOND.value, unit=Unit.KWH.value, limit=8, timeout=None):
+        """Gets the chart usage of several channels concurrently over the pooled session, at most limit requests at a time.
+           Returns a dictionary of (device gid, channel number) -> (usage list, first instant). Channels whose request failed
+           or didn't answer within timeout seconds are left out and counted in chart_stats."""
+        if not start: start = datetime.datetime.now(datetime.timezone.utc)
+        if not end: end = datetime.datetime.now(datetime.timezone.utc)
+        if self._chart_executor is None or self._chart_limit != limit:
+            if self._chart_executor is not None:
+                self._chart_executor.shutdown(wait=False)
+            self._chart_executor = concurrent.futures.ThreadPoolExecutor(max_workers=limit, thread_name_prefix='pyemvue-chart')
+            self._chart_limit = limit
+            if isinstance(self.session, requests.Session):
+                # one pooled connection per worker, plus the hedged usage requests
+                adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=limit + 8)
+                self.session.mount('https://', adapter)
+        self._check_token() # once here rather than in every request
+        request_timeout = (min(self.connect_timeout, timeout), timeout) if timeout else None
+
+        futures = {}
+        for channel in channels:
+            key = (channel.device_gid, channel.channel_num)
+            if key not in futures:
+                futures[key] = self._chart_executor.submit(self.get_chart_usage, channel, start, end, scale, unit, request_timeout)
+        self.chart_stats['requests'] += len(futures)
+        done, late = concurrent.futures.wait(futures.values(), timeout=timeout)
+        for future in late:
+            future.cancel()
+
+        result = {}
+        for key, future in futures.items():
+            if future not in done:
+                self.chart_stats['late'] += 1
+                continue
+            try:
+                result[key] = future.result()
+            except Exception:
+                self.chart_stats['failed'] += 1
+        return result
 
     def get_outlets(self):
         """ Return a list of outlets linked to the account. Deprecated, use get_devices_status instead."""
@@ -179,28 +279,10 @@ class PyEmVue(object):
     def get_devices_status(self, device_list=None):
         """Gets the list of outlets and chargers. If device list is provided, updates the connected status on each device."""
         url = API_ROOT + API_GET_STATUS
-        response = self._get_request(url)
-        response.raise_for_status()
-        chargers = []
-        outlets = []
-        if response.text:
-            j = response.json()
-            if j and 'evChargers' in j and j['evChargers']:
-                for raw_charger in j['evChargers']:
-                    chargers.append(ChargerDevice().from_json_dictionary(raw_charger))
-            if j and 'outlets' in j and j['outlets']:
-                for raw_outlet in j['outlets']:
-                    outlets.append(OutletDevice().from_json_dictionary(raw_outlet))
-            if device_list and j and 'devicesConnected' in j and j['devicesConnected']:
-                for raw_device_data in j['devicesConnected']:
-                    if raw_device_data and 'deviceGid' in raw_device_data and raw_device_data['deviceGid']:
-                        for device in device_list:
-                            if device.device_gid == raw_device_data['deviceGid']:
-                                device.connected = raw_device_data['connected']
-                                device.offline_since = raw_device_data['offlineSince']
-                                break
-
-        return (outlets, chargers)
+        j = self._get_conditional(url, 'status')
+        if j:
+            return _parse_devices_status(j, device_list)
+        return ([], [])
 
     def login(self, username=None, password=None, id_token=None, access_token=None, refresh_token=None, token_storage_file=None):
         """ Authenticates the current user using access tokens if provided or username/password if no tokens available.
@@ -263,17 +345,186 @@ class PyEmVue(object):
         with open(self.token_storage_file, 'w') as f:
             json.dump(data, f, indent=2)
 
-    def _get_request(self, full_endpoint):
+    def cache_hit_rate(self, endpoint):
+        """Fraction of conditional requests to endpoint that were answered with 304 Not Modified."""
+        hits, total = self.cache_stats.get(endpoint, (0, 0))
+        return hits / total if total else 0.0
+
+    def _get_conditional(self, full_endpoint, endpoint):
+        """GET using the ETag/Last-Modified of the previous response, returns the parsed json (cached on a 304)."""
+        headers = {}
+        cached = self._validators.get(full_endpoint)
+        if cached:
+            if cached[0]: headers['If-None-Match'] = cached[0]
+            if cached[1]: headers['If-Modified-Since'] = cached[1]
+
+        stats = self.cache_stats.setdefault(endpoint, [0, 0])
+        stats[1] += 1
+        response = self._get_request(full_endpoint, headers)
+        if response.status_code == 304 and cached:
+            stats[0] += 1
+            return cached[2]
+        response.raise_for_status()
+
+        j = response.json() if response.text else None
+        etag = response.headers.get('ETag')
+        modified = response.headers.get('Last-Modified')
+        if etag or modified:
+            self._validators[full_endpoint] = (etag, modified, j)
+        else:
+            self._validators.pop(full_endpoint, None)
+        return j
+
+    def _get_request(self, full_endpoint, extra_headers=None, timeout=None, check_token=True):
         if not self.cognito: raise Exception('Must call "login" before calling any API methods.')
-        self._check_token() # ensure our token hasn't expired, refresh if it has
+        if check_token: self._check_token() # ensure our token hasn't expired, refresh if it has
         headers = {'authtoken': self.cognito.id_token}
-        return requests.get(full_endpoint, headers=headers)
+        if extra_headers: headers.update(extra_headers)
+        return self.session.get(full_endpoint, headers=headers, timeout=timeout or (self.connect_timeout, self.read_timeout))
 
     def _put_request(self, full_endpoint, body):
         if not self.cognito: raise Exception('Must call "login" before calling any API methods.')
         self._check_token() # ensure our token hasn't expired, refresh if it has
         headers = {'authtoken': self.cognito.id_token}
-        return requests.put(full_endpoint, headers=headers, json=body)
+        return self.session.put(full_endpoint, headers=headers, json=body, timeout=(self.connect_timeout, self.read_timeout))
+
+    def _get_hedged(self, full_endpoint, timeout):
+        """GET that answers within timeout seconds or raises DeadlineExceeded. If the request hasn't answered by the
+           hedge_percentile latency a duplicate is sent and the first response wins, the other is discarded."""
+        if self._executor is None:
+            self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=8, thread_name_prefix='pyemvue')
+        self._check_token() # once here rather than in both requests
+        self._count('requests')
+        deadline = time.monotonic() + timeout
+        first = self._executor.submit(self._timed_get, full_endpoint, timeout)
+        pending = {first}
+
+        hedge_after = self._hedge_delay()
+        if hedge_after is not None and hedge_after < timeout:
+            done, _ = concurrent.futures.wait(pending, timeout=hedge_after)
+            remaining = deadline - time.monotonic()
+            if not done and remaining > 0.05:
+                self._count('hedged')
+                pending.add(self._executor.submit(self._timed_get, full_endpoint, remaining))
+
+        error = None
+        while pending:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            done, pending = concurrent.futures.wait(pending, timeout=remaining, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                try:
+                    response = future.result()
+                except Exception as e:
+                    error = e
+                    continue
+                if future is not first:
+                    self._count('hedge_won')
+                return response
+
+        # a request timing out is the deadline passing, anything else is a real error
+        if error is not None and not pending and not isinstance(error, requests.exceptions.Timeout):
+            raise error
+        self._count('deadline_exceeded')
+        raise DeadlineExceeded('No response within {:.2f}s'.format(timeout))
+
+    def _count(self, stat):
+        with self._stats_lock:
+            self.hedge_stats[stat] += 1
+
+    def _timed_get(self, full_endpoint, timeout):
+        start = time.monotonic()
+        try:
+            response = self._get_request(full_endpoint, timeout=(min(self.connect_timeout, timeout), timeout), check_token=False)
+        except Exception:
+            # a failed request took at least the deadline as far as the caller is
+            # concerned, leaving it out would make the percentile look too fast
+            with self._stats_lock:
+                self.latency.append(timeout)
+            raise
+        with self._stats_lock:
+            self.latency.append(time.monotonic() - start)
+        return response
+
+    def _hedge_delay(self):
+        with self._stats_lock:
+            ordered = sorted(self.latency)
+        if not self.hedge_percentile or len(ordered) < HEDGE_MIN_SAMPLES:
+            return None
+        index = min(len(ordered) - 1, int(len(ordered) * self.hedge_percentile / 100))
+        return ordered[index]
+
+def _parse_devices(j):
+    """Build the VueDevice list from a customers/devices response."""
+    devices = []
+    if 'devices' in j:
+        for dev in j['devices']:
+            devices.append(VueDevice().from_json_dictionary(dev))
+            if 'devices' in dev:
+                for subdev in dev['devices']:
+                    devices.append(VueDevice().from_json_dictionary(subdev))
+    return devices
+
+def _parse_device_list_usage(j, into=None):
+    """Build the nested VueUsageDevice dictionary from a getDeviceListUsages response. If into is given
+       it's a dictionary from a previous call that is updated in place and returned."""
+    if into is None:
+        devices = {}
+        if 'deviceListUsages' in j and 'devices' in j['deviceListUsages']:
+            timestamp = parse(j['deviceListUsages']['instant'])
+            for device in j['deviceListUsages']['devices']:
+                populated = VueUsageDevice(timestamp=timestamp).from_json_dictionary(device)
+                devices[populated.device_gid] = populated
+        return devices
+
+    updated = 0
+    if 'deviceListUsages' in j and 'devices' in j['deviceListUsages']:
+        timestamp = parse(j['deviceListUsages']['instant'])
+        for device in j['deviceListUsages']['devices']:
+            if not device: continue
+            existing = into.get(device.get('deviceGid'))
+            if existing is None:
+                existing = VueUsageDevice(timestamp=timestamp).from_json_dictionary(device)
+                into[existing.device_gid] = existing
+            else:
+                existing.update_from_json_dictionary(device, timestamp)
+            updated += 1
+    if updated != len(into):
+        present = set(d.get('deviceGid') for d in j.get('deviceListUsages', {}).get('devices', []) if d)
+        for gid in [g for g in into if g not in present]:
+            del into[gid]
+    return into
+
+def _parse_chart_usage(j, start):
+    """Returns the usage list and first usage instant from a getChartUsage response."""
+    usage = []
+    instant = start
+    if 'firstUsageInstant' in j: instant = parse(j['firstUsageInstant'])
+    if 'usageList' in j: usage = j['usageList']
+    return usage, instant
+
+def _parse_devices_status(j, device_list=None):
+    """Returns (outlets, chargers) from a devices/status response, updating the connected status of device_list."""
+    chargers = []
+    outlets = []
+    if j and 'evChargers' in j and j['evChargers']:
+        for raw_charger in j['evChargers']:
+            chargers.append(ChargerDevice().from_json_dictionary(raw_charger))
+    if j and 'outlets' in j and j['outlets']:
+        for raw_outlet in j['outlets']:
+            outlets.append(OutletDevice().from_json_dictionary(raw_outlet))
+    if device_list and j and 'devicesConnected' in j and j['devicesConnected']:
+        by_gid = {}
+        for device in device_list:
+            by_gid.setdefault(device.device_gid, device)
+        for raw_device_data in j['devicesConnected']:
+            if raw_device_data and 'deviceGid' in raw_device_data and raw_device_data['deviceGid']:
+                device = by_gid.get(raw_device_data['deviceGid'])
+                if device:
+                    device.connected = raw_device_data['connected']
+                    device.offline_since = raw_device_data['offlineSince']
+    return (outlets, chargers)
 
 def _format_time(time):
     '''Convert time to utc, then format'''
@@ -0,0 +1,216 @@
+import gzip
+import json
+import queue
+import re
+import threading
+import time
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+# Our files
+from pyemvue.customer import Customer
+
+# query parameters that change with every request and are ignored when
+# matching a request against the recording
+VOLATILE_PARAMS = re.compile(r'([?&](instant|start|end)=)[^&]*')
+EMAIL_PARAM = re.compile(r'([?&]email=)[^&]*')
+REDACTED_FIELDS = ['email', 'firstName', 'lastName']
+KEPT_HEADERS = ['ETag', 'Last-Modified', 'Content-Type']
+
+# a recording stops after this many bytes of json lines (uncompressed) or
+# seconds, whichever comes first
+MAX_BYTES = 64 * 1024 * 1024
+MAX_SECONDS = 24 * 3600
+# exchanges waiting for the writer thread, more are dropped
+WRITE_QUEUE = 1000
+
+def record(vue, path, max_bytes=MAX_BYTES, max_seconds=MAX_SECONDS):
+    """Record every request made by a logged in PyEmVue to path (gzipped json lines)."""
+    vue.session = RecordingSession(vue.session, path, max_bytes, max_seconds)
+    return vue
+
+def stop_recording(vue):
+    """Stop recording a PyEmVue's requests, writing out what's queued. The recorder can be
+       wrapped by other sessions (the bench command's TimingSession), it's found by following
+       their session attributes."""
+    owner, session = vue, vue.session
+    while session is not None:
+        if isinstance(session, RecordingSession):
+            session.close()
+            owner.session = session.session
+            break
+        owner, session = session, getattr(session, 'session', None)
+    return vue
+
+def replay(vue, path, speed=1.0):
+    """Serve all of a PyEmVue's requests from a recording. speed scales the recorded
+       latencies (2.0 is twice as fast), None or 0 replays without any delay."""
+    return offline(vue, ReplaySession(path, speed))
+
+def offline(vue, session):
+    """Point a PyEmVue at a session that answers requests without the Emporia Cloud (a
+       ReplaySession or synthetic data) and skip authentication."""
+    vue.session = session
+    vue.cognito = _ReplayAuth()
+    vue.username = 'offline'
+    vue.customer = Customer()
+    vue._check_token = lambda: None
+    return vue
+
+def _redact_url(url):
+    return EMAIL_PARAM.sub(r'\1redacted', url)
+
+def _match_key(method, url):
+    return method + ' ' + VOLATILE_PARAMS.sub(r'\1', _redact_url(url))
+
+def _redact_body(text):
+    if not text:
+        return text
+    try:
+        j = json.loads(text)
+    except ValueError:
+        return text
+    if isinstance(j, dict) and any(field in j for field in REDACTED_FIELDS):
+        for field in REDACTED_FIELDS:
+            if field in j:
+                j[field] = 'redacted'
+        return json.dumps(j, separators=(',', ':'))
+    return text
+
+class RecordingSession(object):
+    """Wraps a requests.Session and appends each exchange to a gzipped json lines file.
+       Request headers (which carry the auth token) are never written. Requests only
+       queue the exchange, a writer thread keeps the file open and writes them. The
+       recording stops at max_bytes or max_seconds, or when the queue is full the
+       exchange is dropped (counted in dropped)."""
+    def __init__(self, session, path, max_bytes=MAX_BYTES, max_seconds=MAX_SECONDS):
+        self.session = session
+        self.headers = session.headers
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_seconds = max_seconds
+        self.start = time.monotonic()
+        self.written = 0
+        self.dropped = 0
+        self.recording = True
+        self.queue = queue.Queue(WRITE_QUEUE)
+        self.writer = threading.Thread(target=self._write, name='pyemvue-record', daemon=True)
+        self.writer.start()
+
+    def close(self):
+        """Stop recording and wait for the queued exchanges to be written."""
+        if self.recording:
+            self.recording = False
+            self.queue.put(None)
+        self.writer.join(5)
+
+    def get(self, url, **kwargs):
+        return self._record('GET', url, self.session.get, kwargs)
+
+    def put(self, url, **kwargs):
+        return self._record('PUT', url, self.session.put, kwargs)
+
+    def _record(self, method, url, send, kwargs):
+        sent = time.monotonic()
+        response = send(url, **kwargs)
+        if not self.recording:
+            return response
+        if sent - self.start > self.max_seconds:
+            self.recording = False
+            self.queue.put(None)
+            return response
+        entry = {
+            't': round(sent - self.start, 3),
+            'latency': round(time.monotonic() - sent, 3),
+            'method': method,
+            'url': _redact_url(url),
+            'status': response.status_code,
+            'headers': {h: response.headers[h] for h in KEPT_HEADERS if h in response.headers},
+            'body': _redact_body(response.text),
+        }
+        try:
+            self.queue.put_nowait(entry)
+        except queue.Full:
+            self.dropped += 1
+        return response
+
+    def _write(self):
+        with gzip.open(self.path, 'at', encoding='utf-8') as f:
+            while True:
+                try:
+                    entry = self.queue.get(timeout=1)
+                except queue.Empty:
+                    # idle, make what's written so far readable
+                    f.flush()
+                    continue
+                if entry is None:
+                    break
+                line = json.dumps(entry, separators=(',', ':')) + '\n'
+                f.write(line)
+                self.written += len(line)
+                if self.written >= self.max_bytes:
+                    self.recording = False
+                    break
+
+class ReplayResponse(object):
+    def __init__(self, entry, url):
+        self.url = url
+        self.status_code = entry['status']
+        self.headers = CaseInsensitiveDict(entry.get('headers', {}))
+        self.text = entry.get('body') or ''
+
+    def json(self):
+        return json.loads(self.text)
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError('{} Error (replayed) for url: {}'.format(self.status_code, self.url), response=self)
+
+class ReplaySession(object):
+    """Answers requests from a recording. Requests are matched on method and url (ignoring the
+       time parameters) and each match is served in recorded order, wrapping around at the end.
+       Only each response's recorded latency is replayed, the caller decides when requests are
+       made, so the recorded start times (t) are informational and not used for pacing."""
+    def __init__(self, path, speed=1.0):
+        self.headers = {}
+        self.speed = speed
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.position = {}
+        self.requests = 0
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    entry = json.loads(line)
+                    self.entries.setdefault(_match_key(entry['method'], entry['url']), []).append(entry)
+
+    def get(self, url, **kwargs):
+        return self._replay('GET', url)
+
+    def put(self, url, **kwargs):
+        return self._replay('PUT', url)
+
+    def _replay(self, method, url):
+        key = _match_key(method, url)
+        with self.lock:
+            self.requests += 1
+            entries = self.entries.get(key)
+            if not entries:
+                entry = {'status': 404, 'body': ''}
+            else:
+                index = self.position.get(key, 0)
+                self.position[key] = (index + 1) % len(entries)
+                entry = entries[index]
+
+        if self.speed and entry.get('latency'):
+            time.sleep(entry['latency'] / self.speed)
+        return ReplayResponse(entry, url)
+
+class _ReplayAuth(object):
+    id_token = 'replay'
+    access_token = 'replay'
+    refresh_token = 'replay'
+
+    def check_token(self, renew=True):
+        return False
@@ -4,21 +4,166 @@ Cloud for usage/status data.
 '''
 
 import udi_interface
+import logging
 import re
+import time
+import collections
+import threading
+import datetime
+import concurrent.futures
+from dateutil import tz
 import pyemvue
+import history
+import tariff
+import tiers
+import commands
+import polllog
+import sources
 from nodes import vueChannel
 
 LOGGER = udi_interface.LOGGER
 
+# a local reading newer than this replaces the cloud 1S sample
+LOCAL_FRESH = 10
+
+# part of the short poll interval a 1S usage request may take, a later
+# answer is dropped since the next poll is already due
+DEADLINE_FRACTION = 0.9
+
+# 1S data older than this (seconds) marks the devices stale
+STALE_AFTER = 30
+
+# longest gap (seconds) between short polls covered by the interval
+# average, a longer gap just uses the latest sample
+MAX_INTERVAL = 300
+
+# shards fetched at once, and the longest a failing shard is skipped
+SHARD_WORKERS = 4
+SHARD_BACKOFF_MAX = 300
+
+# device ST values
+OFFLINE = 0
+ONLINE = 1
+STALE = 3
+
 class Query(object):
-    def __init__(self, polyglot, vue):
+    def __init__(self, polyglot, vue, window=3600, tariff_config=None):
         self.polyglot = polyglot
         self.vue = vue
+        self.source = sources.CloudSource(vue)
+        self.local = None
+        self.local_config = None
+        self.local_seen = {}
+        self.lock = threading.Lock()
+        self.consumers = []
+        self.last_short = None
+        self.instants = {}
+        self.publish_lags = collections.deque(maxlen=30)
+        self.interval_limit = 0
+        self.intervals = {}
+        self.shard_size = 0
+        self.shard_cache = {}
+        self.shard_retry = {}
+        self.executor = None
+        self.tiers = None
+        self.tier_instants = {}
+        self.stale_after = STALE_AFTER
+        self.stale = False
+        self.ready = False
+        self.log = polllog.PollLogger(LOGGER)
+        self.commands = commands.CommandDispatcher()
+        # maintenance.Maintenance of the current session
+        self.outage = None
         self.deviceList = []
+        self.history = history.ChannelHistory(window)
+        self.demand = {}
+        self.tariff_config = tariff_config
+        self.tariffs = {}
+        self.costs = {}
+        self.net = {}
+        self.last_status = {}
+        self.last_connected = {}
+        self.addresses = {}
+        self.info = {}
         LOGGER.info('Query class initialized')
 
-    def devices(self, deviceList):
+    # apply changed custom parameters without logging in again
+    def configure(self, window, tariff_config, local_config=None):
+        if window != self.history.window:
+            self.history = history.ChannelHistory(window)
+        if tariff_config != self.tariff_config:
+            self.tariff_config = tariff_config
+            self.tariffs = {}
+            self.costs = {}
+        if local_config != self.local_config:
+            self.set_local(local_config)
+
+    # switch to a new PyEmVue session after logging in again
+    def use_session(self, vue):
+        self.vue = vue
+        self.source = sources.CloudSource(vue)
+
+    # start (or replace) the local data source, None stops it
+    def set_local(self, config):
+        self.local_config = config
+        if self.local is not None:
+            self.local.stop()
+            self.local = None
+            self.local_seen = {}
+        if config:
+            try:
+                local = sources.MqttSource(config)
+                local.start(self.update_local)
+                self.local = local
+            except ImportError:
+                LOGGER.error('LocalSource needs the paho-mqtt package, using the Emporia Cloud only')
+            except Exception as e:
+                LOGGER.error('Failed to start the local source: {}'.format(e))
+
+    # replace the polling tiers if the PollTiers config changed
+    def set_tiers(self, config):
+        if config == (self.tiers.config if self.tiers else {}):
+            return
+        self.tiers = tiers.PollTiers(config) if config else None
+        self.tier_instants = {}
+
+    # drop any local state kept for a node that was removed
+    def forget(self, address):
+        self.history.remove(address)
+        self.demand.pop(address, None)
+        self.costs.pop(address, None)
+        self.net.pop(address, None)
+        self.local_seen.pop(address, None)
+
+    # deviceList is the list of gids to query, info maps each gid to
+    # its VueDevice (time zone, billing cycle, etc.)
+    def devices(self, deviceList, info=None):
         self.deviceList = deviceList
+        if info is not None:
+            self.info = info
+        self.shard_cache = {}
+        self.shard_retry = {}
+        if self.tiers:
+            self.tiers.reset()
+
+    # The tariff for a device, falling back to the device's flat
+    # rate and demand charge for anything not configured.
+    def get_tariff(self, gid):
+        if gid not in self.tariffs:
+            rate = 0.0
+            demand = 0.0
+            if gid in self.info:
+                rate = self.info[gid].usage_cent_per_kw_hour / 100
+                demand = self.info[gid].peak_demand_dollar_per_kw
+            self.tariffs[gid] = tariff.Tariff(self.tariff_config, rate, demand)
+        return self.tariffs[gid]
+
+    # current local time for a device, in the device's time zone
+    def local_time(self, gid):
+        zone = None
+        if gid in self.info and self.info[gid].time_zone:
+            zone = tz.gettz(self.info[gid].time_zone)
+        return datetime.datetime.now(zone)
 
     # UDI interface getValidAddress doesn't seem to work right
     def makeValidAddress(self, address):
@@ -27,38 +172,186 @@ class Query(object):
         address = address.lower()[:14]
         return address
 
+    # node address for a gid/channel, cached since it's needed for
+    # every channel on every poll.
+    def channel_address(self, gid, channel_num):
+        key = (gid, channel_num)
+        address = self.addresses.get(key)
+        if address is None:
+            if channel_num == '1,2,3':
+                address = str(gid)
+            else:
+                address = str(gid) + '_' + str(channel_num)
+            address = self.makeValidAddress(address)
+            self.addresses[key] = address
+        return address
+
     # query all device usage info for different scale values
     def query(self, scale, extra):
+        self.log.start_cycle()
+
+        # the usage tree is reused between polls, it's only valid
+        # until the next query for this scale.
+        timeout = self.deadline(scale)
+        if timeout:
+            timeout -= self.align(scale, timeout)
+        started = time.monotonic()
+        previous = self.instants.get(scale)
 
-        usage = self.vue.get_device_list_usage(self.deviceList, None, scale=scale,
-                unit=pyemvue.enums.Unit.KWH.value)
+        # with polling tiers only the devices of the tiers that are due
+        due = None
+        gids = self.deviceList
+        if self.tiers and scale == pyemvue.enums.Scale.SECOND.value:
+            due = self.tiers.due(started)
+            gids = self.tiers.gids(due, self.deviceList, self.info)
 
-        self.update_devices(usage, scale)
+        try:
+            usage = self.fetch_usage(scale, timeout, gids) if gids else None
+        except pyemvue.DeadlineExceeded:
+            self.log.count('stale')
+            self.log.limited(logging.WARNING, 'deadline', 'No %s usage within %.2fs, skipped', scale, timeout)
+            usage = None
+
+        if usage is not None and self.new_instant(scale, usage):
+            if scale == pyemvue.enums.Scale.SECOND.value:
+                remaining = timeout - (time.monotonic() - started) if timeout else None
+                self.intervals = self.interval_usage(usage, previous, self.instants[scale], remaining, due)
+            changes = self.snapshot_changes()
+            self.update_devices(usage, scale, changes, due)
+            self.publish(scale, changes)
+            # a tier is only used up by a poll that updated it, a skipped
+            # or repeated poll leaves it due
+            if due is not None:
+                self.tiers.mark(due, started)
 
         # Update outlet/charger status
         if extra:
             self.query_device_status()
 
-    def update_devices(self, usage, scale):
+        self.log.end_cycle(scale)
+
+    # Usage of every device.  With shard_size set the gids are split into
+    # shards that are requested concurrently and merged, a nested device
+    # stays in its parent's shard.  A shard that fails is retried once
+    # and then skipped, with a growing back off, while the other shards
+    # still update.  Raises only when no shard answered.
+    def fetch_usage(self, scale, timeout, gids):
+        shards = self.shards(gids)
+        if len(shards) < 2:
+            return self.source.usage(gids, scale, reuse=True, timeout=timeout)
+
+        if self.executor is None:
+            self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=SHARD_WORKERS, thread_name_prefix='shard')
+        now = time.monotonic()
+        futures = []
+        for shard in shards:
+            if self.shard_retry.get(shard, (0, 0))[1] <= now:
+                futures.append((shard, self.executor.submit(self.fetch_shard, shard, scale, timeout)))
+            else:
+                self.log.count('shard_skipped')
+
+        usage = {}
+        error = None
+        for shard, future in futures:
+            try:
+                usage.update(future.result())
+                self.shard_retry.pop(shard, None)
+            except pyemvue.DeadlineExceeded as e:
+                # out of time isn't the shard's fault, no back off
+                error = error or e
+            except Exception as e:
+                error = e
+                failures = self.shard_retry.get(shard, (0, 0))[0] + 1
+                self.shard_retry[shard] = (failures, now + min(2 ** failures, SHARD_BACKOFF_MAX))
+                self.log.count('shard_failed')
+                self.log.limited(logging.WARNING, 'shard:{}'.format(shard[0]),
+                        'Usage of devices %s failed %d times, skipping for %ds: %s',
+                        '+'.join(map(str, shard)), failures, min(2 ** failures, SHARD_BACKOFF_MAX), e)
+        if not usage and error is not None:
+            raise error
+        return usage
+
+    def fetch_shard(self, shard, scale, timeout):
+        started = time.monotonic()
+        try:
+            return self.source.usage(list(shard), scale, reuse=True, timeout=timeout)
+        except pyemvue.DeadlineExceeded:
+            raise
+        except Exception:
+            if timeout:
+                timeout -= time.monotonic() - started
+                if timeout <= 0:
+                    raise
+            return self.source.usage(list(shard), scale, reuse=True, timeout=timeout)
+
+    # gids split into tuples of at most shard_size gids, a device and
+    # its nested devices are never split.
+    def shards(self, gids):
+        key = (tuple(gids), self.shard_size)
+        if key not in self.shard_cache:
+            groups = collections.OrderedDict()
+            present = set(gids)
+            for gid in gids:
+                parent = self.info[gid].parent_device_gid if gid in self.info else None
+                groups.setdefault(parent if parent in present else gid, []).append(gid)
+
+            shards = []
+            shard = []
+            for group in groups.values():
+                if shard and self.shard_size and len(shard) + len(group) > self.shard_size:
+                    shards.append(tuple(shard))
+                    shard = []
+                shard.extend(group)
+            if shard:
+                shards.append(tuple(shard))
+            self.shard_cache[key] = shards
+        return self.shard_cache[key]
+
+    # collects what update_devices published, only when something
+    # (snapshot server, exporter) consumes it
+    def snapshot_changes(self):
+        return {} if self.consumers else None
+
+    def publish(self, scale, changes):
+        if changes:
+            for consumer in self.consumers:
+                consumer.publish(scale, changes)
+
+    # due is the polling tiers to update, None for every channel.
+    # accounting is False for ad-hoc refreshes outside the poll cadence,
+    # they only update the drivers and leave the history, demand, net
+    # and cost meters (and the poll's interval averages) alone.
+    def update_devices(self, usage, scale, changes=None, due=None, accounting=True):
         for gid, device in usage.items():
             # device is class VueUsageDevice. this adds channels dictionary
-            LOGGER.debug('Found usage data for {}'.format(gid))
+            self.log.count('devices')
             for channelnum, channel in device.channels.items():
                 # channel is a VueDeviceChannelUsage class object
                 # how are we mapping each channel to child node?
-                LOGGER.debug('{} => {} -- {}'.format(gid, channelnum, channel.usage))
-                if channel.channel_num == '1,2,3':
-                    address = str(gid)
-                else:
-                    address = str(gid) + '_' + str(channel.channel_num)
-                address = self.makeValidAddress(address)
+                if due is not None and self.tiers.tier(gid, channel.channel_num) not in due:
+                    if channel.nested_devices:
+                        self.update_devices(channel.nested_devices, scale, changes, due, accounting)
+                    continue
+                self.log.count('channels')
+                self.log.debug('%s => %s -- %s', gid, channelnum, channel.usage)
+                address = self.channel_address(gid, channel.channel_num)
 
-                LOGGER.debug('Updating child node {}'.format(address))
                 try:
                     node = self.polyglot.getNode(address)
                     if node:
-                        if scale == pyemvue.enums.Scale.SECOND.value:
-                            node.update_current(channel.usage)
+                        # channels with a live local sensor are updated by update_local
+                        local = scale == pyemvue.enums.Scale.SECOND.value and self.local_fresh(address)
+                        if local:
+                            pass
+                        elif scale == pyemvue.enums.Scale.SECOND.value:
+                            value = channel.usage
+                            interval = self.intervals.get(address) if accounting else None
+                            if interval is not None:
+                                value, peak = interval
+                                node.update_peak(peak)
+                            node.update_current(value)
+                            if accounting:
+                                self.update_history(node, address, gid, value)
                         elif scale == pyemvue.enums.Scale.MINUTE.value:
                             node.update_minute(channel.usage)
                         elif scale == pyemvue.enums.Scale.HOUR.value:
@@ -67,8 +360,14 @@ class Query(object):
                             node.update_day(channel.usage)
                         elif scale == pyemvue.enums.Scale.MONTH.value:
                             node.update_month(channel.usage)
+
+                        if changes is not None and not local:
+                            value = channel.usage
+                            if accounting and scale == pyemvue.enums.Scale.SECOND.value and address in self.intervals:
+                                value = self.intervals[address][0]
+                            changes[address] = (gid, channel.channel_num, node.name, value)
                     else:
-                        LOGGER.info('Node {} is missing, attempting to add.'.format(address))
+                        self.log.limited(logging.INFO, 'missing:' + address, 'Node %s is missing, attempting to add.', address)
                         # Add it?
                         name = channel.name
                         if name == '' or name == None:
@@ -77,52 +376,303 @@ class Query(object):
                         self.polyglot.addNode(child)
 
                 except Exception as e:
-                    LOGGER.error('Update of node {} failed for scale {} :: {}'.format(address, scale, e))
+                    self.log.error('update:' + address, 'Update of node %s failed for scale %s :: %s', address, scale, e)
 
                 # recurse into nested devices
                 if channel.nested_devices:
-                    self.update_devices(channel.nested_devices, scale)
+                    self.update_devices(channel.nested_devices, scale, changes, due, accounting)
 
-    def update_outlets(self, outlets):
+    # With a long short poll the 1S sample at the poll is a poor picture
+    # of cycling loads.  interval_usage() gets the 1S chart usage of
+    # every channel for the samples since the last poll, at most
+    # interval_limit requests at a time, and returns address ->
+    # (average, peak) in the same units as the 1S usage.  Channels that
+    # didn't answer in time keep the single sample.  With polling tiers
+    # a channel's interval starts at its tier's last update.
+    def interval_usage(self, usage, previous, instant, timeout, due=None):
+        if not self.interval_limit:
+            return {}
+        channels = []
+        self.collect_channels(usage, channels, due)
+
+        starts = collections.defaultdict(list)
+        for channel in channels:
+            last = previous
+            if due is not None:
+                last = self.tier_instants.get(self.tiers.tier(channel.device_gid, channel.channel_num))
+            if last is not None and (instant - last).total_seconds() <= MAX_INTERVAL:
+                starts[last].append(channel)
+        if due is not None:
+            for tier in due:
+                self.tier_instants[tier] = instant
+
+        intervals = {}
+        deadline = time.monotonic() + timeout if timeout else None
+        for last, channels in starts.items():
+            start = last + datetime.timedelta(seconds=1)
+            remaining = deadline - time.monotonic() if deadline else None
+            if remaining is not None and remaining <= 0:
+                break
+            try:
+                charts = self.source.chart_usage(channels, start, instant, self.interval_limit, remaining)
+            except Exception as e:
+                self.log.limited(logging.WARNING, 'interval', 'Interval usage failed: %s', e)
+                continue
+
+            for (gid, channel_num), (values, first) in charts.items():
+                # only the samples after the last update, up to this one
+                first = first or start
+                low = max(0, int((last - first).total_seconds()) + 1)
+                high = int((instant - first).total_seconds()) + 1
+                values = [v for v in values[low:high] if v is not None]
+                if values:
+                    intervals[self.channel_address(gid, channel_num)] = (sum(values) / len(values), max(values))
+        return intervals
+
+    def collect_channels(self, usage, channels, due=None):
+        for gid, device in usage.items():
+            for channel in device.channels.values():
+                if channel.channel_num in ('MainsFromGrid', 'MainsToGrid'):
+                    pass
+                elif due is None or self.tiers.tier(gid, channel.channel_num) in due:
+                    channels.append(channel)
+                if channel.nested_devices:
+                    self.collect_channels(channel.nested_devices, channels, due)
+
+    # a reading from the local source.  The node's power is updated on
+    # every reading, history/demand/cost at most once a second since
+    # they assume one sample per second.
+    def update_local(self, gid, channel_num, usage):
+        address = self.channel_address(gid, channel_num)
+        node = self.polyglot.getNode(address)
+        if node is None:
+            self.log.limited(logging.INFO, 'local:' + address, 'No node %s for local sensor', address)
+            return
+
+        try:
+            node.update_current(usage)
+            self.publish(pyemvue.enums.Scale.SECOND.value, {address: (gid, channel_num, node.name, usage)})
+            now = time.monotonic()
+            if now - self.local_seen.get(address, 0) >= 1:
+                self.local_seen[address] = now
+                self.update_history(node, address, gid, usage)
+        except Exception as e:
+            self.log.error('local:' + address, 'Local update of node %s failed :: %s', address, e)
+
+    def local_fresh(self, address):
+        seen = self.local_seen.get(address)
+        return seen is not None and time.monotonic() - seen < LOCAL_FRESH
+
+    # add the 1S sample to the channel's history and publish the
+    # windowed statistics, rolling averages, demand and cost.
+    def update_history(self, node, address, gid, usage):
+        if usage is None:
+            return
+
+        # the local source updates history from its own thread
+        with self.lock:
+            self._update_history(node, address, gid, usage * 3600)
+
+    def _update_history(self, node, address, gid, kw):
+        when = time.monotonic()
+        buf = self.history.record(address, kw, when)
+        node.update_window(buf.mean(), buf.max(), buf.min())
+
+        start_day = 1
+        if gid in self.info:
+            start_day = self.info[gid].billing_cycle_start_day
+        now = self.local_time(gid)
+
+        meter = self.demand.get(address)
+        if meter is None:
+            meter = history.DemandMeter(cycle_start_day=start_day)
+            self.demand[address] = meter
+        demand, peak = meter.add(kw, now)
+
+        node.update_demand(buf.mean_since(when - 60), buf.mean_since(when - 300), demand, peak)
+
+        cost = self.costs.get(address)
+        if cost is None:
+            cost = tariff.CostMeter(self.get_tariff(gid), cycle_start_day=start_day)
+            self.costs[address] = cost
+        node.update_cost(*cost.add(kw, now, peak, self.meter_cost(gid, address)))
+
+        # a monitor's Main channel is net of any solar, split it into
+        # grid import and export
+        if node.id == 'controller':
+            net = self.net.get(address)
+            if net is None:
+                net = history.NetMeter()
+                self.net[address] = net
+            node.update_net(*net.add(kw, now))
+
+    # the CostMeter of the Main channel of the monitor a channel is on,
+    # plugs and chargers count against their parent's.  None for a Main.
+    def meter_cost(self, gid, address):
+        parent = self.info[gid].parent_device_gid if gid in self.info else None
+        main = self.channel_address(parent if parent in self.info else gid, '1,2,3')
+        if main == address:
+            return None
+        return self.costs.get(main)
+
+    # Only push status for outlets/chargers whose state changed since
+    # the last status poll.  Devices with a command in progress are
+    # skipped and forgotten so they're refreshed once it completes.
+    def changed(self, gid, status, force):
+        if self.commands.busy(str(gid)):
+            self.last_status.pop(gid, None)
+            return False
+        if not force and self.last_status.get(gid) == status:
+            return False
+        self.last_status[gid] = status
+        return True
+
+    def update_outlets(self, outlets, force=False):
         for outlet in outlets:
+            if not self.changed(outlet.device_gid, (outlet.outlet_on,), force):
+                continue
             try:
                 node = self.polyglot.getNode(str(outlet.device_gid))
                 if node:
-                    LOGGER.debug('Updating status to {}'.format(outlet.outlet_on))
+                    self.log.debug('Updating status to %s', outlet.outlet_on)
+                    node.outlet = outlet
                     node.update_state(outlet.outlet_on)
                 else:
-                    LOGGER.error('Node {} (outlet) is missing!'.format(outlet.device_gid))
+                    self.log.error('missing:{}'.format(outlet.device_gid), 'Node %s (outlet) is missing!', outlet.device_gid)
             except Exception as e:
-                LOGGER.error('Failed to update {}:: {}'.format(outlet.device_gid, e))
+                self.log.error('status:{}'.format(outlet.device_gid), 'Failed to update %s:: %s', outlet.device_gid, e)
 
-    def update_chargers(self, chargers):
+    def update_chargers(self, chargers, force=False):
         for charger in chargers:
+            status = (charger.charger_on, charger.charging_rate, charger.max_charging_rate)
+            if not self.changed(charger.device_gid, status, force):
+                continue
             try:
                 node = self.polyglot.getNode(str(charger.device_gid))
                 if node:
-                    LOGGER.debug('Updating status to {}'.format(charger.charger_on))
+                    self.log.debug('Updating status to %s', charger.charger_on)
+                    node.charger = charger
                     node.update_state(charger.charger_on)
                     node.update_rate(charger.charging_rate)
                     node.update_max_rate(charger.max_charging_rate)
                 else:
-                    LOGGER.error('Node {} (charger) is missing!'.format(charger.device_gid))
+                    self.log.error('missing:{}'.format(charger.device_gid), 'Node %s (charger) is missing!', charger.device_gid)
             except Exception as e:
-                LOGGER.error('Failed to update {}:: {}'.format(charger.device_gid, e))
+                self.log.error('status:{}'.format(charger.device_gid), 'Failed to update %s:: %s', charger.device_gid, e)
+
+    # connectivity goes to the ST driver of the device (controller) nodes
+    def update_connected(self, devices, force=False):
+        for device in devices:
+            if not force and self.last_connected.get(device.device_gid) == device.connected:
+                continue
+            self.last_connected[device.device_gid] = device.connected
+            node = self.polyglot.getNode(str(device.device_gid))
+            if node and node.id == 'controller':
+                self.log.debug('Device %s connected = %s', device.device_gid, device.connected)
+                node.update_status(self.status(device.device_gid))
+
+    # Emporia publishes 1S samples a few seconds late and polling faster
+    # than it publishes returns the same instant again.  new_instant()
+    # tracks the last instant applied for each scale and returns False
+    # for a repeat.  For 1S it also checks how far behind the data is
+    # and marks the devices stale when it's more than stale_after.
+    def new_instant(self, scale, usage):
+        if scale != pyemvue.enums.Scale.SECOND.value:
+            return True
+        instant = next(iter(usage.values())).timestamp if usage else None
+        if instant is None:
+            return True
+
+        now = datetime.datetime.now(datetime.timezone.utc)
+        lag = (now - instant).total_seconds()
+        self.set_stale(bool(self.stale_after) and lag > self.stale_after, lag)
 
+        last = self.instants.get(scale)
+        if last is not None and instant <= last:
+            self.log.count('duplicate')
+            return False
+        if last is not None and (instant - last).total_seconds() <= 1:
+            # first seen right after it was published, a sample of the publish delay
+            self.publish_lags.append(lag)
+        self.instants[scale] = instant
+        return True
+
+    # wait for the next 1S sample to be published if the poll came
+    # early, so the request gets a new instant rather than the last
+    # one again.  Uses at most half the deadline, returns the wait.
+    def align(self, scale, timeout):
+        last = self.instants.get(scale)
+        if scale != pyemvue.enums.Scale.SECOND.value or last is None or not self.publish_lags:
+            return 0
+        expected = last + datetime.timedelta(seconds=1 + min(self.publish_lags))
+        wait = (expected - datetime.datetime.now(datetime.timezone.utc)).total_seconds()
+        if wait <= 0:
+            return 0
+        wait = min(wait, timeout / 2)
+        time.sleep(wait)
+        return wait
+
+    def set_stale(self, stale, lag):
+        if stale == self.stale:
+            return
+        self.stale = stale
+        if stale:
+            LOGGER.warning('Emporia data is {:.0f} seconds behind, marking devices stale'.format(lag))
+        else:
+            LOGGER.info('Emporia data is current again')
+        for gid in self.deviceList:
+            node = self.polyglot.getNode(str(gid))
+            if node and node.id == 'controller':
+                node.update_status(self.status(gid))
+
+    # offline wins over stale
+    def status(self, gid):
+        if not self.last_connected.get(gid, True):
+            return OFFLINE
+        return STALE if self.stale else ONLINE
+
+    # time allowed for a 1S query, from the measured short poll interval
+    def deadline(self, scale):
+        if scale != pyemvue.enums.Scale.SECOND.value:
+            return None
+        now = time.monotonic()
+        last = self.last_short
+        self.last_short = now
+        if last is None:
+            return None
+        return min(max(now - last, 1), 60) * DEADLINE_FRACTION
+
+    # True while polls are suspended for Emporia maintenance
+    def maintenance(self):
+        return self.outage is not None and self.outage.suspended()
 
     # if we want to query a single device, can we call this from a node object?
     def query_device(self, gid, scale):
-    
-        usage = self.vue.get_device_list_usage([gid], None, scale=scale,
-                unit=pyemvue.enums.Unit.KWH.value)
+        if not self.ready:
+            LOGGER.info('Not ready, skipping query of {}'.format(gid))
+            return
+        if self.maintenance():
+            LOGGER.info('Emporia is down for maintenance, skipping query of {}'.format(gid))
+            return
+
+        # nodes pass their address, the usage cache is keyed by int gid
+        usage = self.source.usage([int(gid)], scale)
 
-        self.update_devices(usage, scale)
+        changes = self.snapshot_changes()
+        self.update_devices(usage, scale, changes, accounting=False)
+        self.publish(scale, changes)
 
-    def query_device_status(self):
-        outlets, chargers = self.vue.get_devices_status()
+    def query_device_status(self, force=False):
+        if not self.ready or self.maintenance():
+            return
+
+        devices = list(self.info.values())
+        outlets, chargers = self.source.status(devices)
 
         if outlets:
-            self.update_outlets(outlets)
+            self.update_outlets(outlets, force)
 
         if chargers:
-            self.update_chargers(chargers)
+            self.update_chargers(chargers, force)
+
+        self.update_connected(devices, force)
@@ -0,0 +1,213 @@
+'''
+Local HTTP server for the latest per-channel snapshot, so dashboards and
+scripts on the local network can share the node server's polls instead
+of each polling the Emporia Cloud.
+
+  GET /snapshot   JSON of every channel's latest values (ETag aware)
+  GET /events     Server-Sent Events, the full snapshot on connect then
+                  the changed channels after every poll
+
+The server runs an asyncio loop on its own thread.  The poll thread only
+hands each poll's changes to the loop with call_soon_threadsafe, the
+snapshot is updated and encoded once on the loop and the same bytes are
+queued to every SSE client.  A client that falls too far behind is
+disconnected, it gets a fresh snapshot when it reconnects.
+
+The server only listens on localhost unless a host is given, and only
+sends a CORS header when an allowed origin is given.
+'''
+
+import udi_interface
+import asyncio
+import json
+import threading
+import time
+
+LOGGER = udi_interface.LOGGER
+
+# snapshot field for each scale's usage
+FIELDS = {
+    '1S': 'kw',
+    '1MIN': 'minute_kwh',
+    '1H': 'hour_kwh',
+    '1D': 'day_kwh',
+    '1MON': 'month_kwh',
+}
+
+CLIENT_QUEUE = 64
+KEEPALIVE = 15
+
+class SnapshotServer(object):
+    def __init__(self, port, host='127.0.0.1', origin=None):
+        self.port = port
+        self.host = host
+        self.origin = origin
+        self.cors = ''
+        if origin:
+            self.cors = 'Access-Control-Allow-Origin: {}\r\n'.format(origin)
+        self.channels = {}
+        self.version = 0
+        self.encoded = None
+        self.clients = set()
+        self.loop = None
+        self.server = None
+        self.thread = None
+        self.started = threading.Event()
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        self.started.wait(5)
+
+    def run(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.server = self.loop.run_until_complete(
+                    asyncio.start_server(self.handle, self.host, self.port))
+            LOGGER.info('Snapshot server listening on {}:{}'.format(self.host, self.port))
+        except Exception as e:
+            LOGGER.error('Snapshot server failed to start on port {}: {}'.format(self.port, e))
+            self.loop = None
+            self.started.set()
+            return
+        self.started.set()
+        loop = self.loop
+        loop.run_forever()
+        loop.close()
+
+    def stop(self):
+        loop = self.loop
+        if loop is None:
+            return
+        self.loop = None
+
+        async def shutdown():
+            self.server.close()
+            for queue in list(self.clients):
+                self.disconnect(queue)
+            # give the streams a moment to end
+            tasks = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
+            if tasks:
+                await asyncio.wait(tasks, timeout=1)
+            loop.stop()
+        asyncio.run_coroutine_threadsafe(shutdown(), loop)
+
+    # called from the poll thread, changes maps a node address to
+    # (gid, channel number, name, value).  Never blocks.
+    def publish(self, scale, changes):
+        loop = self.loop
+        field = FIELDS.get(scale)
+        if loop is None or field is None or not changes:
+            return
+        try:
+            loop.call_soon_threadsafe(self.apply, field, changes, time.time())
+        except RuntimeError:
+            # loop closed while stopping
+            pass
+
+    def apply(self, field, changes, now):
+        updated = {}
+        for address, (gid, channel_num, name, value) in changes.items():
+            channel = self.channels.get(address)
+            if channel is None:
+                channel = {'gid': gid, 'channel': channel_num, 'name': name}
+                self.channels[address] = channel
+            if field == 'kw' and value is not None:
+                value = round(value * 3600, 4)
+            if channel.get(field) != value or channel.get('name') != name:
+                channel[field] = value
+                channel['name'] = name
+                channel['updated'] = now
+                updated[address] = channel
+        if not updated:
+            return
+
+        self.version += 1
+        self.encoded = None
+        if self.clients:
+            event = self.event('update', {'version': self.version, 'channels': updated})
+            for queue in list(self.clients):
+                if queue.qsize() < CLIENT_QUEUE:
+                    queue.put_nowait(event)
+                else:
+                    # too slow, drop it, it resyncs on reconnect
+                    self.disconnect(queue)
+
+    # the queues have one spare slot for the None that ends the stream
+    def disconnect(self, queue):
+        self.clients.discard(queue)
+        queue.put_nowait(None)
+
+    def snapshot(self):
+        if self.encoded is None:
+            self.encoded = json.dumps({'version': self.version, 'channels': self.channels}).encode('utf-8')
+        return self.encoded
+
+    def event(self, name, data):
+        body = json.dumps(data)
+        return 'id: {}\nevent: {}\ndata: {}\n\n'.format(self.version, name, body).encode('utf-8')
+
+    async def handle(self, reader, writer):
+        try:
+            request = await asyncio.wait_for(reader.readline(), 10)
+            headers = {}
+            while True:
+                line = await asyncio.wait_for(reader.readline(), 10)
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                key, _, value = line.decode('latin-1').partition(':')
+                headers[key.strip().lower()] = value.strip()
+
+            parts = request.decode('latin-1').split()
+            if len(parts) < 2 or parts[0] not in ('GET', 'HEAD'):
+                await self.respond(writer, '405 Method Not Allowed', b'', 'text/plain')
+                return
+            path = parts[1].split('?')[0]
+            if path in ('/', '/snapshot'):
+                etag = '"{}"'.format(self.version)
+                if headers.get('if-none-match') == etag:
+                    await self.respond(writer, '304 Not Modified', b'', 'application/json', etag)
+                else:
+                    await self.respond(writer, '200 OK', self.snapshot(), 'application/json', etag,
+                            head_only=parts[0] == 'HEAD')
+            elif path == '/events':
+                await self.stream(writer)
+            else:
+                await self.respond(writer, '404 Not Found', b'', 'text/plain')
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        except Exception as e:
+            LOGGER.debug('Snapshot client failed: {}'.format(e))
+        finally:
+            writer.close()
+
+    # head_only answers a HEAD, the headers GET would send without the body
+    async def respond(self, writer, status, body, content_type, etag=None, head_only=False):
+        head = 'HTTP/1.1 {}\r\nContent-Type: {}\r\nContent-Length: {}\r\n'.format(status, content_type, len(body))
+        if etag:
+            head += 'ETag: {}\r\n'.format(etag)
+        head += self.cors + 'Connection: close\r\n\r\n'
+        writer.write(head.encode('latin-1') + (b'' if head_only else body))
+        await writer.drain()
+
+    async def stream(self, writer):
+        writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nCache-Control: no-cache\r\n' +
+                self.cors.encode('latin-1') + b'Connection: keep-alive\r\n\r\n')
+        writer.write(b'id: %d\nevent: snapshot\ndata: %s\n\n' % (self.version, self.snapshot()))
+        await writer.drain()
+
+        queue = asyncio.Queue(CLIENT_QUEUE + 1)
+        self.clients.add(queue)
+        try:
+            while True:
+                try:
+                    event = await asyncio.wait_for(queue.get(), KEEPALIVE)
+                except asyncio.TimeoutError:
+                    event = b': keepalive\n\n'
+                if event is None:
+                    break
+                writer.write(event)
+                await writer.drain()
+        finally:
+            self.clients.discard(queue)
@@ -0,0 +1,162 @@
+'''
+Data sources for the Query class.
+
+CloudSource is the Emporia Cloud through PyEmVue and is polled for
+usage at every scale and for outlet/charger status.
+
+MqttSource subscribes to the per-channel power sensors that Vue monitors
+running ESPHome publish to an MQTT broker, and pushes each reading to a
+callback as soon as it arrives.  Readings are mapped onto the same
+gid/channel as the cloud data so they update the same nodes.
+
+The local source is configured with the LocalSource custom parameter as
+a JSON object:
+
+  {
+    "broker": "192.168.1.20",    # MQTT broker host
+    "port": 1883,                # optional, default 1883
+    "username": "", "password": "",
+    "devices": [
+      {"gid": 12345,             # Emporia device gid of the monitor
+       "prefix": "vue-panel",    # ESPHome topic_prefix (node name)
+       "unit": "W",              # W (default) or kW
+       "channels": {             # channel number -> sensor object id
+         "1,2,3": "total_power", # or a full topic
+         "1": "circuit_1_power"
+       }}
+    ]
+  }
+
+ESPHome publishes sensor states to <prefix>/sensor/<object id>/state.
+paho-mqtt is only needed when a LocalSource is configured.
+'''
+
+import udi_interface
+import json
+import pyemvue
+
+LOGGER = udi_interface.LOGGER
+
+UNITS = {'w': 0.001, 'kw': 1.0}
+
+
+def parse_local_source(text):
+    '''Parse the LocalSource custom parameter, raises ValueError if invalid.'''
+    if text is None or text.strip() == '':
+        return {}
+    config = json.loads(text)
+    if not isinstance(config, dict):
+        raise ValueError('LocalSource must be a JSON object')
+    if 'broker' not in config:
+        raise ValueError('LocalSource is missing the broker')
+
+    try:
+        int(config.get('port', 1883))
+        for device in config.get('devices', []):
+            int(device['gid'])
+            if str(device.get('unit', 'W')).lower() not in UNITS:
+                raise ValueError('unknown unit {}'.format(device['unit']))
+            if not isinstance(device['channels'], dict):
+                raise ValueError('channels must map channel numbers to sensors')
+    except (KeyError, TypeError) as e:
+        raise ValueError('Invalid LocalSource device: {}'.format(e))
+    return config
+
+
+def sensor_topics(config):
+    '''Map each state topic in the config to (gid, channel number, kW per unit).'''
+    topics = {}
+    for device in config.get('devices', []):
+        gid = int(device['gid'])
+        scale = UNITS[str(device.get('unit', 'W')).lower()]
+        prefix = device.get('prefix', '')
+        for channel_num, sensor in device['channels'].items():
+            if '/' in sensor:
+                topic = sensor
+            else:
+                topic = '{}/sensor/{}/state'.format(prefix, sensor)
+            topics[topic] = (gid, str(channel_num), scale)
+    return topics
+
+
+class CloudSource(object):
+    name = 'cloud'
+
+    def __init__(self, vue):
+        self.vue = vue
+
+    def usage(self, gids, scale, reuse=False, timeout=None):
+        return self.vue.get_device_list_usage(gids, None, scale=scale,
+                unit=pyemvue.enums.Unit.KWH.value, reuse=reuse, timeout=timeout)
+
+    def chart_usage(self, channels, start, end, limit, timeout=None):
+        return self.vue.get_chart_usage_list(channels, start, end, scale=pyemvue.enums.Scale.SECOND.value,
+                unit=pyemvue.enums.Unit.KWH.value, limit=limit, timeout=timeout)
+
+    def status(self, devices):
+        return self.vue.get_devices_status(devices)
+
+
+class MqttSource(object):
+    name = 'mqtt'
+
+    # client is only for testing with a broker stand-in, normally a
+    # paho client is created when the source is started.
+    def __init__(self, config, client=None):
+        self.config = config
+        self.topics = sensor_topics(config)
+        self.client = client
+        self.callback = None
+        self.messages = 0
+        self.errors = 0
+
+    # callback(gid, channel_num, usage) is called on the MQTT network
+    # thread for every reading.  usage is in kWh over one second, the
+    # same as a 1S cloud sample.
+    def start(self, callback):
+        self.callback = callback
+        if self.client is None:
+            import paho.mqtt.client as mqtt
+            # paho-mqtt 2.x wants the callback API version
+            version = getattr(mqtt, 'CallbackAPIVersion', None)
+            self.client = mqtt.Client(version.VERSION2) if version else mqtt.Client()
+            if self.config.get('username'):
+                self.client.username_pw_set(self.config['username'], self.config.get('password'))
+        self.client.on_connect = self.on_connect
+        self.client.on_message = self.on_message
+        LOGGER.info('Connecting to local MQTT broker {}'.format(self.config['broker']))
+        self.client.connect_async(self.config['broker'], int(self.config.get('port', 1883)))
+        self.client.loop_start()
+
+    def stop(self):
+        if self.client is not None:
+            self.client.loop_stop()
+            self.client.disconnect()
+        self.callback = None
+
+    def on_connect(self, client, userdata, flags, rc, properties=None):
+        if rc != 0:
+            LOGGER.error('Local MQTT broker refused the connection: {}'.format(rc))
+            return
+        LOGGER.info('Subscribing to {} local sensors'.format(len(self.topics)))
+        for topic in self.topics:
+            client.subscribe(topic)
+
+    def on_message(self, client, userdata, message):
+        self.handle(message.topic, message.payload)
+
+    def handle(self, topic, payload):
+        sensor = self.topics.get(topic)
+        if sensor is None or self.callback is None:
+            return
+        gid, channel_num, scale = sensor
+        try:
+            kw = float(payload) * scale
+        except (TypeError, ValueError):
+            # ESPHome publishes 'nan' or '' while a sensor has no state
+            self.errors += 1
+            return
+        if kw != kw:
+            return
+        self.messages += 1
+        self.callback(gid, channel_num, kw / 3600)
@@ -0,0 +1,199 @@
+'''
+Local tariff engine.  Computes cost from the usage samples we already
+poll instead of asking the Emporia Cloud for Dollars at every scale.
+
+The tariff is configured with the Tariff custom parameter as a JSON
+object:
+
+  {
+    "rate": 0.12,                # base energy rate, $/kWh
+    "demand": 8.50,              # demand charge, $/kW of cycle peak
+    "periods": [                 # time of use periods
+      {"name": "peak", "start": "16:00", "end": "21:00",
+       "days": [0, 1, 2, 3, 4], "rate": 0.31}
+    ],
+    "tiers": [                   # added to the energy rate once the
+      {"above": 500, "adder": 0.04}   # cycle-to-date kWh is above
+    ],
+    "seasons": [                 # override any of the above by month
+      {"name": "summer", "months": [6, 7, 8, 9], "rate": 0.15}
+    ]
+  }
+
+Anything not configured falls back to the device's usage_cent_per_kw_hour
+and peak_demand_dollar_per_kw from the Emporia location properties.
+'''
+
+import json
+import history
+
+
+def parse_tariff(text):
+    '''
+    Parse the Tariff custom parameter, raises ValueError if invalid.
+    Rates, thresholds and months are converted here so a bad value is
+    reported once instead of failing on every sample.
+    '''
+    if text is None or text.strip() == '':
+        return {}
+    config = json.loads(text)
+    if not isinstance(config, dict):
+        raise ValueError('Tariff must be a JSON object')
+
+    try:
+        config = _check_rates(config)
+        seasons = []
+        for season in config.get('seasons', []):
+            if 'months' not in season:
+                raise ValueError('Tariff season is missing months')
+            months = season['months']
+            if not isinstance(months, list) or not all(isinstance(m, int) and 1 <= m <= 12 for m in months):
+                raise ValueError('Tariff season months must be a list of 1 to 12')
+            seasons.append(_check_rates(season))
+        if 'seasons' in config:
+            config['seasons'] = seasons
+    except (KeyError, TypeError, AttributeError) as e:
+        raise ValueError('Invalid tariff setting: {}'.format(e))
+    return config
+
+
+# the rate, demand, periods and tiers of the tariff or a season, with
+# every number converted to float
+def _check_rates(config):
+    config = dict(config)
+    for key in ('rate', 'demand'):
+        if key in config:
+            config[key] = _number(config[key], key)
+
+    periods = []
+    for period in config.get('periods', []):
+        period = dict(period)
+        _minutes(period['start'])
+        _minutes(period['end'])
+        period['rate'] = _number(period['rate'], 'period rate')
+        if 'days' in period and not all(isinstance(d, int) and 0 <= d <= 6 for d in period['days']):
+            raise ValueError('Tariff period days must be 0 (Monday) to 6')
+        periods.append(period)
+    if 'periods' in config:
+        config['periods'] = periods
+
+    tiers = []
+    for tier in config.get('tiers', []):
+        tiers.append({'above': _number(tier['above'], 'tier above'), 'adder': _number(tier['adder'], 'tier adder')})
+    if 'tiers' in config:
+        config['tiers'] = tiers
+    return config
+
+
+def _number(value, name):
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        raise ValueError('Tariff {} must be a number'.format(name))
+    return float(value)
+
+
+def _minutes(hhmm):
+    hour, minute = hhmm.split(':')
+    return int(hour) * 60 + int(minute)
+
+
+class Tariff(object):
+    def __init__(self, config, default_rate=0.0, default_demand=0.0):
+        self.config = config if config else {}
+        self.default_rate = default_rate if default_rate else 0.0
+        self.default_demand = default_demand if default_demand else 0.0
+
+    def _lookup(self, key, now, default):
+        for season in self.config.get('seasons', []):
+            if now.month in season['months'] and key in season:
+                return season[key]
+        return self.config.get(key, default)
+
+    def energy_rate(self, now, cycle_kwh=0.0):
+        '''$/kWh at local time now given the kWh used so far this cycle.'''
+        rate = self._lookup('rate', now, self.default_rate)
+
+        minute = now.hour * 60 + now.minute
+        for period in self._lookup('periods', now, []):
+            if 'days' in period and now.weekday() not in period['days']:
+                continue
+            start = _minutes(period['start'])
+            end = _minutes(period['end'])
+            if start <= end:
+                match = start <= minute < end
+            else:
+                match = minute >= start or minute < end
+            if match:
+                rate = period['rate']
+                break
+
+        for tier in self._lookup('tiers', now, []):
+            if cycle_kwh > tier['above']:
+                rate += tier['adder']
+        return rate
+
+    def demand_rate(self, now):
+        '''$/kW charged on the billing cycle peak demand.'''
+        return self._lookup('demand', now, self.default_demand)
+
+
+class CostMeter(object):
+    '''
+    Applies a tariff incrementally to one channel's power samples.  Energy
+    is integrated over the time between samples, gaps longer than
+    max_gap seconds (outages, restarts) are not billed.
+
+    The utility applies tiers and the demand charge to the whole meter,
+    so a circuit's CostMeter is given the CostMeter of its monitor's Main
+    channel: the tier comes from the Main's cycle kWh and the circuit is
+    charged the share of the Main's demand charge that its cycle kWh is
+    of the Main's.
+    '''
+    def __init__(self, tariff, cycle_start_day=1, max_gap=300):
+        self.tariff = tariff
+        self.cycle_start_day = cycle_start_day
+        self.max_gap = max_gap
+        self.last = None
+        self.day = None
+        self.cycle = None
+        self.day_cost = 0.0
+        self.cycle_cost = 0.0
+        self.cycle_kwh = 0.0
+        self.peak_kw = 0.0
+
+    def add(self, kw, now, peak_kw=0.0, meter=None):
+        '''
+        Add a power sample taken at local time now.  Returns the current
+        cost rate ($/hour), day to date cost and cycle to date cost
+        (energy plus the demand charge).  For a Main channel (meter is
+        None) the demand charge is on peak_kw, for a circuit it's the
+        circuit's share of the meter's.
+        '''
+        day = now.date()
+        cycle = history.billing_cycle(now, self.cycle_start_day)
+        if day != self.day:
+            self.day = day
+            self.day_cost = 0.0
+        if cycle != self.cycle:
+            self.cycle = cycle
+            self.cycle_cost = 0.0
+            self.cycle_kwh = 0.0
+
+        rate = self.tariff.energy_rate(now, (meter if meter is not None else self).cycle_kwh)
+        if self.last is not None:
+            elapsed = (now - self.last).total_seconds()
+            if 0 < elapsed <= self.max_gap:
+                kwh = kw * elapsed / 3600
+                self.cycle_kwh += kwh
+                self.day_cost += kwh * rate
+                self.cycle_cost += kwh * rate
+        self.last = now
+
+        if meter is None:
+            self.peak_kw = peak_kw
+            demand = peak_kw * self.tariff.demand_rate(now)
+        elif meter.cycle_kwh > 0:
+            share = min(1.0, max(0.0, self.cycle_kwh / meter.cycle_kwh))
+            demand = meter.peak_kw * self.tariff.demand_rate(now) * share
+        else:
+            demand = 0.0
+        return (kw * rate, self.day_cost, self.cycle_cost + demand)
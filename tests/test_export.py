@@ -0,0 +1,144 @@
+'''
+Exporter retry and spool paths against a sink stand-in.  Run from the
+repository root with python -m pytest.
+'''
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from bench import stub_udi
+stub_udi.install()
+
+import requests
+import export
+
+
+class Sink(object):
+    '''Stands in for the database behind the exporter's requests.Session.
+       Each POST is answered with the next status code (or raises the next
+       exception) in replies, then 204 once they run out.'''
+    def __init__(self, *replies):
+        self.replies = list(replies)
+        self.bodies = []
+
+    def post(self, url, data=None, timeout=None):
+        self.bodies.append(data)
+        reply = self.replies.pop(0) if self.replies else 204
+        if isinstance(reply, Exception):
+            raise reply
+        response = requests.Response()
+        response.status_code = reply
+        response.url = url
+        return response
+
+
+CHANGES = {'100000_1': (100000, '1', 'Fridge', 0.0005)}
+
+
+class ExporterTest(unittest.TestCase):
+    def setUp(self):
+        self.spool = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.spool)
+
+    def exporter(self, sink, **config):
+        config.setdefault('url', 'http://sink/write')
+        exporter = export.Exporter(config)
+        exporter.session.post = sink.post
+        # no backoff delays
+        exporter.stopping.wait = lambda timeout: False
+        return exporter
+
+    def lines(self, exporter):
+        return exporter.format('1S', CHANGES, 1700000000250000000)
+
+    def test_format(self):
+        exporter = self.exporter(Sink())
+        self.assertEqual(self.lines(exporter),
+                ['emporia,gid=100000,channel=1,name=Fridge kw=1.8 1700000000250000000'])
+
+    def test_sent(self):
+        sink = Sink(204)
+        exporter = self.exporter(sink)
+        exporter.flush(self.lines(exporter))
+        self.assertEqual(len(sink.bodies), 1)
+        self.assertEqual(exporter.stats['sent_points'], 1)
+        self.assertEqual(exporter.stats['retries'], 0)
+
+    def test_connection_error_retried(self):
+        sink = Sink(requests.ConnectionError('down'))
+        exporter = self.exporter(sink)
+        exporter.flush(self.lines(exporter))
+        self.assertEqual(len(sink.bodies), 2)
+        self.assertEqual(exporter.stats['retries'], 1)
+        self.assertEqual(exporter.stats['sent_batches'], 1)
+
+    def test_too_many_requests_retried(self):
+        sink = Sink(429, 429)
+        exporter = self.exporter(sink)
+        exporter.flush(self.lines(exporter))
+        self.assertEqual(len(sink.bodies), 3)
+        self.assertEqual(exporter.stats['retries'], 2)
+        self.assertEqual(exporter.stats['sent_batches'], 1)
+
+    def test_bad_request_is_not_retried(self):
+        sink = Sink(400)
+        exporter = self.exporter(sink)
+        exporter.flush(self.lines(exporter))
+        self.assertEqual(len(sink.bodies), 1)
+        self.assertEqual(exporter.stats['retries'], 0)
+        self.assertEqual(exporter.stats['failed_batches'], 1)
+        self.assertEqual(exporter.last_error, 'HTTP 400')
+
+    def test_server_error_retried_then_spooled(self):
+        sink = Sink(*[500] * (export.RETRIES + 1))
+        exporter = self.exporter(sink, spool=self.spool)
+        exporter.flush(self.lines(exporter))
+        self.assertEqual(len(sink.bodies), export.RETRIES + 1)
+        self.assertEqual(exporter.stats['retries'], export.RETRIES)
+        self.assertEqual(exporter.stats['spooled_batches'], 1)
+        self.assertEqual(exporter.stats['failed_batches'], 0)
+        self.assertEqual(len(exporter.spool_files()), 1)
+
+    def test_spooled_then_sent(self):
+        sink = Sink(400)
+        exporter = self.exporter(sink, spool=self.spool)
+        exporter.flush(self.lines(exporter))
+        self.assertEqual(exporter.stats['spooled_batches'], 1)
+        self.assertEqual(len(exporter.spool_files()), 1)
+
+        # the sink is back, the next batch brings the spooled one with it
+        exporter.flush(self.lines(exporter))
+        self.assertEqual(exporter.stats['unspooled_batches'], 1)
+        self.assertEqual(exporter.spool_files(), [])
+        self.assertEqual(sink.bodies[1], sink.bodies[2])
+
+    def test_spool_keeps_newest_under_cap(self):
+        exporter = self.exporter(Sink(), spool=self.spool, spool_mb=0.0001)
+        first = b'x' * 60
+        second = b'y' * 60
+        self.assertTrue(exporter.spool_batch(first))
+        self.assertTrue(exporter.spool_batch(second))
+        files = exporter.spool_files()
+        self.assertEqual(len(files), 1)
+        with open(os.path.join(self.spool, files[0]), 'rb') as f:
+            self.assertEqual(f.read(), second)
+        self.assertEqual(exporter.stats['spool_dropped'], 1)
+
+    def test_queue_bounded_by_points(self):
+        exporter = self.exporter(Sink())
+        exporter.queue_points = 2
+        changes = dict(CHANGES, **{'100000_2': (100000, '2', 'Oven', 0.001)})
+        exporter.publish('1S', changes)
+        exporter.publish('1S', CHANGES)
+        self.assertEqual(exporter.depth(), 2)
+        self.assertEqual(exporter.stats['dropped'], 1)
+        self.assertEqual(len(exporter.take(block=False)), 2)
+        self.assertEqual(exporter.depth(), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
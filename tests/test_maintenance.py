@@ -0,0 +1,117 @@
+'''
+Cloud requests outside the poll loop during Emporia maintenance.  Run
+from the repository root with python -m pytest.
+'''
+
+import unittest
+
+from bench import stub_udi
+udi_interface = stub_udi.install()
+
+import commands
+import maintenance
+import pyemvue
+import vue as nodeserver
+
+
+class Notice(object):
+    '''PyEmVue stand-in whose maintenance notice is posted for the first
+       `checks` checks, and whose logins always fail.'''
+    def __init__(self, checks=0):
+        self.checks = checks
+        self.logins = 0
+
+    def down_for_maintenance(self, max_age=60):
+        if self.checks:
+            self.checks -= 1
+            return 'Scheduled maintenance'
+        return None
+
+    def login(self, **kwargs):
+        self.logins += 1
+        raise Exception('Service unavailable')
+
+
+class Cancel(object):
+    '''threading.Event stand-in that cancels after `waits` waits.'''
+    def __init__(self, waits):
+        self.waits = waits
+        self.cancelled = False
+
+    def is_set(self):
+        return self.cancelled
+
+    def wait(self, timeout):
+        self.waits -= 1
+        if self.waits <= 0:
+            self.cancelled = True
+
+
+class Node(object):
+    address = '100000'
+
+    def __init__(self):
+        self.sent = []
+
+    def send_update(self, changes):
+        self.sent.append(changes)
+
+    def refresh_state(self):
+        pass
+
+
+class MaintenanceTest(unittest.TestCase):
+    def suspended(self):
+        outage = maintenance.Maintenance(Notice(checks=1))
+        self.assertFalse(outage.failure())
+        return outage
+
+    def test_suspended_until_over(self):
+        outage = self.suspended()
+        self.assertTrue(outage.suspended())
+        outage.next_check = 0
+        outage.jitter = 0
+        self.assertFalse(outage.allow('shortPoll'))
+        self.assertFalse(outage.suspended())
+
+    def test_commands_held(self):
+        outage = self.suspended()
+        dispatcher = commands.CommandDispatcher()
+        dispatcher.hold = outage.suspended
+        commands.HOLD_RECHECK, recheck = 0.01, commands.HOLD_RECHECK
+        try:
+            node = Node()
+            dispatcher.submit(node, on=True)
+            dispatcher.thread.join(0.1)
+            self.assertEqual(node.sent, [])
+            self.assertTrue(dispatcher.busy(node.address))
+
+            outage.state = maintenance.POLLING
+            dispatcher.thread.join(0.1)
+            self.assertEqual(node.sent, [{'on': True}])
+        finally:
+            commands.HOLD_RECHECK = recheck
+
+    def test_no_logins_while_posted(self):
+        sessions = []
+        def session():
+            # the first session only checks the notice
+            vue = Notice(checks=3 if not sessions else 0)
+            sessions.append(vue)
+            return vue
+
+        original = pyemvue.PyEmVue
+        pyemvue.PyEmVue = session
+        try:
+            nodeserver.connect('user', 'password', Cancel(waits=3))
+        finally:
+            pyemvue.PyEmVue = original
+
+        # one failed login finds the notice, the next is only after it's
+        # gone: two waits on the notice, then the login fails again
+        self.assertEqual(sum(vue.logins for vue in sessions), 2)
+        self.assertEqual(sessions[0].checks, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,49 @@
+'''
+Query against a synthetic account.  Run from the repository root with
+python -m pytest.
+'''
+
+import unittest
+
+from bench import stub_udi
+udi_interface = stub_udi.install()
+
+import pyemvue
+import pyemvue.replay
+import query
+import vue as nodeserver
+from bench.synthetic import SyntheticAccount, SyntheticSession, FIRST_GID
+
+SECOND = pyemvue.enums.Scale.SECOND.value
+
+
+class QueryDeviceTest(unittest.TestCase):
+    def setUp(self):
+        self.account = SyntheticAccount(monitors=1, circuits=3)
+        vue = pyemvue.replay.offline(pyemvue.PyEmVue(), SyntheticSession(self.account))
+        self.polyglot = udi_interface.Interface()
+        nodeserver.polyglot = self.polyglot
+        nodeserver.vue = vue
+        nodeserver.querys = query.Query(self.polyglot, vue)
+        nodeserver.querys.align = lambda scale, timeout: 0
+        nodeserver.topology = {}
+        nodeserver.discover()
+        self.querys = nodeserver.querys
+        self.address = '{}_1'.format(FIRST_GID)
+
+    def test_node_query_skips_accounting(self):
+        self.account.step()
+        self.querys.query(SECOND, extra=False)
+        samples = len(self.querys.history.get(self.address))
+        cost = self.querys.costs[self.address].cycle_kwh
+
+        self.account.step()
+        self.querys.query_device(str(FIRST_GID), SECOND)
+        node = self.polyglot.getNode(self.address)
+        self.assertEqual(node.getDriver('CPW'), round(self.account.power[(FIRST_GID, '1')], 4))
+        self.assertEqual(len(self.querys.history.get(self.address)), samples)
+        self.assertEqual(self.querys.costs[self.address].cycle_kwh, cost)
+
+
+if __name__ == '__main__':
+    unittest.main()
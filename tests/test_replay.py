@@ -0,0 +1,64 @@
+'''
+Recording the bench command's traffic and replaying it.  Run from the
+repository root with python -m pytest.
+'''
+
+import argparse
+import contextlib
+import gzip
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+from bench import stub_udi
+stub_udi.install()
+
+import pyemvue
+import pyemvue.replay
+from pyemvue import __main__ as cli
+from bench.synthetic import SyntheticAccount, SyntheticSession
+
+
+def bench_args(**kwargs):
+    args = dict(cycles=3, interval=0, scales='1S', status=True, timeout=None,
+            hedge=0, interval_average=0, json=True)
+    args.update(kwargs)
+    return argparse.Namespace(**args)
+
+
+class RecordReplayTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'traffic.jsonl.gz')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def bench(self, vue):
+        with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+            cli.cmd_bench(vue, bench_args())
+
+    def test_bench_recording_replays(self):
+        account = SyntheticAccount(monitors=1, circuits=3)
+        vue = pyemvue.replay.offline(pyemvue.PyEmVue(), SyntheticSession(account))
+        pyemvue.replay.record(vue, self.path)
+        self.bench(vue)
+        # bench wrapped the recorder in its TimingSession
+        pyemvue.replay.stop_recording(vue)
+        self.assertNotIsInstance(vue.session.session, pyemvue.replay.RecordingSession)
+
+        with gzip.open(self.path, 'rt') as f:
+            recorded = [line for line in f if line.strip()]
+        # devices, then usage and status for each cycle
+        self.assertEqual(len(recorded), 1 + 2 * 3)
+
+        session = pyemvue.replay.ReplaySession(self.path, speed=0)
+        replayed = pyemvue.replay.offline(pyemvue.PyEmVue(), session)
+        self.bench(replayed)
+        self.assertEqual(session.requests, len(recorded))
+
+
+if __name__ == '__main__':
+    unittest.main()
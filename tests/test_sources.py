@@ -0,0 +1,121 @@
+'''
+MqttSource with a broker stand-in, merged into a Query polling a
+synthetic account.  Run from the repository root with python -m pytest.
+'''
+
+import unittest
+
+from bench import stub_udi
+udi_interface = stub_udi.install()
+
+import pyemvue
+import pyemvue.replay
+import query
+import sources
+import vue as nodeserver
+from bench.synthetic import SyntheticAccount, SyntheticSession, FIRST_GID
+
+SECOND = pyemvue.enums.Scale.SECOND.value
+
+
+class FakeClient(object):
+    '''Records what MqttSource asks of the paho client.'''
+    def __init__(self):
+        self.subscribed = []
+        self.connected = None
+        self.running = False
+
+    def connect_async(self, broker, port):
+        self.connected = (broker, port)
+
+    def loop_start(self):
+        self.running = True
+
+    def loop_stop(self):
+        self.running = False
+
+    def disconnect(self):
+        self.connected = None
+
+    def subscribe(self, topic):
+        self.subscribed.append(topic)
+
+
+class Message(object):
+    def __init__(self, topic, payload):
+        self.topic = topic
+        self.payload = payload
+
+
+CONFIG = {
+    'broker': 'broker.local',
+    'devices': [{'gid': FIRST_GID, 'prefix': 'vue', 'channels': {'1': 'circuit_1_power'}}],
+}
+TOPIC = 'vue/sensor/circuit_1_power/state'
+
+
+class MqttSourceTest(unittest.TestCase):
+    def setUp(self):
+        self.account = SyntheticAccount(monitors=1, circuits=3)
+        vue = pyemvue.replay.offline(pyemvue.PyEmVue(), SyntheticSession(self.account))
+        self.polyglot = udi_interface.Interface()
+        nodeserver.polyglot = self.polyglot
+        nodeserver.vue = vue
+        nodeserver.querys = query.Query(self.polyglot, vue)
+        nodeserver.querys.align = lambda scale, timeout: 0
+        nodeserver.topology = {}
+        nodeserver.discover()
+        self.querys = nodeserver.querys
+
+        self.client = FakeClient()
+        self.source = sources.MqttSource(CONFIG, client=self.client)
+        self.source.start(self.querys.update_local)
+        self.querys.local = self.source
+
+    def tearDown(self):
+        self.source.stop()
+
+    def send(self, topic, payload):
+        self.client.on_message(self.client, None, Message(topic, payload))
+
+    def test_subscribes_on_connect(self):
+        self.assertEqual(self.client.connected, ('broker.local', 1883))
+        self.client.on_connect(self.client, None, {}, 0)
+        self.assertEqual(self.client.subscribed, [TOPIC])
+
+    def test_reading_updates_node(self):
+        self.send(TOPIC, b'1500')
+        node = self.polyglot.getNode('{}_1'.format(FIRST_GID))
+        self.assertEqual(node.getDriver('CPW'), 1.5)
+        self.assertEqual(self.source.messages, 1)
+
+    def test_cloud_poll_keeps_fresh_local_value(self):
+        self.send(TOPIC, b'1500')
+        self.account.step()
+        self.querys.query(SECOND, extra=False)
+
+        local = self.polyglot.getNode('{}_1'.format(FIRST_GID))
+        cloud = self.polyglot.getNode('{}_2'.format(FIRST_GID))
+        self.assertEqual(local.getDriver('CPW'), 1.5)
+        self.assertNotEqual(cloud.getDriver('CPW'), 0)
+
+    def test_cloud_poll_takes_over_when_local_is_stale(self):
+        self.send(TOPIC, b'1500')
+        address = '{}_1'.format(FIRST_GID)
+        self.querys.local_seen[address] -= query.LOCAL_FRESH
+        self.account.step()
+        self.querys.query(SECOND, extra=False)
+        self.assertNotEqual(self.polyglot.getNode(address).getDriver('CPW'), 1.5)
+
+    def test_bad_and_unknown_readings_are_ignored(self):
+        self.send(TOPIC, b'nan')
+        self.send(TOPIC, b'')
+        self.send('vue/sensor/other/state', b'100')
+        node = self.polyglot.getNode('{}_1'.format(FIRST_GID))
+        self.assertEqual(self.source.messages, 0)
+        self.assertEqual(self.source.errors, 1)
+        self.assertNotEqual(node.getDriver('CPW'), 1.5)
+
+
+if __name__ == '__main__':
+    unittest.main()
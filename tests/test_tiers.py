@@ -0,0 +1,85 @@
+'''
+Polling tiers on a Query polling a synthetic account.  Run from the
+repository root with python -m pytest.
+'''
+
+import unittest
+
+from bench import stub_udi
+udi_interface = stub_udi.install()
+
+import pyemvue
+import pyemvue.replay
+import query
+import tiers
+import vue as nodeserver
+from bench.synthetic import SyntheticAccount, SyntheticSession, FIRST_GID
+
+SECOND = pyemvue.enums.Scale.SECOND.value
+
+CONFIG = {
+    'hot': {'interval': 1, 'channels': ['{}:1'.format(FIRST_GID)]},
+    'warm': {'interval': 10},
+}
+
+
+class PollTiersTest(unittest.TestCase):
+    def test_due_until_marked(self):
+        poll_tiers = tiers.PollTiers(CONFIG)
+        self.assertEqual(poll_tiers.due(100), {None, 'hot', 'warm'})
+        # nothing was applied, still due
+        self.assertEqual(poll_tiers.due(101), {None, 'hot', 'warm'})
+        poll_tiers.mark(poll_tiers.due(101), 101)
+        self.assertEqual(poll_tiers.due(102), {None, 'hot'})
+        self.assertEqual(poll_tiers.due(111), {None, 'hot', 'warm'})
+
+
+class QueryTiersTest(unittest.TestCase):
+    def setUp(self):
+        self.account = SyntheticAccount(monitors=1, circuits=3)
+        vue = pyemvue.replay.offline(pyemvue.PyEmVue(), SyntheticSession(self.account))
+        self.polyglot = udi_interface.Interface()
+        nodeserver.polyglot = self.polyglot
+        nodeserver.vue = vue
+        nodeserver.querys = query.Query(self.polyglot, vue)
+        nodeserver.querys.align = lambda scale, timeout: 0
+        nodeserver.topology = {}
+        nodeserver.discover()
+        self.querys = nodeserver.querys
+        self.querys.set_tiers(CONFIG)
+        self.warm = self.polyglot.getNode('{}_2'.format(FIRST_GID))
+
+    def poll(self, step=True):
+        if step:
+            self.account.step()
+        self.querys.query(SECOND, extra=False)
+
+    def test_duplicate_instant_leaves_tier_due(self):
+        self.poll()
+        warm_last = self.querys.tiers.last['warm']
+
+        # the warm tier is due, but the cloud answers with the same instant
+        self.querys.tiers.last['warm'] -= 10
+        warm_last -= 10
+        self.poll(step=False)
+        self.assertEqual(self.querys.tiers.last['warm'], warm_last)
+
+        before = self.warm.getDriver('CPW')
+        self.poll()
+        self.assertGreater(self.querys.tiers.last['warm'], warm_last)
+        self.assertNotEqual(self.warm.getDriver('CPW'), before)
+
+    def test_deadline_leaves_tier_due(self):
+        self.poll()
+        self.querys.tiers.last['warm'] -= 10
+        warm_last = self.querys.tiers.last['warm']
+
+        def late(scale, timeout, gids):
+            raise pyemvue.DeadlineExceeded('late')
+        self.querys.fetch_usage = late
+        self.poll()
+        self.assertEqual(self.querys.tiers.last['warm'], warm_last)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,118 @@
+'''
+Polling tiers.  Only a few circuits usually need second by second
+updates, the PollTiers custom parameter puts channels into tiers that
+are polled at their own interval (seconds) as a JSON object:
+
+  {
+    "hot":  {"interval": 1,  "channels": ["12345:1", "12345:4", "67890"]},
+    "warm": {"interval": 10, "channels": ["12345:2"]},
+    "cold": {"interval": 60}
+  }
+
+A channel is "gid:channel number", a gid alone is every channel of that
+device ("12345:1,2,3" is just the device's Main).  The tier without a
+channel list gets everything that isn't listed, without one unlisted
+channels are updated on every short poll.
+
+Each short poll only requests the devices that have a channel in a tier
+that's due and only updates the nodes of those channels.  The Emporia
+Cloud returns whole devices, so a device with one hot channel is still
+requested on every short poll, its other channels are just not updated.
+'''
+
+import json
+
+# a tier is due this much early so timer jitter doesn't push it back a
+# whole short poll
+SLACK = 0.5
+
+
+def parse_tiers(text):
+    '''Parse the PollTiers custom parameter, raises ValueError if invalid.'''
+    if text is None or text.strip() == '':
+        return {}
+    config = json.loads(text)
+    if not isinstance(config, dict):
+        raise ValueError('PollTiers must be a JSON object')
+
+    defaults = 0
+    for name, tier in config.items():
+        if not isinstance(tier, dict):
+            raise ValueError('tier {} must be a JSON object'.format(name))
+        try:
+            if float(tier.get('interval', 1)) <= 0:
+                raise ValueError('tier {} interval must be positive'.format(name))
+        except TypeError:
+            raise ValueError('tier {} interval must be a number of seconds'.format(name))
+        channels = tier.get('channels')
+        if channels is None:
+            defaults += 1
+        elif not isinstance(channels, list):
+            raise ValueError('tier {} channels must be a list'.format(name))
+    if defaults > 1:
+        raise ValueError('only one tier can be without channels')
+    return config
+
+
+class PollTiers(object):
+    def __init__(self, config):
+        self.config = config
+        self.intervals = {}
+        self.channels = {}
+        self.default = None
+        for name, tier in config.items():
+            self.intervals[name] = float(tier.get('interval', 1))
+            if tier.get('channels') is None:
+                self.default = name
+            for channel in tier.get('channels', []):
+                self.channels[str(channel).replace(' ', '')] = name
+        self.last = {}
+        self.tier_cache = {}
+        self.gid_cache = {}
+
+    # forget what was worked out for the old device list
+    def reset(self):
+        self.tier_cache = {}
+        self.gid_cache = {}
+
+    # the tier of a channel, None is unlisted without a default tier
+    def tier(self, gid, channel_num):
+        key = (gid, channel_num)
+        if key not in self.tier_cache:
+            tier = self.channels.get('{}:{}'.format(gid, channel_num))
+            if tier is None:
+                tier = self.channels.get(str(gid), self.default)
+            self.tier_cache[key] = tier
+        return self.tier_cache[key]
+
+    # the tiers to update on a short poll at now (monotonic).  Doesn't
+    # use them up, mark() does that once the poll has been applied.
+    def due(self, now):
+        due = {None}
+        for name, interval in self.intervals.items():
+            last = self.last.get(name)
+            if last is None or now - last >= interval - SLACK:
+                due.add(name)
+        return frozenset(due)
+
+    # the tiers in due were updated by the poll started at now
+    def mark(self, due, now):
+        for name in due:
+            if name is not None:
+                self.last[name] = now
+
+    # gids in deviceList with a channel in a due tier, plus their parents
+    # since Emporia returns nested devices inside the parent
+    def gids(self, due, deviceList, info):
+        gids = self.gid_cache.get(due)
+        if gids is None:
+            needed = set()
+            for gid in deviceList:
+                device = info.get(gid)
+                if device is None or any(self.tier(gid, c.channel_num) in due for c in device.channels):
+                    needed.add(gid)
+                    if device is not None and device.parent_device_gid in info:
+                        needed.add(device.parent_device_gid)
+            gids = [gid for gid in deviceList if gid in needed]
+            self.gid_cache[due] = gids
+        return gids
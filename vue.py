@@ -7,21 +7,50 @@ Copyright (C) 2021 Robert Paauwe
 import udi_interface
 import sys
 import time
+import threading
 import pyemvue
+import pyemvue.replay
 from nodes import vueDevice
 from nodes import vueChannel
 import re
 import query
+import tariff
+import sources
+import snapshot
+import export
+import maintenance
+import tiers
 
 LOGGER = udi_interface.LOGGER
 polyglot = None
 vue = None
 querys = None
+outage = None
 deviceList = []
 ready = False
 hour_update = 0
 username = ''
 password = ''
+history_window = 3600
+tariff_config = None
+local_config = None
+hedge_percentile = 95
+stale_after = query.STALE_AFTER
+interval_limit = 0
+shard_size = 0
+tier_config = {}
+snapshot_server = None
+export_config = None
+exporter = None
+startup_cancel = None
+session_lock = threading.Lock()
+topology = {}
+last_discover = 0
+discover_interval = 60
+record_file = None
+
+STARTUP_RETRY_MIN = 15
+STARTUP_RETRY_MAX = 900
 
 # UDI interface getValidAddress doesn't seem to work right
 def makeValidAddress(address):
@@ -40,6 +69,10 @@ def poll(poll_flag):
     if not ready:
         return
 
+    # nothing goes to the cloud while Emporia is down for maintenance
+    if not outage.allow(poll_flag):
+        return
+
     if poll_flag == 'shortPoll':
         try:
             querys.query(pyemvue.enums.Scale.SECOND.value, extra=True)
@@ -50,10 +83,11 @@ def poll(poll_flag):
                 querys.query(pyemvue.enums.Scale.HOUR.value, extra=False)
             else:
                 hour_update = hour_update + 1
+            outage.success(poll_flag)
         except Exception as ex:
-            # We may want to re-login when this happens?
-            LOGGER.error('SP query failed: {}'.format(ex))
-            vue.login(username=username, password=password)
+            querys.log.error('poll', 'SP query failed: %s', ex)
+            if outage.failure():
+                vue.login(username=username, password=password)
 
     else:
         '''
@@ -64,9 +98,14 @@ def poll(poll_flag):
             #query(pyemvue.enums.Scale.HOUR.value, extra=False)
             querys.query(pyemvue.enums.Scale.DAY.value, extra=False)
             querys.query(pyemvue.enums.Scale.MONTH.value, extra=False)
+
+            if discover_interval and time.time() - last_discover >= discover_interval * 60:
+                discover()
+            outage.success(poll_flag)
         except Exception as ex:
-            LOGGER.error('LP query failed: {}'.format(ex))
-            vue.login(username=username, password=password)
+            querys.log.error('poll', 'LP query failed: %s', ex)
+            if outage.failure():
+                vue.login(username=username, password=password)
 
 def parameterHandler(params):
     global polyglot
@@ -74,48 +113,243 @@ def parameterHandler(params):
     global querys
     global username
     global password
+    global history_window
+    global tariff_config
+    global local_config
+    global hedge_percentile
+    global stale_after
+    global interval_limit
+    global shard_size
+    global tier_config
+    global snapshot_server
+    global export_config
+    global exporter
+    global discover_interval
+    global record_file
     valid_u = False
     valid_p = False
 
     polyglot.Notices.clear()
+    history_window = 3600
+    tariff_config = None
+    local_config = None
+    discover_interval = 60
+    record_file = None
+    snapshot_port = 0
+    snapshot_host = '127.0.0.1'
+    snapshot_origin = None
+    new_export = None
+    hedge_percentile = 95
+    stale_after = query.STALE_AFTER
+    interval_limit = 0
+    shard_size = 0
+    tier_config = {}
 
     for p in params:
         if p == 'Username' and params[p] != '':
             valid_u = True
         if p == 'Password' and params[p] != '':
             valid_p = True
+        if p == 'HistoryWindow' and params[p] != '':
+            try:
+                history_window = max(1, int(params[p]))
+            except ValueError:
+                polyglot.Notices['cfg_h'] = 'HistoryWindow must be a number of samples'
+        if p == 'DiscoverInterval' and params[p] != '':
+            try:
+                discover_interval = max(0, int(params[p]))
+            except ValueError:
+                polyglot.Notices['cfg_d'] = 'DiscoverInterval must be a number of minutes'
+        if p == 'HedgePercentile' and params[p] != '':
+            try:
+                hedge_percentile = min(max(0, int(params[p])), 99)
+            except ValueError:
+                polyglot.Notices['cfg_hp'] = 'HedgePercentile must be a number from 0 to 99'
+        if p == 'StaleAfter' and params[p] != '':
+            try:
+                stale_after = max(0, int(params[p]))
+            except ValueError:
+                polyglot.Notices['cfg_sa'] = 'StaleAfter must be a number of seconds'
+        if p == 'IntervalAverage' and params[p] != '':
+            try:
+                interval_limit = min(max(0, int(params[p])), 32)
+            except ValueError:
+                polyglot.Notices['cfg_ia'] = 'IntervalAverage must be a number of requests from 0 to 32'
+        if p == 'ShardSize' and params[p] != '':
+            try:
+                shard_size = max(0, int(params[p]))
+            except ValueError:
+                polyglot.Notices['cfg_ss'] = 'ShardSize must be a number of devices'
+        if p == 'SnapshotPort' and params[p] != '':
+            try:
+                snapshot_port = int(params[p])
+            except ValueError:
+                polyglot.Notices['cfg_s'] = 'SnapshotPort must be a port number'
+        if p == 'SnapshotHost' and params[p] != '':
+            snapshot_host = params[p].strip()
+        if p == 'SnapshotOrigin' and params[p] != '':
+            if re.search(r'\s', params[p].strip()):
+                polyglot.Notices['cfg_so'] = 'SnapshotOrigin must be a single origin or *'
+            else:
+                snapshot_origin = params[p].strip()
+        if p == 'Export':
+            try:
+                new_export = export.parse_export(params[p])
+            except ValueError as e:
+                polyglot.Notices['cfg_e'] = 'Export is not valid: {}'.format(e)
+        if p == 'RecordTraffic' and params[p] != '':
+            record_file = params[p]
+        if p == 'Tariff':
+            try:
+                tariff_config = tariff.parse_tariff(params[p])
+            except ValueError as e:
+                polyglot.Notices['cfg_t'] = 'Tariff is not valid: {}'.format(e)
+        if p == 'PollTiers':
+            try:
+                tier_config = tiers.parse_tiers(params[p])
+            except ValueError as e:
+                polyglot.Notices['cfg_pt'] = 'PollTiers is not valid: {}'.format(e)
+        if p == 'LocalSource':
+            try:
+                local_config = sources.parse_local_source(params[p])
+            except ValueError as e:
+                polyglot.Notices['cfg_l'] = 'LocalSource is not valid: {}'.format(e)
+
+    # the snapshot server outlives logins, restart it only if its settings changed
+    if snapshot_server and (snapshot_server.port, snapshot_server.host, snapshot_server.origin) != (snapshot_port, snapshot_host, snapshot_origin):
+        snapshot_server.stop()
+        snapshot_server = None
+    if snapshot_port and not snapshot_server:
+        snapshot_server = snapshot.SnapshotServer(snapshot_port, snapshot_host, snapshot_origin)
+        snapshot_server.start()
+    if exporter and new_export != export_config:
+        exporter.stop()
+        exporter = None
+    export_config = new_export
+    if export_config and not exporter:
+        exporter = export.Exporter(export_config)
+        exporter.start()
+    if querys:
+        querys.consumers = consumers()
+        querys.stale_after = stale_after
+        querys.interval_limit = interval_limit
+        querys.shard_size = shard_size
+        querys.set_tiers(tier_config)
+    if vue:
+        vue.hedge_percentile = hedge_percentile or None
 
     if not valid_u:
         polyglot.Notices['cfg_u'] = 'Please enter a valid Username'
     if not valid_p:
         polyglot.Notices['cfg_p'] = 'Please enter a valid Password'
 
-    while valid_u and valid_p:
-        #  Possibly move this to start?
+    if not (valid_u and valid_p):
+        return
+
+    if querys and params['Username'] == username and params['Password'] == password:
+        # credentials didn't change, just apply the new settings
+        querys.configure(history_window, tariff_config, local_config)
+        return
+
+    username = params['Username']
+    password = params['Password']
+    start_session(username, password)
+
+# everything that gets each poll's channel values
+def consumers():
+    return [c for c in (snapshot_server, exporter) if c]
+
+'''
+Log in and discover devices on a background thread so the CUSTOMPARAMS
+handler returns right away.  Failures are retried with exponential
+backoff until it succeeds or the credentials change.
+'''
+def start_session(user, pwd):
+    global startup_cancel
+    global ready
+
+    if startup_cancel:
+        startup_cancel.set()
+    ready = False
+
+    startup_cancel = threading.Event()
+    worker = threading.Thread(target=connect, args=(user, pwd, startup_cancel), daemon=True)
+    worker.start()
+
+def connect(user, pwd, cancel):
+    global vue
+    global querys
+    global outage
+
+    delay = STARTUP_RETRY_MIN
+    # after a login fails during Emporia maintenance only the notice is
+    # checked until it's gone, the login isn't retried
+    notice = maintenance.Maintenance(pyemvue.PyEmVue())
+    down = False
+    while not cancel.is_set():
+        if down and notice.check(False):
+            cancel.wait(notice.recheck)
+            continue
+        down = False
+
         LOGGER.info('Logging in to Emporia Cloud')
-        username = params['Username']
-        password = params['Password']
         try:
-            vue = pyemvue.PyEmVue()
-            vue.login(username=params['Username'], password=params['Password'])
-            querys = query.Query(polyglot, vue)
-            LOGGER.error('querys is type {}'.format(type(querys)))
+            session = pyemvue.PyEmVue()
+            session.hedge_percentile = hedge_percentile or None
+            session.login(username=user, password=pwd)
+            # the cancel check and publishing the session happen under one
+            # lock so a cancelled login can't overwrite a newer one
+            with session_lock:
+                if cancel.is_set():
+                    break
 
-            # Now that we've logged in, discover devices
-            try:
+                # the previous session's recorder still has the file open
+                if vue is not None:
+                    pyemvue.replay.stop_recording(vue)
+                if record_file:
+                    LOGGER.info('Recording Emporia Cloud traffic to {}'.format(record_file))
+                    pyemvue.replay.record(session, record_file)
+
+                vue = session
+                outage = maintenance.Maintenance(vue)
+                # nodes hold on to querys, keep it and just give it the new session
+                if querys is None:
+                    querys = query.Query(polyglot, vue, window=history_window, tariff_config=tariff_config)
+                else:
+                    querys.use_session(vue)
+                # node queries and commands wait out maintenance too
+                querys.outage = outage
+                querys.commands.hold = outage.suspended
+                querys.consumers = consumers()
+                querys.stale_after = stale_after
+                querys.interval_limit = interval_limit
+                querys.shard_size = shard_size
+                querys.set_tiers(tier_config)
+
+                # Now that we've logged in, discover devices
                 discover()
+                querys.configure(history_window, tariff_config, local_config)
                 poll('longPoll') # force initial values
-                return  # we're good for now
-            except Exception as e:
-                LOGGER.error('Discovery failed: {}'.format(e))
-                time.sleep(60)
+                return
         except Exception as e:
-            LOGGER.error('Emporia Cloud connection failed: {}'.format(e))
-            time.sleep(60)
+            if notice.check(False):
+                LOGGER.warning('Emporia Cloud is down for maintenance, logging in once it is over: {}'.format(notice.message))
+                down = True
+                continue
+            LOGGER.error('Emporia Cloud connection failed: {}, retry in {} seconds'.format(e, delay))
+
+        cancel.wait(delay)
+        delay = min(delay * 2, STARTUP_RETRY_MAX)
+
+    LOGGER.info('Login for {} cancelled'.format(user))
 
 '''
 query for the devices on the account and create corresponding nodes. We
 create a node for each GID with child nodes for each channel.
+
+Discovery is incremental.  The device list is compared with the topology
+found last time and only new or changed devices have their properties
+fetched and their nodes added, renamed or removed.
 '''
 def discover():
     global polyglot
@@ -123,26 +357,36 @@ def discover():
     global vue
     global ready
     global querys
+    global topology
+    global last_discover
 
-    info = {}
-    deviceList = []
-    devices = vue.get_devices()
+    if not querys:
+        LOGGER.warning('Discovery requested before login completed')
+        return
 
-    for dev in devices:
-        vue.populate_device_properties(dev)
+    last_discover = time.time()
 
-        if not dev.device_gid in deviceList:
-            deviceList.append(dev.device_gid)
-            info[dev.device_gid] = dev
-            LOGGER.error('dev.channels is {}'.format(type(dev.channels)))
-            for i in dev.channels:
-                LOGGER.error('{} channel {} {}'.format(dev.device_gid, i.channel_num, i.name))
+    # merge the entries for each gid, some devices are listed more
+    # than once with different channels.
+    found = {}
+    for dev in vue.get_devices():
+        if dev.device_gid in found:
+            known = set(c.channel_num for c in found[dev.device_gid].channels)
+            found[dev.device_gid].channels += [c for c in dev.channels if c.channel_num not in known]
         else:
-            info[dev.device_gid].channels += dev.channels
-            # dev.channels is what, an array of vueChannelDevices
-            LOGGER.error('dev.channels is {}'.format(type(dev.channels)))
-            for i in dev.channels:
-                LOGGER.error('{} channel {}'.format(dev.device_gid, i))
+            found[dev.device_gid] = dev
+
+    info = {}
+    added = []
+    for gid, dev in found.items():
+        signature = device_signature(dev)
+        if topology.get(gid) == signature and gid in querys.info:
+            # unchanged, keep the properties we already have
+            info[gid] = querys.info[gid]
+            continue
+
+        vue.populate_device_properties(dev)
+        info[gid] = dev
 
         LOGGER.info(f'GID:               {dev.device_gid}')
         LOGGER.info(f'Manufacturer:      {dev.manufacturer_id}')
@@ -155,57 +399,110 @@ def discover():
         if dev.outlet:
             LOGGER.info(f'Outlet:            {dev.outlet.outlet_on}')
 
-        # create main device node for GID if needed
-        parent_addr = str(dev.device_gid)
-        node = polyglot.getNode(parent_addr)
-        if not node:
-            name = dev.device_name
-            if name == None:
-                name = dev.model
-            name = polyglot.getValidName(name)
-
-            LOGGER.info('Creating device node for {} ({})'.format(name, parent_addr))
-            if dev.ev_charger:
-                node = vueDevice.VueCharger(polyglot, parent_addr, parent_addr, name, vue, dev.ev_charger, querys)
-                polyglot.addNode(node)
-            elif dev.outlet:
-                node = vueDevice.VueOutlet(polyglot, parent_addr, parent_addr, name, vue, dev.outlet, querys)
-                polyglot.addNode(node)
-            else:
-                node = vueDevice.VueDevice(polyglot, parent_addr, parent_addr, name, querys)
-                # FIXME: this may only work for one node
-                polyglot.addNode(node, conn_status="ST")
-
-        # look up and create any channel children nodes
-        for channel in dev.channels:
-            # Look at channel_num == '1', '2', etc.
-            # channel_num == '1,2,3' is the parent node usage so skip it
-            LOGGER.info('Found channel: {} - {} ({})'.format(channel.channel_num, channel.name, channel.channel_type_gid))
-            if channel.channel_num != '1,2,3':
-                address = str(dev.device_gid) + '_' + str(channel.channel_num)
-                address = makeValidAddress(address)
-                child = polyglot.getNode(address)
-                if not child:
-                    name = channel.name
-                    if name == '' or name == None:
-                        name = 'channel_' + str(channel.channel_num)
-                    name = polyglot.getValidName(name)
-
-                    LOGGER.info('Creating child node {} / {}'.format(name, address))
-                    child = vueChannel.VueChannel(polyglot, parent_addr, address, name)
-                    polyglot.addNode(child)
-
-    querys.devices(deviceList)
-
-    # do initial query to populate all the device values??
-    LOGGER.info('Starting initial querys to populate all device values')
-    querys.query(pyemvue.enums.Scale.SECOND.value, extra=True)
-    querys.query(pyemvue.enums.Scale.HOUR.value, extra=False)
-    querys.query(pyemvue.enums.Scale.DAY.value, extra=False)
-    querys.query(pyemvue.enums.Scale.MONTH.value, extra=False)
+        if gid not in topology:
+            added.append(gid)
+        sync_device_nodes(dev, topology.get(gid))
+        topology[gid] = signature
+
+    for gid in [g for g in topology if g not in found]:
+        LOGGER.info('Device {} is no longer on the account, removing'.format(gid))
+        remove_device_nodes(gid, topology[gid])
+        del topology[gid]
+
+    deviceList = list(info.keys())
+    querys.devices(deviceList, info)
+    querys.ready = True
+
+    if not ready:
+        # do initial query to populate all the device values
+        LOGGER.info('Starting initial querys to populate all device values')
+        querys.query(pyemvue.enums.Scale.SECOND.value, extra=True)
+        querys.query(pyemvue.enums.Scale.HOUR.value, extra=False)
+        querys.query(pyemvue.enums.Scale.DAY.value, extra=False)
+        querys.query(pyemvue.enums.Scale.MONTH.value, extra=False)
+    else:
+        for gid in added:
+            LOGGER.info('Populating values for new device {}'.format(gid))
+            for scale in [pyemvue.enums.Scale.SECOND, pyemvue.enums.Scale.HOUR, pyemvue.enums.Scale.DAY, pyemvue.enums.Scale.MONTH]:
+                querys.query_device(gid, scale.value)
 
     ready = True
-            
+
+# What we compare between discoveries to decide if a device changed.
+def device_signature(dev):
+    channels = tuple(sorted((str(c.channel_num), c.name, c.channel_type_gid) for c in dev.channels))
+    return (dev.model, dev.firmware, dev.device_name, dev.parent_device_gid, channels)
+
+def channel_address(gid, channel_num):
+    return makeValidAddress(str(gid) + '_' + str(channel_num))
+
+# create or rename the device node and its channel nodes, remove any
+# channel nodes that no longer exist.
+def sync_device_nodes(dev, old_signature):
+    parent_addr = str(dev.device_gid)
+    name = dev.device_name
+    if name == None or name == '':
+        name = dev.model
+    name = polyglot.getValidName(name)
+
+    node = polyglot.getNode(parent_addr)
+    if not node:
+        LOGGER.info('Creating device node for {} ({})'.format(name, parent_addr))
+        if dev.ev_charger:
+            node = vueDevice.VueCharger(polyglot, parent_addr, parent_addr, name, dev.ev_charger, querys)
+            polyglot.addNode(node)
+        elif dev.outlet:
+            node = vueDevice.VueOutlet(polyglot, parent_addr, parent_addr, name, dev.outlet, querys)
+            polyglot.addNode(node)
+        else:
+            node = vueDevice.VueDevice(polyglot, parent_addr, parent_addr, name, querys)
+            # FIXME: this may only work for one node
+            polyglot.addNode(node, conn_status="ST")
+    elif node.name != name:
+        LOGGER.info('Renaming device node {} to {}'.format(parent_addr, name))
+        polyglot.renameNode(parent_addr, name)
+
+    # look up and create any channel children nodes
+    current = set()
+    for channel in dev.channels:
+        # Look at channel_num == '1', '2', etc.
+        # channel_num == '1,2,3' is the parent node usage so skip it
+        LOGGER.debug('Found channel: {} - {} ({})'.format(channel.channel_num, channel.name, channel.channel_type_gid))
+        if channel.channel_num == '1,2,3':
+            continue
+
+        address = channel_address(dev.device_gid, channel.channel_num)
+        current.add(address)
+        name = channel.name
+        if name == '' or name == None:
+            name = 'channel_' + str(channel.channel_num)
+        name = polyglot.getValidName(name)
+
+        child = polyglot.getNode(address)
+        if not child:
+            LOGGER.info('Creating child node {} / {}'.format(name, address))
+            child = vueChannel.VueChannel(polyglot, parent_addr, address, name)
+            polyglot.addNode(child)
+        elif child.name != name:
+            LOGGER.info('Renaming child node {} to {}'.format(address, name))
+            polyglot.renameNode(address, name)
+
+    if old_signature:
+        for channel_num, _, _ in old_signature[4]:
+            address = channel_address(dev.device_gid, channel_num)
+            if channel_num != '1,2,3' and address not in current:
+                LOGGER.info('Removing child node {}'.format(address))
+                polyglot.delNode(address)
+                querys.forget(address)
+
+def remove_device_nodes(gid, signature):
+    for channel_num, _, _ in signature[4]:
+        if channel_num != '1,2,3':
+            address = channel_address(gid, channel_num)
+            polyglot.delNode(address)
+            querys.forget(address)
+    polyglot.delNode(str(gid))
+    querys.forget(str(gid))
 
 if __name__ == "__main__":
     try: